@@ -24,6 +24,8 @@
                  ]
   :plugins [[lein-pprint "1.2.0"]]
   :main tap-mssql.core
+  :test-selectors {:default   (complement :benchmark)
+                   :benchmark :benchmark}
   :profiles {:uberjar {:aot [tap-mssql.core]}
              :system  {:java-cmd "/usr/lib/jvm/java-8-openjdk-amd64/jre/bin/java"}}
   :manifest {"Multi-Release" "true"})
@@ -1,5 +1,9 @@
 (ns tap-mssql.catalog
   (:require [tap-mssql.config :as config]
+            [tap-mssql.connection-pool :as connection-pool]
+            [tap-mssql.discovery-cache :as discovery-cache]
+            [tap-mssql.filters :as filters]
+            [tap-mssql.utils :refer [bounded-pmap]]
             [clojure.tools.logging :as log]
             [clojure.string :as string]
             [clojure.java.jdbc :as jdbc]))
@@ -38,9 +42,9 @@
   [config database]
   (try
     (conj (filter #(not (nil? (:table_catalog %)))
-                  (jdbc/with-db-metadata [md (assoc (config/->conn-map config)
-                                                    :dbname
-                                                    (:table_cat database))]
+                  (jdbc/with-db-metadata [md (connection-pool/pooled (assoc (config/->conn-map config)
+                                                                            :dbname
+                                                                            (:table_cat database)))]
                     (jdbc/metadata-result (.getSchemas md))))
           ;; Calling getSchemas does not return dbo so that's added
           ;; for each database
@@ -59,8 +63,9 @@
   (log/info "Discovering  databases...")
   (let [conn-map (config/->conn-map config)
         databases (filter (every-pred non-system-database?
-                                      (partial config-specific-database? config))
-                          (jdbc/with-db-metadata [md conn-map]
+                                      (partial config-specific-database? config)
+                                      #(filters/keep-database? (filters/->filters config) (:table_cat %)))
+                          (jdbc/with-db-metadata [md (connection-pool/pooled conn-map)]
                             (jdbc/metadata-result (.getCatalogs md))))]
     (log/infof "Found %s non-system databases." (count databases))
     databases))
@@ -84,11 +89,15 @@
    "tap_stream_id" (column->tap-stream-id column)
    "table_name"    (:table_name column)
    "schema"        {"type" "object"}
-   "metadata"      {"database-name"        (:table_cat column)
-                    "schema-name"          (:table_schem column)
-                    "table-key-properties" #{}
-                    "is-view"              (:is-view? column)
-                    "row-count"            (:approximate-row-count column)}})
+   "metadata"      (cond-> {"database-name"        (:table_cat column)
+                            "schema-name"          (:table_schem column)
+                            "table-key-properties" #{}
+                            "is-view"              (:is-view? column)
+                            "row-count"            (:approximate-row-count column)}
+                     ;; Only system-versioned tables are marked, so the
+                     ;; metadata of every other stream is unchanged
+                     (:is-temporal? column)
+                     (assoc "is-temporal" true))})
 
 (defn maybe-add-nullable-to-column-schema [column-schema column]
   (if (and column-schema
@@ -231,39 +240,44 @@
              column))
 
 (defn get-table-names [conn-map]
-  (map :table_name (jdbc/query conn-map ["SELECT table_name FROM INFORMATION_SCHEMA.TABLES"])))
+  (map :table_name (jdbc/query (connection-pool/pooled conn-map) ["SELECT table_name FROM INFORMATION_SCHEMA.TABLES"])))
+
+(defn call-with-deadlock-retry
+  "Calls `f`, retrying it after a pause when SQL Server picks it as a
+  deadlock victim. Metadata queries deadlock against concurrent DDL."
+  [f]
+  (let [max-retries 5
+        retry-delay 120000]
+    ((fn retry [attempt]
+       (try
+         (f)
+         (catch com.microsoft.sqlserver.jdbc.SQLServerException ex
+           (let [error-message (.getMessage ex)]
+             (if (some #(.contains error-message %)
+                       ["deadlocked on lock resources" "deadlock victim" "Rerun the transaction"])
+               (if (< attempt max-retries)
+                 (do
+                   (log/warnf "Deadlock detected, retrying... Attempt %d of %d" attempt max-retries)
+                   (Thread/sleep retry-delay)
+                   (retry (inc attempt)))
+                 (do
+                   (log/errorf "Max retries reached. Deadlock still persists after %d attempts" max-retries)
+                   (throw ex)))
+               (do
+                 (log/errorf "Unexpected SQL error occurred: %s" error-message)
+                 (throw ex)))))))
+     1)))
 
 (defn get-database-raw-columns
-  [conn-map database]
+  [conn-map database table-names]
   (log/infof "Discovering columns and tables for database: %s" (:table_cat database))
-
-  (let [max-retries 5
-        retry-delay 120000
-        try-fetch-columns
-        (fn retry [attempt]
-          (try
-            (let [columns (jdbc/with-db-metadata [md conn-map]
-                            (jdbc/metadata-result (.getColumns md (:table_cat database) (:table_schem database) nil nil)))
-                  table-names (set (get-table-names conn-map))]
-              (filter (comp (partial contains? table-names)
-                            :table_name)
-                      columns))
-            (catch com.microsoft.sqlserver.jdbc.SQLServerException ex
-              (let [error-message (.getMessage ex)]
-                (if (some #(.contains error-message %)
-                          ["deadlocked on lock resources" "deadlock victim" "Rerun the transaction"])
-                  (if (< attempt max-retries)
-                    (do
-                      (log/warnf "Deadlock detected, retrying... Attempt %d of %d" attempt max-retries)
-                      (Thread/sleep retry-delay)
-                      (retry (inc attempt)))
-                    (do
-                      (log/errorf "Max retries reached. Deadlock still persists after %d attempts" max-retries)
-                      (throw ex)))
-                  (do
-                    (log/errorf "Unexpected SQL error occurred: %s" error-message)
-                    (throw ex)))))))]
-    (try-fetch-columns 1)))
+  (call-with-deadlock-retry
+   (fn []
+     (let [columns (jdbc/with-db-metadata [md (connection-pool/pooled conn-map)]
+                     (jdbc/metadata-result (.getColumns md (:table_cat database) (:table_schem database) nil nil)))]
+       (filter (comp (partial contains? table-names)
+                     :table_name)
+               columns)))))
 
 (defn get-primary-keys
   [conn-map]
@@ -271,7 +285,7 @@
                        "FROM INFORMATION_SCHEMA.TABLE_CONSTRAINTS AS tc "
                        "INNER JOIN INFORMATION_SCHEMA.KEY_COLUMN_USAGE AS kcu ON tc.CONSTRAINT_TYPE = 'PRIMARY KEY' AND tc.CONSTRAINT_NAME = kcu.CONSTRAINT_NAME")]
     (log/infof "Executing query: %s" sql-query)
-    (jdbc/query conn-map [sql-query])))
+    (jdbc/query (connection-pool/pooled conn-map) [sql-query])))
 
 (defn add-primary-key?-data
   [primary-key-data column]
@@ -279,21 +293,19 @@
         pk-row (get primary-key-data key-format)]
     (assoc column :primary-key? (true? (some #(= (:column_name column) (:primary_key %)) pk-row)))))
 
-(defn get-column-database-view-names*
-  [conn-map table_cat table_schem]
-  (jdbc/with-db-metadata [md conn-map]
-    (->> (.getTables md table_cat table_schem nil (into-array ["VIEW"]))
+(defn get-database-view-names
+  "Structure: {\"schema_name\" #{\"view1\" \"view2\" ...} ...}"
+  [conn-map table_cat]
+  (jdbc/with-db-metadata [md (connection-pool/pooled conn-map)]
+    (->> (.getTables md table_cat nil nil (into-array ["VIEW"]))
          jdbc/metadata-result
-         (map :table_name)
-         (into #{}))))
-
-;;; Not memoizing this proves to have prohibitively bad performance
-;;; characteristics.
-(def get-column-database-view-names (memoize get-column-database-view-names*))
+         (reduce (fn [acc view]
+                   (update acc (:table_schem view) (fnil conj #{}) (:table_name view)))
+                 {}))))
 
 (defn add-is-view?-data
-  [conn-map column]
-  (let [view-names (get-column-database-view-names conn-map (:table_cat column) (:table_schem column))]
+  [view-names column]
+  (let [view-names (get view-names (:table_schem column) #{})]
     (assoc column :is-view? (if (view-names (:table_name column))
                               ;; Want to be explicit rather than punning
                               ;; here so that we're sure we serialize
@@ -309,13 +321,15 @@
 
 (defn get-approximate-row-count
   [conn-map]
-  (let [sql-query (str  "SELECT tbl.name as table_name, SCHEMA_NAME(tbl.schema_id) as schema_name, CAST(p.rows AS bigint) as row_count "
+  (let [sql-query (str  "SELECT tbl.name as table_name, SCHEMA_NAME(tbl.schema_id) as schema_name, CAST(p.rows AS bigint) as row_count, "
+                    ;; NULL before SQL Server 2016, where sys.tables has no temporal_type
+                    "OBJECTPROPERTY(tbl.object_id, 'TableTemporalType') as temporal_type "
                     "FROM sys.tables AS tbl "
                     "INNER JOIN sys.indexes AS idx ON idx.object_id = tbl.object_id and idx.index_id < 2 "
                     "INNER JOIN sys.partitions AS p ON p.object_id=CAST(tbl.object_id AS int) "
                     "AND p.index_id=idx.index_id")]
     (log/infof "Executing query: %s" sql-query)
-    (jdbc/query conn-map [sql-query])))
+    (jdbc/query (connection-pool/pooled conn-map) [sql-query])))
 
 (defn add-row-count-data
   [row-count-data column]
@@ -328,31 +342,333 @@
                                     :row_count)]
       (assoc column :approximate-row-count approximate-row-count))))
 
-(defn get-database-columns
-  [config database]
+(defn add-is-temporal?-data
+  "Marks the columns of system-versioned temporal tables, whose
+  temporal_type is 2."
+  [row-count-data column]
+  (let [row-count-key (format "%s.%s" (:table_schem column) (:table_name column))
+        temporal-type (-> (get row-count-data row-count-key)
+                          first
+                          :temporal_type)]
+    (assoc column :is-temporal? (= 2 temporal-type))))
+
+;;; Table names, views, primary keys and row counts are fetched for a
+;;; whole database at a time, so they are fetched once per database into a
+;;; discovery context and looked up from there by every schema, rather
+;;; than once per schema.
+
+(defn counting-round-trips
+  "Returns `f` counting a round trip in `round-trips` every time it is
+  called."
+  [round-trips f]
+  (fn [& args]
+    (swap! round-trips inc)
+    (apply f args)))
+
+(defn discovery-context
+  [config database round-trips]
   (let [conn-map (assoc (config/->conn-map config)
                         :dbname
                         (:table_cat database))
-        raw-columns (get-database-raw-columns conn-map database)
-        ;; group by "schema_name.table_name" so we can look it up
-        row-count-data (->> (get-approximate-row-count conn-map)
+        counted  (partial counting-round-trips round-trips)]
+    {:conn-map         conn-map
+     :filters          (filters/->filters config)
+     :round-trips      round-trips
+     :table-names      (set (call-with-deadlock-retry
+                             #((counted get-table-names) conn-map)))
+     :view-names       ((counted get-database-view-names) conn-map (:table_cat database))
+     ;; group by "schema_name.table_name" so we can look it up
+     :row-count-data   (->> ((counted get-approximate-row-count) conn-map)
                             (group-by #(format "%s.%s" (:schema_name %) (:table_name %))))
-        ;; group by "database.schema.table" so we can look it up
-        primary-key-data (->> (get-primary-keys conn-map)
-                              (group-by #(format "%s.%s.%s" (:table_catalog %) (:table_schema %) (:table_name %))))]
-    (->> raw-columns
-         (map (partial add-primary-key?-data primary-key-data))
-         (map (partial add-is-view?-data conn-map))
-         (map (partial add-row-count-data row-count-data))
-         (map add-unsupported?-data))))
+     ;; group by "database.schema.table" so we can look it up
+     :primary-key-data (->> ((counted get-primary-keys) conn-map)
+                            (group-by #(format "%s.%s.%s" (:table_catalog %) (:table_schema %) (:table_name %))))}))
+
+(defn get-database-columns
+  [{:keys [conn-map filters round-trips table-names view-names row-count-data primary-key-data]} database]
+  (->> ((counting-round-trips round-trips get-database-raw-columns) conn-map database table-names)
+       (filter #(filters/keep-object? filters (:table_schem %) (:table_name %)))
+       (map (partial add-primary-key?-data primary-key-data))
+       (map (partial add-is-view?-data view-names))
+       (map (partial add-row-count-data row-count-data))
+       (map (partial add-is-temporal?-data row-count-data))
+       (map add-unsupported?-data)))
+
+(defn- log-database-discovery
+  [database round-trips start-nanos]
+  (log/infof "Discovered database %s in %d ms with %d round trips"
+             (:table_cat database)
+             (quot (- (System/nanoTime) start-nanos) 1000000)
+             round-trips))
+
+(defn- start-database-discovery
+  "Lists the schemas of `database`. Its discovery context is only fetched
+  once the first of them is discovered."
+  [config database]
+  (let [start-nanos (System/nanoTime)
+        round-trips (atom 0)
+        ;; Calling getSchemas returns :table_catalog instead of table_cat so
+        ;; that key is renamed for consistency
+        schemas     (->> ((counting-round-trips round-trips get-schemas-for-db) config database)
+                         (map #(clojure.set/rename-keys % {:table_catalog :table_cat}))
+                         (filterv #(filters/keep-schema? (filters/->filters config) (:table_schem %))))]
+    (when (empty? schemas)
+      (log-database-discovery database @round-trips start-nanos))
+    {:database          database
+     :schemas           schemas
+     :start-nanos       start-nanos
+     :round-trips       round-trips
+     :remaining-schemas (atom (count schemas))
+     :context           (delay (discovery-context config database round-trips))}))
+
+(defn- discover-schema
+  [{:keys [database context round-trips start-nanos remaining-schemas]} schema]
+  (let [columns (doall (get-database-columns @context schema))]
+    (when (zero? (swap! remaining-schemas dec))
+      (log-database-discovery database @round-trips start-nanos))
+    columns))
+
+(defn get-databases-columns-by-schema
+  "Discovers every schema of every database, with up to `parallelism`
+  databases having their schemas listed, or schemas being discovered, at
+  once. Columns come back in the order of `databases` then schemas."
+  [config parallelism databases]
+  (let [discoveries (bounded-pmap parallelism (partial start-database-discovery config) databases)]
+    (apply concat
+           (bounded-pmap parallelism
+                         (fn [[discovery schema]]
+                           (discover-schema discovery schema))
+                         (for [discovery discoveries
+                               schema    (:schemas discovery)]
+                           [discovery schema])))))
+
+(defn get-database-columns-by-schema
+  [config database]
+  (get-databases-columns-by-schema config 1 [database]))
+
+;;; Bulk discovery reads every column of every table and view in a
+;;; database with one query against the sys catalog views, in place of
+;;; DatabaseMetaData.getColumns per schema plus the separate queries for
+;;; table names, views, primary keys and row counts. The columns it returns
+;;; carry the same keys, and the same values, the JDBC path builds.
+
+(defn build-bulk-columns-query
+  [where-clause]
+  (str "SELECT o.object_id, "
+       "       s.name AS table_schem, "
+       "       o.name AS table_name, "
+       "       c.name AS column_name, "
+       ;; Matches the TYPE_NAME of sp_columns, which getColumns is built on
+       "       CASE WHEN c.is_identity = 1 AND t.name IN ('numeric', 'decimal') THEN t.name + '() identity' "
+       "            WHEN c.is_identity = 1 THEN t.name + ' identity' "
+       "            ELSE t.name END AS type_name, "
+       "       CAST(COLUMNPROPERTY(c.object_id, c.name, 'precision') AS int) AS column_size, "
+       "       CAST(c.scale AS int) AS decimal_digits, "
+       "       CAST(CASE WHEN o.type = 'V' THEN 1 ELSE 0 END AS bit) AS is_view, "
+       "       CAST(CASE WHEN pk.column_id IS NULL THEN 0 ELSE 1 END AS bit) AS is_primary_key, "
+       "       CAST(CASE WHEN OBJECTPROPERTY(o.object_id, 'TableTemporalType') = 2 THEN 1 ELSE 0 END AS bit) AS is_temporal, "
+       "       CAST(p.rows AS bigint) AS row_count "
+       "FROM sys.objects AS o "
+       "INNER JOIN sys.schemas AS s ON s.schema_id = o.schema_id "
+       "INNER JOIN sys.columns AS c ON c.object_id = o.object_id "
+       "INNER JOIN sys.types AS t ON t.user_type_id = c.user_type_id "
+       "LEFT JOIN (SELECT ic.object_id, ic.column_id "
+       "           FROM sys.indexes AS i "
+       "           INNER JOIN sys.index_columns AS ic ON ic.object_id = i.object_id AND ic.index_id = i.index_id "
+       "           WHERE i.is_primary_key = 1) AS pk "
+       "       ON pk.object_id = c.object_id AND pk.column_id = c.column_id "
+       "LEFT JOIN sys.partitions AS p "
+       "       ON p.object_id = o.object_id AND p.index_id < 2 AND p.partition_number = 1 AND o.type = 'U' "
+       "WHERE o.type IN ('U', 'V')"
+       where-clause
+       " ORDER BY s.name, o.name, c.column_id"))
+
+(defn- and-clauses
+  [clauses]
+  (string/join (map #(str " AND " %) clauses)))
+
+(defn bulk-row->column
+  [database row]
+  (-> (select-keys row [:table_schem :table_name :column_name :type_name :column_size :decimal_digits])
+      (assoc :table_cat             (:table_cat database)
+             :primary-key?          (true? (:is_primary_key row))
+             :is-view?              (true? (:is_view row))
+             :is-temporal?          (true? (:is_temporal row))
+             ;; a view's count can only be done via count(*) which causes a table scan so just return 0
+             :approximate-row-count (if (:is_view row) 0 (:row_count row)))
+      add-unsupported?-data))
+
+(defn- call-skipping-inaccessible-database
+  "Calls `f`, returning `default` instead when the database can't be
+  accessed."
+  [database default f]
+  (try
+    (f)
+    (catch com.microsoft.sqlserver.jdbc.SQLServerException ex
+      ;; NB: 4060 is indicative of a lack of permissions or failed login
+      (when-not (= 4060 (.getErrorCode ex))
+        (throw ex))
+      (log/warnf "%s - Skipping due to error discovering tables: %s" (:table_cat database) (.getMessage ex))
+      default)))
+
+(defn get-database-columns-bulk
+  [config database]
+  (log/infof "Discovering columns and tables for database: %s" (:table_cat database))
+  (let [conn-map         (assoc (config/->conn-map config)
+                                :dbname
+                                (:table_cat database))
+        filters          (filters/->filters config)
+        [clauses params] (filters/sql-clauses filters "s.name" "o.name")
+        sql-params       (into [(build-bulk-columns-query (and-clauses clauses))] params)]
+    (log/infof "Executing query: %s" (pr-str sql-params))
+    (call-skipping-inaccessible-database
+     database
+     []
+     (fn []
+       (let [start-nanos (System/nanoTime)
+             columns     (->> (call-with-deadlock-retry
+                               #(jdbc/query (connection-pool/pooled conn-map) sql-params))
+                              (filter #(filters/keep-object? filters (:table_schem %) (:table_name %)))
+                              (mapv (partial bulk-row->column database)))]
+         (log-database-discovery database 1 start-nanos)
+         columns)))))
+
+;;; With `discovery_cache_path` set, the columns of objects whose
+;;; fingerprint did not change since the cache was written are taken from
+;;; the cache, and only new and changed objects are read, with the bulk
+;;; query. Row counts are always refreshed.
+
+(defn build-object-fingerprints-query
+  [where-clause]
+  (str "SELECT o.object_id, "
+       "       s.name AS schema_name, "
+       "       o.name AS table_name, "
+       "       CONVERT(varchar(23), o.modify_date, 126) AS modify_date "
+       "FROM sys.objects AS o "
+       "INNER JOIN sys.schemas AS s ON s.schema_id = o.schema_id "
+       "WHERE o.type IN ('U', 'V')"
+       where-clause))
+
+(defn get-object-fingerprints
+  "Structure: {\"object_id\" {\"schema_name\" ... \"table_name\" ... \"modify_date\" ...} ...}"
+  [conn-map filters]
+  (let [[clauses params] (filters/sql-clauses filters "s.name" "o.name")
+        sql-params       (into [(build-object-fingerprints-query (and-clauses clauses))] params)]
+    (log/infof "Executing query: %s" (pr-str sql-params))
+    (->> (jdbc/query (connection-pool/pooled conn-map) sql-params)
+         (filter #(filters/keep-object? filters (:schema_name %) (:table_name %)))
+         (map (fn [{:keys [object_id schema_name table_name modify_date]}]
+                [(str object_id) {"schema_name" schema_name
+                                  "table_name"  table_name
+                                  "modify_date" modify_date}]))
+         (into {}))))
+
+(def max-objects-per-query 1000)
+
+(defn get-object-columns-bulk
+  "Structure: {\"object_id\" [column1 column2 ...] ...}"
+  [conn-map database object-ids]
+  (let [sql-query (build-bulk-columns-query
+                   (format " AND o.object_id IN (%s)" (string/join ", " object-ids)))]
+    (->> (call-with-deadlock-retry
+          #(jdbc/query (connection-pool/pooled conn-map) [sql-query]))
+         (group-by (comp str :object_id))
+         (into {} (map (fn [[object-id rows]]
+                         [object-id (mapv (partial bulk-row->column database) rows)]))))))
+
+(defn get-database-columns-cached
+  "Returns the columns of `database` and what to cache for it next time."
+  [config cached-database database]
+  (let [start-nanos    (System/nanoTime)
+        round-trips    (atom 0)
+        counted        (partial counting-round-trips round-trips)
+        conn-map       (assoc (config/->conn-map config)
+                              :dbname
+                              (:table_cat database))]
+    (call-skipping-inaccessible-database
+     database
+     [[] nil]
+     (fn []
+       (let [fingerprints   ((counted get-object-fingerprints) conn-map (filters/->filters config))
+             cached-objects (get cached-database "objects" {})
+             changed-ids    (discovery-cache/changed-object-ids cached-objects fingerprints)
+             fresh-columns  (if (seq changed-ids)
+                              (->> (partition-all max-objects-per-query changed-ids)
+                                   (map (fn [object-ids]
+                                          ((counted get-object-columns-bulk) conn-map database object-ids)))
+                                   (apply merge))
+                              {})
+             row-count-data (when (< (count fresh-columns) (count fingerprints))
+                              (->> ((counted get-approximate-row-count) conn-map)
+                                   (group-by #(format "%s.%s" (:schema_name %) (:table_name %)))))
+             objects        (->> fingerprints
+                                 (keep (fn [[object-id object-fingerprint]]
+                                         (if-let [columns (fresh-columns object-id)]
+                                           [object-id (discovery-cache/->cached-object object-fingerprint columns) columns]
+                                           (when-let [cached-object (get cached-objects object-id)]
+                                             [object-id
+                                              cached-object
+                                              (map (partial add-row-count-data row-count-data)
+                                                   (discovery-cache/cached-columns cached-object))]))))
+                                 (sort-by (fn [[_ object]]
+                                            [(object "schema_name") (object "table_name")])))]
+         (log/infof "Read the columns of %d of %d objects in database %s, the rest came from the discovery cache"
+                    (count changed-ids)
+                    (count fingerprints)
+                    (:table_cat database))
+         (log-database-discovery database @round-trips start-nanos)
+         [(vec (mapcat #(nth % 2) objects))
+          {"objects" (into {} (map (juxt first second)) objects)}])))))
+
+(defn get-columns-cached
+  [config cache-path]
+  (let [host      (config "host")
+        cache     (discovery-cache/read-cache cache-path host)
+        databases (get-databases config)
+        results   (bounded-pmap (config/get-integer config "discovery_parallelism" 1)
+                                (fn [database]
+                                  (get-database-columns-cached config
+                                                               (get-in cache ["databases" (:table_cat database)])
+                                                               database))
+                                databases)]
+    (discovery-cache/write-cache! cache-path
+                                  host
+                                  (into {}
+                                        (keep (fn [[database [_ cached-database]]]
+                                                (when cached-database
+                                                  [(:table_cat database) cached-database])))
+                                        (map vector databases results)))
+    (mapcat first results)))
+
+(def discovery-methods #{"jdbc" "bulk"})
+
+(defn get-columns-by-method
+  [config]
+  (case (get config "discovery_method" "jdbc")
+    "jdbc"
+    (get-databases-columns-by-schema config
+                                     (config/get-integer config "discovery_parallelism" 1)
+                                     (get-databases config))
+
+    "bulk"
+    (apply concat (bounded-pmap (config/get-integer config "discovery_parallelism" 1)
+                                (partial get-database-columns-bulk config)
+                                (get-databases config)))
+
+    (throw (IllegalArgumentException.
+            (format "discovery_method must be one of %s, got: %s"
+                    (string/join ", " (sort discovery-methods))
+                    (get config "discovery_method"))))))
 
 (defn get-columns
   [config]
-  (flatten (map (partial get-database-columns config) (get-databases-with-schemas config))))
+  (if-let [cache-path (get config "discovery_cache_path")]
+    (get-columns-cached config cache-path)
+    (get-columns-by-method config)))
 
 (defn discover
   [config]
-  (jdbc/with-db-metadata [metadata (config/->conn-map config)]
+  (jdbc/with-db-metadata [metadata (connection-pool/pooled (config/->conn-map config))]
     (log/infof "Connecting to %s version %s"
                (.getDatabaseProductName metadata)
                (.getDatabaseProductVersion metadata)))
@@ -1,6 +1,7 @@
 (ns tap-mssql.config
   (:require [tap-mssql.utils :refer [try-read-only]]
             [clojure.tools.logging :as log]
+            [clojure.string :as string]
             [clojure.java.jdbc :as jdbc]))
 
 (defn check-connection [conn-map]
@@ -48,3 +49,19 @@
        (check-connection conn-map)))))
 
 (def ->conn-map (memoize ->conn-map*))
+
+(defn get-integer
+  "Reads an integer setting from the config. Config files are written by
+  hand as often as by UIs, so both JSON numbers and numeric strings are
+  accepted. Returns `default` when the setting is absent."
+  [config setting-name default]
+  (let [value (get config setting-name)]
+    (cond
+      (nil? value)     default
+      (integer? value) value
+      (string? value)  (if (string/blank? value)
+                         default
+                         (Long/parseLong (string/trim value)))
+      :else
+      (throw (IllegalArgumentException.
+              (format "Config setting %s must be an integer, got: %s" setting-name value))))))
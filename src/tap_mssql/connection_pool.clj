@@ -0,0 +1,202 @@
+(ns tap-mssql.connection-pool
+  (:require [tap-mssql.config :as config]
+            [clojure.tools.logging :as log]
+            [clojure.java.jdbc :as jdbc])
+  (:import [java.lang.reflect InvocationHandler InvocationTargetException Method Proxy]
+           [java.sql Connection SQLException]
+           [java.util ArrayDeque]
+           [java.util.concurrent ConcurrentHashMap Executors ScheduledExecutorService ThreadFactory TimeUnit]
+           [java.util.concurrent.atomic AtomicLong]
+           [java.util.function Function]
+           [javax.sql DataSource]))
+
+;;; `config/->conn-map` is a plain db-spec, so every query used to open its
+;;; own connection and pay for the TCP, TLS and login handshakes. With
+;;; `connection_pool_size` set, `pooled` turns a db-spec into one backed by
+;;; a pool of connections kept open across the run. There is one pool per
+;;; distinct db-spec, which in practice means one per database name and
+;;; ApplicationIntent.
+;;;
+;;; Borrowing never blocks: when no idle connection is left a new one is
+;;; opened, and `connection_pool_size` only bounds how many are kept idle
+;;; once returned. Idle connections are closed after
+;;; `connection_pool_idle_timeout_seconds`, and any connection that sat
+;;; idle for longer than `validation-interval-ms` is checked with
+;;; `Connection.isValid` before being handed out again.
+
+(def default-idle-timeout-seconds 300)
+
+(def validation-interval-ms 30000)
+
+(def validation-timeout-seconds 5)
+
+(defonce ^:private settings (atom {:size 0}))
+
+(defonce ^:private pools (ConcurrentHashMap.))
+
+(defonce ^:private evictor (atom nil))
+
+(defn- close-quietly!
+  [^Connection connection]
+  (try
+    (.close connection)
+    (catch SQLException ex
+      (log/debugf "Ignoring error closing a pooled connection: %s" (.getMessage ex)))))
+
+(defn- reset-connection!
+  "Undoes what a borrower may have left behind. Returns false when the
+  connection is not fit to be reused."
+  [^Connection connection]
+  (try
+    (when-not (.getAutoCommit connection)
+      (.rollback connection)
+      (.setAutoCommit connection true))
+    (not (.isClosed connection))
+    (catch SQLException _
+      false)))
+
+(defn- valid-connection?
+  [^Connection connection idle-since-ms]
+  (try
+    (and (not (.isClosed connection))
+         (or (< (- (System/currentTimeMillis) idle-since-ms) validation-interval-ms)
+             (.isValid connection validation-timeout-seconds)))
+    (catch SQLException _
+      false)))
+
+(defn- borrowed-connection
+  "Returns a Connection that hands `connection` back to `release!` when
+  closed instead of closing it. It can't be used after that."
+  [release! ^Connection connection]
+  (let [closed? (atom false)]
+    (Proxy/newProxyInstance
+     (.getClassLoader Connection)
+     (into-array Class [Connection])
+     (reify InvocationHandler
+       (invoke [_ proxy method args]
+         (case (.getName ^Method method)
+           "close"    (when (compare-and-set! closed? false true)
+                        (release! connection))
+           "isClosed" (or @closed? (.isClosed connection))
+           "equals"   (identical? proxy (first args))
+           "hashCode" (System/identityHashCode proxy)
+           "toString" (str "Pooled " connection)
+           (if @closed?
+             (throw (SQLException. "Connection has been returned to the pool"))
+             (try
+               (.invoke ^Method method connection args)
+               (catch InvocationTargetException ex
+                 (throw (.getCause ex)))))))))))
+
+(defrecord Pool [open-connection! ^ArrayDeque idle ^AtomicLong opened ^AtomicLong borrowed])
+
+(defn- release!
+  [{:keys [^ArrayDeque idle]} ^Connection connection]
+  (when-not (and (reset-connection! connection)
+                 (locking idle
+                   (when (< (.size idle) (:size @settings))
+                     (.addLast idle {:connection connection
+                                     :idle-since (System/currentTimeMillis)})
+                     true)))
+    (close-quietly! connection)))
+
+(defn borrow!
+  "Returns the most recently returned connection that is still valid, or a
+  new one."
+  [{:keys [open-connection! ^ArrayDeque idle ^AtomicLong opened ^AtomicLong borrowed] :as pool}]
+  (.incrementAndGet borrowed)
+  (loop []
+    (if-let [{:keys [connection idle-since]} (locking idle (.pollLast idle))]
+      (if (valid-connection? connection idle-since)
+        (borrowed-connection (partial release! pool) connection)
+        (do (close-quietly! connection)
+            (recur)))
+      (do (.incrementAndGet opened)
+          (borrowed-connection (partial release! pool) (open-connection!))))))
+
+(defn evict-idle!
+  "Closes the connections that have been idle since before `cutoff-ms`."
+  [{:keys [^ArrayDeque idle]} cutoff-ms]
+  (let [stale (locking idle
+                ;; The oldest connections are at the head
+                (loop [stale []]
+                  (let [oldest (.peekFirst idle)]
+                    (if (and oldest (< (:idle-since oldest) cutoff-ms))
+                      (recur (conj stale (:connection (.pollFirst idle))))
+                      stale))))]
+    (run! close-quietly! stale)))
+
+(defn make-pool
+  [open-connection!]
+  (->Pool open-connection! (ArrayDeque.) (AtomicLong.) (AtomicLong.)))
+
+(defn- ->data-source
+  [pool]
+  (reify DataSource
+    (getConnection [_]
+      (borrow! pool))
+    (getConnection [_ _ _]
+      (borrow! pool))))
+
+(defn enabled?
+  []
+  (pos? (:size @settings)))
+
+(defn pooled
+  "Returns a db-spec drawing its connections from the pool for `db-spec`,
+  or `db-spec` itself when pooling is off."
+  [db-spec]
+  (if (enabled?)
+    (let [pool (.computeIfAbsent ^ConcurrentHashMap pools
+                                 db-spec
+                                 (reify Function
+                                   (apply [_ db-spec]
+                                     (make-pool #(jdbc/get-connection db-spec)))))]
+      {:datasource (->data-source pool)})
+    db-spec))
+
+(defn close-all!
+  "Closes every idle connection, logging how many connections the run
+  opened against how many it asked for."
+  []
+  (when-let [^ScheduledExecutorService executor (first (reset-vals! evictor nil))]
+    (.shutdown executor))
+  (let [all-pools (vec (.values ^ConcurrentHashMap pools))]
+    (run! #(evict-idle! % Long/MAX_VALUE) all-pools)
+    (when (seq all-pools)
+      (log/infof "Connection pools opened %d connections for %d uses"
+                 (reduce + (map #(.get ^AtomicLong (:opened %)) all-pools))
+                 (reduce + (map #(.get ^AtomicLong (:borrowed %)) all-pools))))))
+
+(defn- daemon-thread-factory
+  []
+  (reify ThreadFactory
+    (newThread [_ runnable]
+      (doto (Thread. ^Runnable runnable "connection-pool-evictor")
+        (.setDaemon true)))))
+
+(defn configure!
+  "Sets up pooling from `connection_pool_size` (idle connections kept per
+  database, 0 to turn pooling off) and
+  `connection_pool_idle_timeout_seconds`."
+  [config]
+  (close-all!)
+  (let [size            (config/get-integer config "connection_pool_size" 0)
+        idle-timeout-ms (* 1000 (config/get-integer config
+                                                    "connection_pool_idle_timeout_seconds"
+                                                    default-idle-timeout-seconds))]
+    (reset! settings {:size size})
+    (when (pos? size)
+      (let [executor (Executors/newSingleThreadScheduledExecutor (daemon-thread-factory))
+            period   (max 1000 (quot idle-timeout-ms 2))]
+        (.scheduleAtFixedRate executor
+                              ^Runnable (fn []
+                                          (doseq [pool (.values ^ConcurrentHashMap pools)]
+                                            (evict-idle! pool (- (System/currentTimeMillis) idle-timeout-ms))))
+                              period
+                              period
+                              TimeUnit/MILLISECONDS)
+        (reset! evictor executor))
+      (log/infof "Pooling connections, keeping up to %d idle per database for %d seconds"
+                 size
+                 (quot idle-timeout-ms 1000)))))
@@ -1,11 +1,20 @@
 (ns tap-mssql.core
   (:require [tap-mssql.catalog :as catalog]
+            [tap-mssql.config :as config]
+            [tap-mssql.connection-pool :as connection-pool]
             [tap-mssql.serialized-catalog :as serialized-catalog]
             [tap-mssql.sync-strategies.full :as full]
             [tap-mssql.sync-strategies.logical :as logical]
             [tap-mssql.sync-strategies.incremental :as incremental]
+            [tap-mssql.sync-strategies.rowversion :as rowversion]
+            [tap-mssql.sync-strategies.cdc :as cdc]
+            [tap-mssql.sync-strategies.temporal :as temporal]
             [tap-mssql.singer.parse :as singer-parse]
             [tap-mssql.singer.messages :as singer-messages]
+            [tap-mssql.singer.multiplexer :as multiplexer]
+            [tap-mssql.singer.output :as singer-output]
+            [tap-mssql.singer.pipeline :as singer-pipeline]
+            [tap-mssql.singer.transform :as singer-transform]
             [clojure.tools.logging :as log]
             [singer-clojure.log :as singer-log]
             [nrepl.server :as nrepl-server]
@@ -32,6 +41,7 @@
    [nil "--state STATE" "Singer State File"
     :default {}
     :parse-fn #'singer-parse/state]
+   [nil "--follow" "Follow Mode: keep syncing LOG_BASED streams until stopped"]
    ["-h" "--help"]])
 
 (defn repl-arg-passed?
@@ -109,6 +119,15 @@
     "INCREMENTAL"
     (incremental/sync! config catalog stream-name state)
 
+    "ROWVERSION"
+    (rowversion/sync! config catalog stream-name state)
+
+    "CDC"
+    (cdc/sync! config catalog stream-name state)
+
+    "TEMPORAL"
+    (temporal/sync! config catalog stream-name state)
+
     ;; Default
     (throw (IllegalArgumentException. (format "Replication Method for stream %s is invalid: %s"
                                               stream-name
@@ -120,9 +139,12 @@
   (let [replication-method (get-in catalog ["streams" stream-name "metadata" "replication-method"])]
     (log/infof "Syncing stream %s using replication method %s" stream-name replication-method)
     (singer-messages/write-schema! catalog stream-name)
-    (->> (singer-messages/maybe-write-activate-version! stream-name replication-method catalog state)
-         (dispatch-sync-by-strategy config catalog stream-name)
-         (singer-messages/write-state! stream-name))))
+    (try
+      (->> (singer-messages/maybe-write-activate-version! stream-name replication-method catalog state)
+           (dispatch-sync-by-strategy config catalog stream-name)
+           (singer-messages/write-state! stream-name))
+      (finally
+        (singer-pipeline/log-stream-timings! stream-name)))))
 
 (defn selected? [catalog stream-name]
   (get-in catalog ["streams" stream-name "metadata" "selected"]))
@@ -137,21 +159,111 @@
         ;; returns original state
         state)))
 
+(defn do-parallel-sync [config catalog state stream-names parallelism]
+  (let [{selected true skipped false} (group-by (comp boolean (partial selected? catalog))
+                                                stream-names)]
+    (doseq [stream-name skipped]
+      (log/infof "Skipping stream %s" stream-name))
+    (multiplexer/sync-streams! parallelism
+                               (partial sync-stream! config catalog)
+                               state
+                               selected)))
+
 (defn do-sync [config catalog state]
   {:pre [(valid-state? state)]}
   (log/info "Starting sync mode")
-  ;; Sync streams, no selection (e.g., maybe-sync-stream)
-  (reduce (partial maybe-sync-stream! config catalog)
+  (let [stream-names (->> (catalog "streams")
+                          vals
+                          (map #(get % "tap_stream_id")))
+        parallelism  (config/get-integer config "max_parallel_streams" 1)]
+    (logical/prefetch-change-tracking-snapshots! config catalog)
+    (if (> parallelism 1)
+      (do-parallel-sync config catalog state stream-names parallelism)
+      ;; Sync streams, no selection (e.g., maybe-sync-stream)
+      (reduce (partial maybe-sync-stream! config catalog)
+              state
+              stream-names))))
+
+(defn log-based-stream-names
+  [catalog]
+  (->> (catalog "streams")
+       vals
+       (filter #(and (selected? catalog (% "tap_stream_id"))
+                     (= "LOG_BASED" (get-in % ["metadata" "replication-method"]))))
+       (map #(get % "tap_stream_id"))))
+
+(defn do-follow-cycle
+  "Syncs the changes made to the LOG_BASED streams since the last cycle."
+  [config catalog state stream-names]
+  (logical/prefetch-change-tracking-snapshots! config catalog)
+  (reduce (fn [state stream-name]
+            (try
+              (->> (logical/sync! config catalog stream-name state)
+                   (singer-messages/write-state! stream-name))
+              (finally
+                (singer-pipeline/log-stream-timings! stream-name))))
           state
-          (->> (catalog "streams")
-               vals
-               (map #(get % "tap_stream_id")))))
+          stream-names))
+
+(defn do-follow
+  "Syncs every selected stream once, then keeps syncing the changes to the
+  LOG_BASED streams every follow_interval_seconds until `stop` is
+  delivered. A cycle under way when it is finishes first."
+  [config catalog state stop]
+  (log/info "Starting follow mode")
+  (let [interval-ms  (* 1000 (config/get-integer config "follow_interval_seconds" 10))
+        stream-names (log-based-stream-names catalog)]
+    (when (empty? stream-names)
+      (log/warn "No LOG_BASED streams are selected, there is nothing to follow"))
+    (loop [state (do-sync config catalog state)
+           cycle 1]
+      (if (or (empty? stream-names)
+              (deref stop interval-ms false))
+        state
+        (let [start-nanos (System/nanoTime)
+              state       (do-follow-cycle config catalog state stream-names)]
+          (log/infof "Follow cycle %d took %.0f ms" cycle (/ (- (System/nanoTime) start-nanos) 1e6))
+          (recur state (inc cycle)))))))
+
+(def follow-shutdown-timeout-ms 60000)
+
+(defn follow!
+  "Runs follow mode until the process is told to stop. On SIGTERM the
+  shutdown hook waits for the current cycle to finish and its output to be
+  flushed, so the last STATE written covers every record before it."
+  [config catalog state]
+  (let [stop    (promise)
+        stopped (promise)]
+    (.addShutdownHook (Runtime/getRuntime)
+                      (Thread. (fn []
+                                 (when-not (realized? stopped)
+                                   (log/info "Stopping follow mode after the current cycle"))
+                                 (deliver stop true)
+                                 (deref stopped follow-shutdown-timeout-ms nil))))
+    (singer-output/install! config)
+    (try
+      (do-follow config catalog state stop)
+      (finally
+        (singer-output/uninstall!)
+        (deliver stopped true)))))
 
 (defn set-include-db-and-schema-names-in-messages!
   [config]
   (reset! singer-messages/include-db-and-schema-names-in-messages? (= "true"
                                                                       (get config "include_schemas_in_destination_stream_name"))))
 
+(def varbinary-encodings #{"hex" "base64"})
+
+(defn set-varbinary-encoding!
+  [config]
+  (let [encoding (or (get config "varbinary_encoding") "hex")]
+    (when-not (varbinary-encodings encoding)
+      (throw (IllegalArgumentException.
+              (format "varbinary_encoding must be one of %s, got: %s"
+                      (string/join ", " (sort varbinary-encodings))
+                      encoding))))
+    (reset! singer-transform/varbinary-encoding encoding)))
+
 (defn -main [& args]
   (let [the-nrepl-server (start-nrepl-server args)]
     ;; This and the other defs here are not accidental. These are required
@@ -159,19 +271,33 @@
     ;; intend to repl into.
     (def args args)
     (try
-      (let [{{:keys [discover repl config catalog state]} :options}
+      (let [{{:keys [discover repl config catalog state follow]} :options}
             (parse-opts args)]
         (set-include-db-and-schema-names-in-messages! config)
+        (set-varbinary-encoding! config)
+        ;; Following keeps connections warm between cycles unless told
+        ;; otherwise
+        (connection-pool/configure! (cond->> config
+                                      (and catalog follow)
+                                      (merge {"connection_pool_size" 1})))
         (cond
           discover
           (do-discovery config)
 
+          (and catalog follow)
+          (follow! config catalog state)
+
           catalog
-          (do-sync config catalog state)
+          (do (singer-output/install! config)
+              (try
+                (do-sync config catalog state)
+                (finally
+                  (singer-output/uninstall!))))
 
           :else
           ;; FIXME: (show-help)?
           nil)
+        (connection-pool/close-all!)
         (log/info "Tap Finished")
         (maybe-stop-nrepl-server args the-nrepl-server)
         (when (not (repl-arg-passed? args))
@@ -0,0 +1,87 @@
+(ns tap-mssql.discovery-cache
+  (:require [clojure.tools.logging :as log]
+            [clojure.data.json :as json]
+            [clojure.java.io :as io]
+            [clojure.walk :as walk])
+  (:import [java.nio.file Files CopyOption StandardCopyOption]))
+
+;;; The discovery cache remembers, per database, the columns discovered for
+;;; every table and view along with a fingerprint of the object taken from
+;;; sys.objects: its object_id (the key), schema, name and modify_date.
+;;; ALTER TABLE, ALTER VIEW and renames all move modify_date, so an object
+;;; whose fingerprint is unchanged still has the columns that were cached
+;;; for it and only new and changed objects need their columns read again.
+;;;
+;;; Structure:
+;;;   {"version"   1
+;;;    "host"      "the server discovered"
+;;;    "databases" {"dbname" {"objects" {"object_id" {"schema_name" ...
+;;;                                                   "table_name"  ...
+;;;                                                   "modify_date" ...
+;;;                                                   "columns"     [...]}}}}}
+
+(def cache-version 1)
+
+(def empty-cache {"version" cache-version "databases" {}})
+
+(defn read-cache
+  "Returns the cache at `path`, or an empty one when there is none yet or
+  it was written for another server or by another version of the tap."
+  [path host]
+  (let [file (io/file path)]
+    (if-not (.exists file)
+      empty-cache
+      (try
+        (let [cache (json/read-str (slurp file))]
+          (if (and (= cache-version (cache "version"))
+                   (= host (cache "host")))
+            cache
+            (do (log/infof "Ignoring discovery cache %s, it was written for another server or version" path)
+                empty-cache)))
+        (catch Exception ex
+          (log/warnf "Ignoring unreadable discovery cache %s: %s" path (.getMessage ex))
+          empty-cache)))))
+
+(defn write-cache!
+  "Replaces the cache at `path` in one move, so an interrupted discovery
+  never leaves half a cache behind."
+  [path host databases]
+  (let [file      (io/file path)
+        temp-file (io/file (str path ".tmp"))]
+    (when-let [parent (.getParentFile (.getAbsoluteFile file))]
+      (.mkdirs parent))
+    (spit temp-file (json/write-str {"version"   cache-version
+                                     "host"      host
+                                     "databases" databases}))
+    (Files/move (.toPath temp-file)
+                (.toPath file)
+                (into-array CopyOption [StandardCopyOption/REPLACE_EXISTING]))))
+
+(defn fingerprint
+  [object]
+  (select-keys object ["schema_name" "table_name" "modify_date"]))
+
+(defn changed-object-ids
+  "Ids of the objects in `fingerprints` ({object-id fingerprint}) that are
+  not in `cached-objects` with the same fingerprint."
+  [cached-objects fingerprints]
+  (->> fingerprints
+       (remove (fn [[object-id object-fingerprint]]
+                 (some-> (get cached-objects object-id)
+                         fingerprint
+                         (= object-fingerprint))))
+       (map key)
+       sort))
+
+(defn cached-columns
+  "The columns cached for an object, keyed the way discovery keys them."
+  [object]
+  (mapv walk/keywordize-keys (object "columns")))
+
+(defn ->cached-object
+  [object-fingerprint columns]
+  (assoc object-fingerprint
+         "columns" (mapv (fn [column]
+                           ;; Row counts are refreshed on every discovery
+                           (dissoc column :approximate-row-count))
+                         columns)))
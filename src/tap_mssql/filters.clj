@@ -0,0 +1,136 @@
+(ns tap-mssql.filters
+  (:require [clojure.string :as string]))
+
+;;; `include_databases`, `include_schemas` and `exclude_tables` limit what
+;;; discovery (and the change tracking lookups of log-based sync) look at.
+;;; Each is a list of patterns, given as a JSON array or a comma separated
+;;; string, and a name is matched if it matches any of them. A pattern is
+;;; either a glob, where `*` matches any run of characters and `?` any one
+;;; character, or a regular expression between slashes, like `/^stg_\d+$/`.
+;;; Commas inside a regular expression, like in `/^x{1,3}$/`, do not
+;;; separate patterns.
+;;;
+;;; Globs compare case-insensitively, as object names do under SQL
+;;; Server's default collations. Where they are pushed into metadata
+;;; queries as LIKE clauses, so that excluded objects are never sent over,
+;;; the clauses are given a case-insensitive collation so they select the
+;;; same objects whatever the database's collation. T-SQL has no regular
+;;; expressions, so those are only applied to what comes back.
+
+(defn- regex-pattern?
+  [pattern]
+  (and (< 1 (count pattern))
+       (string/starts-with? pattern "/")
+       (string/ends-with? pattern "/")))
+
+(defn- pattern->regex
+  [pattern]
+  (if (regex-pattern? pattern)
+    (re-pattern (subs pattern 1 (dec (count pattern))))
+    (->> pattern
+         (map (fn [c]
+                (case c
+                  \* ".*"
+                  \? "."
+                  (java.util.regex.Pattern/quote (str c)))))
+         (apply str "(?i)")
+         re-pattern)))
+
+(defn glob->like
+  "Translates a glob into a LIKE pattern escaped with a backslash."
+  [glob]
+  (->> glob
+       (map (fn [c]
+              (case c
+                \*            "%"
+                \?            "_"
+                (\% \_ \[ \\) (str "\\" c)
+                (str c))))
+       (apply str)))
+
+(defn- open-regex?
+  "True for the start of a regular expression a comma split in two."
+  [piece]
+  (let [piece (string/triml piece)]
+    (and (string/starts-with? piece "/")
+         (not (regex-pattern? (string/trimr piece))))))
+
+(defn- split-patterns
+  [value]
+  (reduce (fn [pieces piece]
+            (if (some-> (peek pieces) open-regex?)
+              (conj (pop pieces) (str (peek pieces) "," piece))
+              (conj pieces piece)))
+          []
+          (string/split value #"," -1)))
+
+(defn get-patterns
+  [config setting-name]
+  (let [value (get config setting-name)]
+    (cond
+      (nil? value)        []
+      (string? value)     (->> (split-patterns value)
+                               (map string/trim)
+                               (remove string/blank?)
+                               vec)
+      (sequential? value) (vec value)
+      :else
+      (throw (IllegalArgumentException.
+              (format "Config setting %s must be a list of patterns, got: %s" setting-name value))))))
+
+(defn ->filters
+  [config]
+  {:include-databases (get-patterns config "include_databases")
+   :include-schemas   (get-patterns config "include_schemas")
+   :exclude-tables    (get-patterns config "exclude_tables")})
+
+(defn- matches-any?
+  [patterns name]
+  (boolean (some #(re-matches (pattern->regex %) name) patterns)))
+
+(defn- included?
+  [patterns name]
+  (or (empty? patterns)
+      (matches-any? patterns name)))
+
+(defn keep-database?
+  [{:keys [include-databases]} database-name]
+  (included? include-databases database-name))
+
+(defn keep-schema?
+  [{:keys [include-schemas]} schema-name]
+  (included? include-schemas schema-name))
+
+(defn keep-object?
+  [{:keys [exclude-tables] :as filters} schema-name table-name]
+  (and (keep-schema? filters schema-name)
+       (not (matches-any? exclude-tables table-name))))
+
+(def like-collation
+  "Makes pushed down globs compare case-insensitively, like `keep-object?`
+  and `keep-schema?` do, under any database collation."
+  "Latin1_General_100_CI_AS")
+
+(defn sql-clauses
+  "Returns [clauses params] expressing the glob patterns for schemas and
+  tables as conditions on `schema-column` and `table-column`. Includes are
+  only pushed down when none of them is a regular expression, as they are
+  alternatives to each other."
+  [{:keys [include-schemas exclude-tables]} schema-column table-column]
+  (let [schema-globs (when (not-any? regex-pattern? include-schemas)
+                       include-schemas)
+        table-globs  (remove regex-pattern? exclude-tables)]
+    [(cond-> []
+       (seq schema-globs)
+       (conj (str "(" (string/join " OR " (repeat (count schema-globs)
+                                                  (format "%s COLLATE %s LIKE ? ESCAPE '\\'"
+                                                          schema-column
+                                                          like-collation)))
+                  ")"))
+
+       (seq table-globs)
+       (into (repeat (count table-globs)
+                     (format "%s COLLATE %s NOT LIKE ? ESCAPE '\\'"
+                             table-column
+                             like-collation))))
+     (mapv glob->like (concat schema-globs table-globs))]))
@@ -45,6 +45,12 @@
       (assoc-in ["bookmarks" stream-name "replication_key_name"]
                 replication-key)))
 
+(defn update-replication-key-pk
+  "Bookmarks the keys of the last record read alongside its replication
+  key value, to break ties between records sharing that value."
+  [stream-name pk-values state]
+  (assoc-in state ["bookmarks" stream-name "replication_key_pk"] pk-values))
+
 (defn update-last-pk-fetched [stream-name bookmark-keys state record]
   ;; bookmark-keys can be nil under certain conditions:
   ;; ex: if a view is missing view-key-properties
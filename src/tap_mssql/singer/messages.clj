@@ -1,5 +1,7 @@
 (ns tap-mssql.singer.messages
   (:require [tap-mssql.singer.schema :as singer-schema]
+            [tap-mssql.singer.output :as singer-output]
+            [tap-mssql.singer.serializer :as singer-serializer]
             [tap-mssql.singer.transform :as singer-transform]
             [clojure.data.json :as json]))
 
@@ -23,19 +25,6 @@
          "ACTIVATE_VERSION"
          (message "version"))))
 
-(def df (-> (java.time.format.DateTimeFormatterBuilder.)
-            (.appendPattern "yyyy-MM-dd'T'HH:mm:ss.SSSSSSX")
-            (.toFormatter)))
-
-(defn- parse-timestamp-to-string [ts]
-  (-> ts
-      (.toLocalDateTime)
-      (.atOffset java.time.ZoneOffset/UTC)
-      (.format df)
-      (.replace "000Z" "Z") ;; replacing microseconds because dates are saved as bookmarks and mssql does not support string datetimes being more precise than the column type
-      (.replace ".000Z" "Z") ;; same with milliseconds
-      ))
-
 ;; date - 0001-01-01 through 9999-12-31
 ;; datetime - 1753-01-01 through 9999-12-31 and 00:00:00 through 23:59:59.997 and no TZ
 ;; datetime2 - 0001-01-01 through 9999-12-31 and 00:00:00 through 23:59:59.9999999 and no TZ
@@ -51,15 +40,18 @@
 (defn serialize-datetimes [k v]
   (condp contains? (type v)
     #{java.sql.Timestamp} ;; Java type for datetime, datetime2, and smalldatetime column types
-    (parse-timestamp-to-string v)
+    (singer-transform/timestamp->string v)
 
     #{microsoft.sql.DateTimeOffset} ;; Java type for datetimeoffset columns
-    (-> v
+    (-> ^microsoft.sql.DateTimeOffset v
         (.getTimestamp)
-        (parse-timestamp-to-string))
+        (singer-transform/timestamp->string))
+
+    #{java.sql.Time} ;; Java type for Time columns
+    (singer-transform/time->string v)
 
-    #{java.sql.Time java.sql.Date} ;; Java type for Time/Date columns respectively
-    (.toString v)
+    #{java.sql.Date} ;; Java type for Date columns
+    (singer-transform/date->string v)
 
     v))
 
@@ -71,12 +63,40 @@
     (get-in catalog ["streams" stream-name "tap_stream_id"])
     (get-in catalog ["streams" stream-name "table_name"])))
 
+(def ^:dynamic *message-sink*
+  "When bound, messages are handed to this function instead of being
+  printed, either as a message map or, for records, as the already
+  serialized line. Used to funnel the output of concurrently synced
+  streams through a single writer."
+  nil)
+
+(defn serialize
+  [message]
+  (json/write-str message :value-fn serialize-datetimes))
+
+(defn write-line!
+  [^String line]
+  (if (singer-output/installed?)
+    (singer-output/write-line! (fn [^java.io.Writer writer]
+                                 (.write writer line)))
+    (println line)))
+
 (defn write!
   [message]
   {:pre [(valid? message)]}
-  (-> message
-      (json/write-str :value-fn serialize-datetimes)
-      println))
+  (cond
+    *message-sink*
+    (*message-sink* message)
+
+    (singer-output/installed?)
+    ;; Encode straight into the output buffer, no intermediate String
+    (singer-output/write-line! (fn [writer]
+                                 (json/write message writer :value-fn serialize-datetimes)))
+
+    :else
+    (-> message
+        serialize
+        write-line!)))
 
 (defn write-schema! [catalog stream-name]
   ;; TODO: Make sure that unsupported values are written with an empty schema
@@ -102,14 +122,29 @@
 
 (defn write-record!
   [stream-name state record catalog]
-  (let [transformed-record (singer-transform/transform catalog stream-name record)
-        record-message {"type"   "RECORD"
-                        "stream" (calculate-destination-stream-name stream-name catalog)
-                        "record" transformed-record}
-        version        (get-in state ["bookmarks" stream-name "version"])]
-    (if (nil? version)
-      (write! record-message)
-      (write! (assoc record-message "version" version)))))
+  (let [serializer (singer-serializer/record-serializer catalog
+                                                        stream-name
+                                                        (calculate-destination-stream-name stream-name catalog)
+                                                        serialize-datetimes)
+        version    (get-in state ["bookmarks" stream-name "version"])]
+    (cond
+      *message-sink*
+      (*message-sink* (singer-serializer/serialize-record serializer record version))
+
+      (singer-output/installed?)
+      (singer-output/write-line! (fn [writer]
+                                   (serializer writer record version)))
+
+      :else
+      (write-line! (singer-serializer/serialize-record serializer record version)))))
+
+(defn write-serialized-record!
+  "Writes a RECORD message serialized ahead of time, e.g. off the writing
+  thread."
+  [^String line]
+  (if *message-sink*
+    (*message-sink* line)
+    (write-line! line)))
 
 (defn write-activate-version!
   [stream-name catalog state]
@@ -124,8 +159,10 @@
   "Writes activate version message if not in state"
   [stream-name replication-method catalog state]
   (let [version-bookmark (get-in state ["bookmarks" stream-name "version"])
-        resuming?        (get-in state ["bookmarks"
-                                        stream-name "last_pk_fetched"] nil)
+        resuming?        (or (get-in state ["bookmarks"
+                                            stream-name "last_pk_fetched"] nil)
+                             (get-in state ["bookmarks"
+                                            stream-name "partitions"] nil))
         new-state        (condp contains? replication-method
                            #{"FULL_TABLE"}
                            (if resuming?
@@ -134,7 +171,7 @@
                                        ["bookmarks" stream-name "version"]
                                        (now)))
 
-                           #{"INCREMENTAL" "LOG_BASED"}
+                           #{"INCREMENTAL" "LOG_BASED" "ROWVERSION" "CDC" "TEMPORAL"}
                            (if version-bookmark
                              state
                              (assoc-in state
@@ -146,7 +183,7 @@
                                                                      replication-method))))]
     ;; Write an activate_version message when we havent and its full table
     (when (and (nil? version-bookmark)
-               (contains? #{"FULL_TABLE" "LOG_BASED"} replication-method))
+               (contains? #{"FULL_TABLE" "LOG_BASED" "CDC" "TEMPORAL"} replication-method))
       (write-activate-version! stream-name catalog new-state))
     new-state))
 
@@ -154,6 +191,19 @@
 
 (def record-buffer-size 100)
 
+(defn state-buffer
+  "Returns a (fn [state]) that writes every `record-buffer-size`th state
+  it is called with, like `write-state-buffered!` but counting on its own
+  rather than across everything the tap syncs."
+  [stream-name]
+  (let [records-since-last-state (volatile! 0)]
+    (fn [state]
+      (if (> (vswap! records-since-last-state inc) record-buffer-size)
+        (do
+          (vreset! records-since-last-state 0)
+          (write-state! stream-name state))
+        state))))
+
 (defn write-state-buffered! [stream-name state]
   (swap! records-since-last-state inc)
   (if (> @records-since-last-state record-buffer-size)
@@ -0,0 +1,89 @@
+(ns tap-mssql.singer.multiplexer
+  (:require [tap-mssql.singer.messages :as singer-messages]
+            [clojure.tools.logging :as log])
+  (:import [java.util.concurrent ArrayBlockingQueue BlockingQueue Executors ExecutorService ThreadFactory]))
+
+;;; Streams synced concurrently never print on their own. Every message
+;;; they write is put on a bounded queue and the calling thread, as the
+;;; only writer, takes them off in order. A single queue is enough to keep
+;;; each stream's messages in the order that stream wrote them.
+
+(def queue-capacity 10000)
+
+(defn merge-stream-state
+  "Folds a STATE written by one stream into the state shared by the whole
+  run. A stream only knows about its own bookmarks, everything else in its
+  state is whatever it started with, so only its own entry is taken."
+  [merged-state stream-name stream-state]
+  (if-let [stream-bookmarks (get-in stream-state ["bookmarks" stream-name])]
+    (assoc-in merged-state ["bookmarks" stream-name] stream-bookmarks)
+    merged-state))
+
+(defn- queue-sink
+  [^BlockingQueue queue]
+  (fn [message]
+    (.put queue (cond
+                  (string? message)
+                  [:line nil message]
+
+                  (= "STATE" (message "type"))
+                  [:state (message "stream") (message "value")]
+
+                  :else
+                  ;; Serializing here keeps the JSON encoding work on the
+                  ;; worker threads, the writer only prints lines.
+                  [:line nil (singer-messages/serialize message)]))))
+
+(defn- daemon-thread-factory
+  []
+  (let [thread-number (atom 0)]
+    (reify ThreadFactory
+      (newThread [_ runnable]
+        (doto (Thread. ^Runnable runnable
+                       (format "stream-sync-%d" (swap! thread-number inc)))
+          (.setDaemon true))))))
+
+(defn sync-streams!
+  "Calls `(sync-fn state stream-name)` for every stream on a pool of at
+  most `parallelism` threads and writes their messages from the calling
+  thread. Every STATE written carries the bookmarks of all streams seen so
+  far. Returns the merged state. The first error raised by a stream is
+  rethrown here, and the remaining streams are interrupted."
+  [parallelism sync-fn state stream-names]
+  {:pre [(pos? parallelism)]}
+  (log/infof "Syncing %d streams with up to %d in parallel" (count stream-names) parallelism)
+  (let [queue                 (ArrayBlockingQueue. queue-capacity)
+        sink                  (queue-sink queue)
+        ^ExecutorService pool (Executors/newFixedThreadPool parallelism (daemon-thread-factory))]
+    (try
+      (doseq [stream-name stream-names]
+        (.submit pool ^Callable (bound-fn []
+                                  (try
+                                    (binding [singer-messages/*message-sink* sink]
+                                      (sync-fn state stream-name))
+                                    (.put queue [:done stream-name nil])
+                                    (catch Throwable ex
+                                      (.put queue [:error stream-name ex]))))))
+      (loop [merged-state state
+             remaining    (count stream-names)]
+        (if (zero? remaining)
+          merged-state
+          (let [[tag stream-name value] (.take queue)]
+            (case tag
+              :line
+              (do (singer-messages/write-line! value)
+                  (recur merged-state remaining))
+
+              :state
+              (let [merged-state (merge-stream-state merged-state stream-name value)]
+                (singer-messages/write-state! stream-name merged-state)
+                (recur merged-state remaining))
+
+              :done
+              (recur merged-state (dec remaining))
+
+              :error
+              (do (log/errorf "Stream %s failed, stopping the remaining streams" stream-name)
+                  (throw value))))))
+      (finally
+        (.shutdownNow pool)))))
@@ -0,0 +1,126 @@
+(ns tap-mssql.singer.output
+  (:require [tap-mssql.config :as config]
+            [clojure.tools.logging :as log])
+  (:import [java.io BufferedOutputStream FileDescriptor FileOutputStream OutputStream OutputStreamWriter Writer]
+           [java.nio.charset StandardCharsets]
+           [java.util.concurrent Executors ScheduledExecutorService ThreadFactory TimeUnit]))
+
+;;; Messages are encoded straight into a large UTF-8 buffer over stdout's
+;;; file descriptor instead of being built as Strings and handed to
+;;; `println`, which encodes through `*out*` and may flush per line. The
+;;; buffer is flushed when it fills up, and at the latest
+;;; `output_max_flush_latency_ms` after something was written to it, so a
+;;; target reading a slow stream still sees messages promptly.
+
+(def default-buffer-size (* 1024 1024))
+
+(def default-max-flush-latency-ms 1000)
+
+(defrecord Sink [^Writer writer
+                 ^long max-flush-latency-ms
+                 last-flush-ms
+                 unflushed?
+                 ^ScheduledExecutorService flusher])
+
+(defonce ^:private installed-sink (atom nil))
+
+(defn installed?
+  []
+  (some? @installed-sink))
+
+(defn- flush-sink!
+  [{:keys [^Writer writer last-flush-ms unflushed?] :as sink}]
+  (locking sink
+    (when @unflushed?
+      (.flush writer)
+      (vreset! unflushed? false))
+    (vreset! last-flush-ms (System/currentTimeMillis))))
+
+(defn- flush-if-stale!
+  [{:keys [max-flush-latency-ms last-flush-ms unflushed?] :as sink}]
+  (locking sink
+    (when (and @unflushed?
+               (>= (- (System/currentTimeMillis) @last-flush-ms)
+                   max-flush-latency-ms))
+      (flush-sink! sink))))
+
+(defn- daemon-thread-factory
+  []
+  (reify ThreadFactory
+    (newThread [_ runnable]
+      (doto (Thread. ^Runnable runnable "output-flusher")
+        (.setDaemon true)))))
+
+(defn- make-sink
+  [^OutputStream out buffer-size max-flush-latency-ms]
+  (let [writer  (-> out
+                    (BufferedOutputStream. buffer-size)
+                    (OutputStreamWriter. StandardCharsets/UTF_8))
+        flusher (Executors/newSingleThreadScheduledExecutor (daemon-thread-factory))
+        sink    (->Sink writer
+                        max-flush-latency-ms
+                        (volatile! (System/currentTimeMillis))
+                        (volatile! false)
+                        flusher)]
+    ;; Bounds latency while the tap is waiting on the database and nothing
+    ;; is being written.
+    (.scheduleAtFixedRate flusher
+                          ^Runnable (fn [] (flush-if-stale! sink))
+                          max-flush-latency-ms
+                          max-flush-latency-ms
+                          TimeUnit/MILLISECONDS)
+    sink))
+
+(declare flush!)
+
+(defonce ^:private flush-on-shutdown
+  ;; One hook for the life of the JVM, flushing whichever sink is
+  ;; installed when it exits.
+  (delay
+    (.addShutdownHook (Runtime/getRuntime)
+                      (Thread. ^Runnable (fn [] (flush!))))))
+
+(defn install!
+  "Routes all Singer messages through a buffered sink over stdout, or
+  `out`, sized by `output_buffer_size` (bytes) and
+  `output_max_flush_latency_ms`."
+  ([config]
+   (install! config (FileOutputStream. FileDescriptor/out)))
+  ([config out]
+   (let [buffer-size          (config/get-integer config "output_buffer_size" default-buffer-size)
+         max-flush-latency-ms (config/get-integer config "output_max_flush_latency_ms" default-max-flush-latency-ms)
+         sink                 (make-sink out buffer-size max-flush-latency-ms)]
+     ;; Anything already printed must not end up behind buffered messages.
+     (flush)
+     (when-let [{:keys [^ScheduledExecutorService flusher] :as previous-sink} (first (reset-vals! installed-sink sink))]
+       (.shutdown flusher)
+       (flush-sink! previous-sink))
+     @flush-on-shutdown
+     (log/infof "Writing messages through a %d byte output buffer, flushed at least every %d ms"
+                buffer-size
+                max-flush-latency-ms)
+     sink)))
+
+(defn write-line!
+  "Calls `(write-fn writer)` to write one line into the installed sink and
+  terminates it with a newline."
+  [write-fn]
+  (let [{:keys [^Writer writer unflushed?] :as sink} @installed-sink]
+    (locking sink
+      (write-fn writer)
+      (.write writer "\n")
+      (vreset! unflushed? true)
+      (flush-if-stale! sink))))
+
+(defn flush!
+  []
+  (when-let [sink @installed-sink]
+    (flush-sink! sink)))
+
+(defn uninstall!
+  "Flushes and removes the installed sink, messages are printed to `*out*`
+  again afterwards."
+  []
+  (when-let [{:keys [^ScheduledExecutorService flusher] :as sink} (first (reset-vals! installed-sink nil))]
+    (.shutdown flusher)
+    (flush-sink! sink)))
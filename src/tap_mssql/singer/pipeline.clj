@@ -0,0 +1,212 @@
+(ns tap-mssql.singer.pipeline
+  (:require [tap-mssql.config :as config]
+            [tap-mssql.singer.messages :as singer-messages]
+            [tap-mssql.singer.serializer :as singer-serializer]
+            [clojure.tools.logging :as log])
+  (:import [java.util.concurrent ArrayBlockingQueue BlockingQueue ExecutionException Executors
+            ExecutorService Future ThreadFactory]
+           [java.util.concurrent.atomic AtomicLong]))
+
+;;; Syncing a stream is a reduce over a JDBC result set where every row is
+;;; read, serialized and written in turn, so a slow target leaves the
+;;; cursor idle and a slow database leaves the CPU idle. With
+;;; `pipeline_serializer_threads` set, the three run as stages connected by
+;;; bounded queues:
+;;;
+;;;   reader      one thread reducing over the result set, realizing each
+;;;               row and handing it to the serializers
+;;;   serializers a pool turning records into RECORD lines, in any order
+;;;   writer      the calling thread, taking the serialized lines back in
+;;;               row order, writing them and folding the state
+;;;
+;;; The reader blocks once `queue-capacity` rows are in flight, so memory
+;;; stays bounded however far the target falls behind. States are still
+;;; only written by the writer, after the records they cover.
+;;;
+;;; How long each stage was busy and blocked is added up over every query
+;;; a stream runs and logged once the stream's sync finishes, by
+;;; `log-stream-timings!`.
+
+(def queue-capacity 1000)
+
+(defn serializer-threads
+  [config]
+  (config/get-integer config "pipeline_serializer_threads" 0))
+
+(defn- daemon-thread-factory
+  [stream-name]
+  (let [thread-number (atom 0)]
+    (reify ThreadFactory
+      (newThread [_ runnable]
+        (doto (Thread. ^Runnable runnable
+                       (format "serializer-%s-%d" stream-name (swap! thread-number inc)))
+          (.setDaemon true))))))
+
+(defmacro ^:private timed
+  "Evaluates body, adding the nanoseconds it took to the volatile `nanos`."
+  [nanos & body]
+  `(let [start# (System/nanoTime)]
+     (try
+       ~@body
+       (finally
+         (vswap! ~nanos + (- (System/nanoTime) start#))))))
+
+(def ^:private end-of-rows (Object.))
+
+(defonce ^:private stream-timings (atom {}))
+
+(defn- add-stream-timings!
+  [stream-name thread-count timings]
+  (swap! stream-timings update stream-name
+         (fn [totals]
+           (assoc (merge-with + totals timings)
+                  :thread-count thread-count))))
+
+(defn- ms
+  [nanos]
+  (quot nanos 1000000))
+
+(defn- cancelled?
+  [^ExecutorService serializers]
+  (or (.isInterrupted (Thread/currentThread))
+      (.isShutdown serializers)))
+
+(defn- start-reader!
+  "Reduces over `rows` on its own thread. Every row becomes a
+  [serialized-line-future record extra] on `queue`, followed by
+  `end-of-rows` or whatever the reduce threw. Stops early once the writer
+  gives up, which shuts the serializers down, even when the JDBC driver
+  swallowed the interrupt."
+  [^BlockingQueue queue ^ExecutorService serializers serialize read-row rows timings]
+  (let [blocked (volatile! 0)]
+    (future
+      (let [start (System/nanoTime)]
+        (try
+          (when-not (= ::cancelled
+                       (reduce (fn [_ row]
+                                 (if (cancelled? serializers)
+                                   (reduced ::cancelled)
+                                   (let [[record extra]  (read-row row)
+                                         ^Future line    (.submit serializers ^Callable (fn [] (serialize record)))]
+                                     (timed blocked (.put queue [line record extra]))
+                                     nil)))
+                               nil
+                               rows))
+            (timed blocked (.put queue end-of-rows)))
+          (catch InterruptedException _
+            ;; The writer gave up and cancelled us
+            nil)
+          (catch Throwable ex
+            ;; Nobody takes this when the writer gave up, so never wait
+            ;; for room
+            (.offer queue ex))
+          (finally
+            (swap! timings assoc
+                   :reader-busy (- (System/nanoTime) start @blocked)
+                   :reader-blocked @blocked)))))))
+
+(defn- take-line!
+  [^Future line]
+  (try
+    (.get line)
+    (catch ExecutionException ex
+      (throw (.getCause ex)))))
+
+(defn- pipelined-reduce
+  [thread-count catalog stream-name read-row step state rows]
+  (let [version                   (get-in state ["bookmarks" stream-name "version"])
+        serializer                (singer-serializer/record-serializer catalog
+                                                                       stream-name
+                                                                       (singer-messages/calculate-destination-stream-name stream-name catalog)
+                                                                       singer-messages/serialize-datetimes)
+        serializer-busy           (AtomicLong.)
+        serialize                 (fn [record]
+                                    (let [start (System/nanoTime)]
+                                      (try
+                                        (singer-serializer/serialize-record serializer record version)
+                                        (finally
+                                          (.addAndGet serializer-busy (- (System/nanoTime) start))))))
+        queue                     (ArrayBlockingQueue. queue-capacity)
+        ^ExecutorService pool     (Executors/newFixedThreadPool thread-count (daemon-thread-factory stream-name))
+        timings                   (atom {})
+        writer-blocked            (volatile! 0)
+        start                     (System/nanoTime)
+        reader                    (start-reader! queue pool serialize read-row rows timings)]
+    (try
+      (loop [state     state
+             row-count 0]
+        (let [item (timed writer-blocked (.take queue))]
+          (cond
+            (identical? end-of-rows item)
+            (let [elapsed (- (System/nanoTime) start)
+                  {:keys [reader-busy reader-blocked]} (do @reader @timings)]
+              (add-stream-timings! stream-name
+                                   thread-count
+                                   {:records         row-count
+                                    :elapsed         elapsed
+                                    :reader-busy     reader-busy
+                                    :reader-blocked  reader-blocked
+                                    :serializer-busy (.get serializer-busy)
+                                    :writer-busy     (- elapsed @writer-blocked)
+                                    :writer-blocked  @writer-blocked})
+              state)
+
+            (instance? Throwable item)
+            (throw item)
+
+            :else
+            (let [[line record extra] item]
+              (singer-messages/write-serialized-record! (timed writer-blocked (take-line! line)))
+              (recur (step state record extra)
+                     (inc row-count))))))
+      (finally
+        (future-cancel reader)
+        (.shutdownNow pool)
+        ;; Makes room for a reader blocked on a full queue to notice
+        (.clear queue)))))
+
+(defn log-stream-timings!
+  "Logs how long each stage was busy and blocked over all of the stream's
+  pipelined queries since the last call, if it had any."
+  [stream-name]
+  (let [[totals _] (swap-vals! stream-timings dissoc stream-name)]
+    (when-let [{:keys [records elapsed reader-busy reader-blocked serializer-busy
+                       thread-count writer-busy writer-blocked]} (get totals stream-name)]
+      (log/infof (str "Pipeline for stream %s wrote %d records in %d ms. "
+                      "Reader busy %d ms, blocked %d ms. "
+                      "Serializers busy %d ms across %d threads. "
+                      "Writer busy %d ms, blocked %d ms.")
+                 stream-name
+                 records
+                 (ms elapsed)
+                 (ms reader-busy)
+                 (ms reader-blocked)
+                 (ms serializer-busy)
+                 thread-count
+                 (ms writer-busy)
+                 (ms writer-blocked)))))
+
+(defn reduce-records!
+  "Writes a RECORD for every row of the reducible `rows` and returns the
+  state folded over them, like
+
+    (reduce (fn [state row]
+              (let [[record extra] (read-row row)]
+                (write-record! ...)
+                (step state record extra)))
+            state
+            rows)
+
+  `read-row` must return values that stay valid after the row is gone, as
+  it runs ahead of the writer when the stream is pipelined. `extra` is
+  anything besides the record `step` needs from the row."
+  [config catalog stream-name read-row step state rows]
+  (let [thread-count (serializer-threads config)]
+    (if (pos? thread-count)
+      (pipelined-reduce thread-count catalog stream-name read-row step state rows)
+      (reduce (fn [acc row]
+                (let [[record extra] (read-row row)]
+                  (singer-messages/write-record! stream-name acc record catalog)
+                  (step acc record extra)))
+              state
+              rows))))
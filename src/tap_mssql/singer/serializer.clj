@@ -0,0 +1,200 @@
+(ns tap-mssql.singer.serializer
+  (:require [tap-mssql.singer.fields :as singer-fields]
+            [tap-mssql.singer.transform :as singer-transform]
+            [clojure.string :as string]
+            [clojure.data.json :as json])
+  (:import [java.io StringWriter Writer]))
+
+;;; Writes RECORD messages without going through `transform` and
+;;; `json/write-str` for every row. Everything that only depends on the
+;;; catalog (the JSON for the message envelope, each escaped field name,
+;;; which writer each column's SQL type needs) is worked out once per
+;;; stream, so writing a row is a walk over the columns by position with no
+;;; catalog lookups and no intermediate maps.
+
+(def ^:private ^"[C" unicode-hex-digits (.toCharArray "0123456789abcdef"))
+
+(defn- write-unicode-escape
+  [^Writer writer cp]
+  (let [cp (int cp)]
+    (.write writer "\\u")
+    (.write writer (int (aget unicode-hex-digits (bit-and (bit-shift-right cp 12) 0xF))))
+    (.write writer (int (aget unicode-hex-digits (bit-and (bit-shift-right cp 8) 0xF))))
+    (.write writer (int (aget unicode-hex-digits (bit-and (bit-shift-right cp 4) 0xF))))
+    (.write writer (int (aget unicode-hex-digits (bit-and cp 0xF))))))
+
+(defn write-json-string
+  "Writes `s` as a JSON string, escaped the same way `json/write-str`
+  escapes it by default."
+  [^Writer writer ^String s]
+  (.write writer (int \"))
+  (dotimes [i (.length s)]
+    (let [cp (int (.charAt s i))]
+      (if (< 31 cp 127)
+        (case cp
+          34 (.write writer "\\\"")
+          92 (.write writer "\\\\")
+          47 (.write writer "\\/")
+          (.write writer cp))
+        (case cp
+          8  (.write writer "\\b")
+          12 (.write writer "\\f")
+          10 (.write writer "\\n")
+          13 (.write writer "\\r")
+          9  (.write writer "\\t")
+          (write-unicode-escape writer cp)))))
+  (.write writer (int \")))
+
+(defn- json-string
+  [s]
+  (let [writer (StringWriter.)]
+    (write-json-string writer s)
+    (str writer)))
+
+(defn- write-generic-value
+  "Falls back to data.json for values whose type the catalog did not let us
+  predict."
+  [^Writer writer value-fn column-name value]
+  (let [value (value-fn column-name value)]
+    (if (string? value)
+      (write-json-string writer value)
+      (.write writer ^String (json/write-str value :value-fn value-fn)))))
+
+(defn sql-datatype->type-name
+  "`sql-datatype` is the type name JDBC reported during discovery. Identity
+  columns come back as e.g. `int identity` or `numeric() identity`."
+  [sql-datatype]
+  (when sql-datatype
+    (first (string/split sql-datatype #"[ (]"))))
+
+(defn- value-writer
+  "Returns a (fn [writer column-name value]) for the non-nil values of a
+  column of the given SQL type."
+  [sql-datatype value-fn]
+  (let [generic (fn [writer column-name value]
+                  (write-generic-value writer value-fn column-name value))]
+    (case (sql-datatype->type-name sql-datatype)
+      ("int" "bigint" "smallint" "tinyint")
+      (fn [^Writer writer column-name value]
+        (if (integer? value)
+          (.write writer (str value))
+          (generic writer column-name value)))
+
+      "bit"
+      (fn [^Writer writer column-name value]
+        (if (instance? Boolean value)
+          (.write writer ^String (if value "true" "false"))
+          (generic writer column-name value)))
+
+      ("char" "nchar" "varchar" "nvarchar" "uniqueidentifier")
+      (fn [^Writer writer column-name value]
+        (if (string? value)
+          (write-json-string writer value)
+          (generic writer column-name value)))
+
+      ("binary" "varbinary" "timestamp")
+      (let [type-name (sql-datatype->type-name sql-datatype)]
+        (fn [^Writer writer column-name value]
+          (if (bytes? value)
+            (singer-transform/write-binary! writer type-name value)
+            (write-json-string writer (singer-transform/transform-binary value)))))
+
+      "date"
+      (fn [^Writer writer column-name value]
+        (write-json-string writer (singer-transform/transform-date value)))
+
+      ("datetime" "datetime2" "smalldatetime" "datetimeoffset" "time")
+      (fn [^Writer writer column-name value]
+        (condp instance? value
+          java.sql.Timestamp
+          (singer-transform/write-timestamp! writer value)
+
+          microsoft.sql.DateTimeOffset
+          (singer-transform/write-timestamp! writer (.getTimestamp ^microsoft.sql.DateTimeOffset value))
+
+          java.sql.Time
+          (write-json-string writer (singer-transform/time->string value))
+
+          (generic writer column-name value)))
+
+      ;; decimals, floats and anything unexpected
+      generic)))
+
+(defn- column-spec
+  [value-fn [column-name column-metadata]]
+  {:column-name  column-name
+   :first-prefix (str (json-string column-name) ":")
+   :prefix       (str "," (json-string column-name) ":")
+   :write-value  (value-writer (get column-metadata "sql-datatype") value-fn)})
+
+(defn- write-field!
+  [^Writer writer ^String prefix write-value column-name value]
+  (.write writer prefix)
+  (if (nil? value)
+    (.write writer "null")
+    (write-value writer column-name value)))
+
+(defn compile-record-serializer
+  "Returns a (fn [writer record version]) that writes a RECORD message for
+  `stream-name` as one line of JSON, without the newline. Only the
+  selected fields, the ones records are read with, are probed for in every
+  record. Any other field of the record, such as `_sdc_deleted_at`, is
+  written afterwards, through its column's writer if the catalog has one
+  and through data.json with `value-fn` if not."
+  [catalog stream-name destination-stream-name value-fn]
+  (let [properties       (get-in catalog ["streams" stream-name "metadata" "properties"])
+        selected         (filter singer-fields/selected-field? properties)
+        ^objects specs   (into-array Object (map (partial column-spec value-fn) selected))
+        column-names     (set (map key selected))
+        write-generic    (fn [writer column-name value]
+                           (write-generic-value writer value-fn column-name value))
+        other-writers    (into {}
+                               (comp (remove (comp column-names key))
+                                     (map (fn [[column-name column-metadata]]
+                                            [column-name (value-writer (get column-metadata "sql-datatype") value-fn)])))
+                               properties)
+        ^String envelope (str "{\"type\":\"RECORD\",\"stream\":"
+                              (json-string destination-stream-name)
+                              ",\"record\":{")]
+    (fn [^Writer writer record version]
+      (.write writer envelope)
+      (let [written (loop [position 0
+                           written  0]
+                      (if (< position (alength specs))
+                        (let [{:keys [column-name first-prefix prefix write-value]} (aget specs position)]
+                          (if-let [entry (find record column-name)]
+                            (do (write-field! writer
+                                              (if (zero? written) first-prefix prefix)
+                                              write-value
+                                              column-name
+                                              (val entry))
+                                (recur (inc position) (inc written)))
+                            (recur (inc position) written)))
+                        written))]
+        (when (< written (count record))
+          (reduce-kv (fn [written column-name value]
+                       (if (contains? column-names column-name)
+                         written
+                         (do (write-field! writer
+                                           (str (when-not (zero? written) ",") (json-string column-name) ":")
+                                           (get other-writers column-name write-generic)
+                                           column-name
+                                           value)
+                             (inc written))))
+                     written
+                     record)))
+      (.write writer "}")
+      (when (some? version)
+        (.write writer ",\"version\":")
+        (.write writer (str version)))
+      (.write writer "}"))))
+
+(def record-serializer
+  "Serializers only need compiling once per stream and catalog."
+  (memoize compile-record-serializer))
+
+(defn serialize-record
+  [serializer record version]
+  (let [writer (StringWriter.)]
+    (serializer writer record version)
+    (str writer)))
@@ -1,21 +1,173 @@
 (ns tap-mssql.singer.transform
-  (:require [clojure.string :as string]))
+  (:require [clojure.string :as string])
+  (:import [java.io Writer]
+           [java.util Base64]))
+
+;;; "hex" or "base64", set from the `varbinary_encoding` config. base64 is
+;;; opt-in because it changes the values written for varbinary columns.
+(def varbinary-encoding (atom "hex"))
+
+(def ^:private ^"[C" hex-digits (.toCharArray "0123456789ABCDEF"))
+
+(defn binary->hex-chars
+  "Table driven encoding of a byte array as 0x followed by two upper case
+  hex digits per byte."
+  ^chars [^bytes binary]
+  (let [length (alength binary)
+        chars  (char-array (+ 2 (* 2 length)))]
+    (aset chars 0 \0)
+    (aset chars 1 \x)
+    (dotimes [i length]
+      (let [b (aget binary i)]
+        (aset chars (+ 2 (* 2 i)) (aget hex-digits (bit-and (bit-shift-right b 4) 0xF)))
+        (aset chars (+ 3 (* 2 i)) (aget hex-digits (bit-and b 0xF)))))
+    chars))
 
 (defn transform-binary [binary]
-  (when binary
+  (cond
+    (nil? binary)
+    nil
+
+    (bytes? binary)
+    (String. (binary->hex-chars binary))
+
+    ;; e.g. bookmarks read back from state as a vector of numbers
+    :else
     (apply str "0x" (map (comp string/upper-case
                                (partial format "%02x"))
                          binary))))
 
-(defn transform-date [^java.sql.Date date]
+(defn transform-varbinary [binary]
+  (if (and (bytes? binary)
+           (= "base64" @varbinary-encoding))
+    (.encodeToString (Base64/getEncoder) ^bytes binary)
+    (transform-binary binary)))
+
+(defn write-binary!
+  "Writes a byte array for a column of `sql-datatype` as a JSON string
+  straight into `writer`."
+  [^Writer writer sql-datatype ^bytes binary]
+  (.write writer (int \"))
+  (if (and (= "varbinary" sql-datatype)
+           (= "base64" @varbinary-encoding))
+    (.write writer (.encodeToString (Base64/getEncoder) binary))
+    (let [chars (binary->hex-chars binary)]
+      (.write writer chars 0 (alength chars))))
+  (.write writer (int \")))
+
+;;; Datetimes are written digit by digit from the fields of the JDBC
+;;; values into a per-thread buffer, rather than going through
+;;; LocalDateTime, OffsetDateTime, a pattern formatter and String.replace.
+;;; The deprecated getters are the same ones `Timestamp.toLocalDateTime`
+;;; reads, so dates before the Gregorian cutover come out the same too.
+
+(def ^:private datetime-buffer
+  (ThreadLocal/withInitial (reify java.util.function.Supplier
+                             (get [_] (char-array 32)))))
+
+(defn- put-digits!
+  "Writes `value` zero padded to `width` digits at `offset`, returns the
+  offset after it."
+  [^chars buffer offset width value]
+  (let [end (+ offset width)]
+    (loop [i     (dec end)
+           value (long value)]
+      (when (>= i offset)
+        (aset buffer i (char (+ 48 (rem value 10))))
+        (recur (dec i) (quot value 10))))
+    end))
+
+(defn- put-char!
+  [^chars buffer offset c]
+  (aset buffer offset (char c))
+  (inc offset))
+
+(defn- put-date!
+  [buffer offset year month day]
+  (as-> offset offset
+    (put-digits! buffer offset 4 year)
+    (put-char! buffer offset \-)
+    (put-digits! buffer offset 2 month)
+    (put-char! buffer offset \-)
+    (put-digits! buffer offset 2 day)))
+
+(defn- put-time!
+  [buffer offset hours minutes seconds]
+  (as-> offset offset
+    (put-digits! buffer offset 2 hours)
+    (put-char! buffer offset \:)
+    (put-digits! buffer offset 2 minutes)
+    (put-char! buffer offset \:)
+    (put-digits! buffer offset 2 seconds)))
+
+(defn- put-timestamp!
+  "yyyy-MM-ddTHH:mm:ss followed by microseconds, milliseconds when that is
+  all the precision there is, or nothing when both are zero, then Z. Dates
+  are saved as bookmarks and mssql does not support string datetimes being
+  more precise than the column type."
+  [buffer ^java.sql.Timestamp ts]
+  (let [micros (quot (.getNanos ts) 1000)]
+    (as-> 0 offset
+      (put-date! buffer offset (+ 1900 (.getYear ts)) (inc (.getMonth ts)) (.getDate ts))
+      (put-char! buffer offset \T)
+      (put-time! buffer offset (.getHours ts) (.getMinutes ts) (.getSeconds ts))
+      (cond
+        (zero? micros)
+        offset
+
+        (zero? (rem micros 1000))
+        (put-digits! buffer (put-char! buffer offset \.) 3 (quot micros 1000))
+
+        :else
+        (put-digits! buffer (put-char! buffer offset \.) 6 micros))
+      (put-char! buffer offset \Z))))
+
+(defn- buffer->string
+  [fill!]
+  (let [^chars buffer (.get ^ThreadLocal datetime-buffer)]
+    (String. buffer 0 (int (fill! buffer)))))
+
+(defn timestamp->string
+  "ISO-8601 in UTC for datetime, datetime2 and smalldatetime values, and
+  for the timestamp of a datetimeoffset value."
+  [^java.sql.Timestamp ts]
+  (buffer->string #(put-timestamp! % ts)))
+
+(defn write-timestamp!
+  "Writes `ts` as a JSON string straight into `writer`."
+  [^Writer writer ^java.sql.Timestamp ts]
+  (let [^chars buffer (.get ^ThreadLocal datetime-buffer)
+        length        (put-timestamp! buffer ts)]
+    (.write writer (int \"))
+    (.write writer buffer 0 (int length))
+    (.write writer (int \"))))
+
+(defn date->string
+  "Same as `java.sql.Date.toString`, yyyy-MM-dd."
+  [^java.sql.Date date]
+  (buffer->string #(put-date! % 0 (+ 1900 (.getYear date)) (inc (.getMonth date)) (.getDate date))))
+
+(defn time->string
+  "Same as `java.sql.Time.toString`, HH:mm:ss."
+  [^java.sql.Time time]
+  (buffer->string #(put-time! % 0 (.getHours time) (.getMinutes time) (.getSeconds time))))
+
+(defn transform-date [date]
   (when date
-    (str date "T00:00:00+00:00")))
+    (str (if (instance? java.sql.Date date)
+           (date->string date)
+           ;; Anything else is written the way `str` writes it
+           (str date))
+         "T00:00:00+00:00")))
 
 (defn transform-field [catalog stream-name [k v]]
   (condp contains? (get-in catalog ["streams" stream-name "metadata" "properties" k "sql-datatype"])
-    #{"timestamp" "varbinary" "binary"}
+    #{"timestamp" "binary"}
     [k (transform-binary v)]
 
+    #{"varbinary"}
+    [k (transform-varbinary v)]
+
     #{"date"}
     [k (transform-date v)]
 
@@ -0,0 +1,282 @@
+(ns tap-mssql.sync-strategies.cdc
+  (:refer-clojure :exclude [sync])
+  (:require [tap-mssql.config :as config]
+            [tap-mssql.connection-pool :as connection-pool]
+            [tap-mssql.singer.fields :as singer-fields]
+            [tap-mssql.singer.messages :as singer-messages]
+            [tap-mssql.singer.pipeline :as singer-pipeline]
+            [tap-mssql.sync-strategies.full :as full]
+            [tap-mssql.sync-strategies.logical :as logical]
+            [tap-mssql.sync-strategies.common :as common]
+            [clojure.tools.logging :as log]
+            [clojure.string :as string]
+            [clojure.java.jdbc :as jdbc]))
+
+;;; CDC replication reads the changes SQL Server Change Data Capture has
+;;; copied into a table's capture instance, through the
+;;; cdc.fn_cdc_get_all_changes_<capture_instance> (every change) or
+;;; cdc.fn_cdc_get_net_changes_<capture_instance> (the last change per
+;;; row) functions. Rows come from the change tables, so the source table
+;;; is only read by the initial full table sync.
+;;;
+;;; The bookmark, `cdc_lsn`, is the LSN every change up to and including
+;;; has been synced, as a hex string. Changes are read in windows ending
+;;; on a commit LSN and the bookmark moves to the end of each window once
+;;; it has been read.
+
+(def change-functions {"all" "fn_cdc_get_all_changes_%s"
+                       "net" "fn_cdc_get_net_changes_%s"})
+
+(defn get-change-function
+  [config]
+  (let [changes (or (get config "cdc_changes") "all")]
+    (when-not (change-functions changes)
+      (throw (IllegalArgumentException.
+              (format "cdc_changes must be one of %s, got: %s"
+                      (string/join ", " (sort (keys change-functions)))
+                      changes))))
+    (change-functions changes)))
+
+(defn- before?
+  [a b]
+  (neg? (compare a b)))
+
+(defn- lsn->hex
+  [lsn]
+  (some-> lsn common/bytes->hex))
+
+(defn cdc-enabled-database?
+  [conn-map dbname]
+  (-> (jdbc/query (connection-pool/pooled conn-map)
+                  ["SELECT is_cdc_enabled FROM sys.databases WHERE name = ?" dbname])
+      first
+      :is_cdc_enabled
+      boolean))
+
+(defn get-capture-instance
+  "The most recently created capture instance of the table, or nil."
+  [conn-map schema-name table-name]
+  (-> (jdbc/query (connection-pool/pooled conn-map)
+                  [(str "SELECT TOP 1 capture_instance "
+                        "FROM cdc.change_tables "
+                        "WHERE source_object_id = OBJECT_ID(?) "
+                        "ORDER BY create_date DESC")
+                   (format "%s.%s"
+                           (common/sanitize-names schema-name)
+                           (common/sanitize-names table-name))])
+      first
+      :capture_instance))
+
+(defn get-captured-columns
+  [conn-map capture-instance]
+  (->> (jdbc/query (connection-pool/pooled conn-map)
+                   [(str "SELECT cc.column_name "
+                         "FROM cdc.captured_columns cc "
+                         "INNER JOIN cdc.change_tables ct ON ct.object_id = cc.object_id "
+                         "WHERE ct.capture_instance = ?")
+                    capture-instance])
+       (map :column_name)
+       set))
+
+(defn get-lsn-range
+  "Structure: {:low-water-lsn \"0x...\" :max-lsn \"0x...\"}
+
+  The low water LSN is the one just below the oldest change still kept for
+  the capture instance. Changes after a bookmark below it have been cleaned
+  up."
+  [conn-map capture-instance]
+  (let [{:keys [low_water_lsn max_lsn]}
+        (first (jdbc/query (connection-pool/pooled conn-map)
+                           [(str "SELECT sys.fn_cdc_decrement_lsn(sys.fn_cdc_get_min_lsn(?)) AS low_water_lsn, "
+                                 "       sys.fn_cdc_get_max_lsn() AS max_lsn")
+                            capture-instance]))]
+    {:low-water-lsn (lsn->hex low_water_lsn)
+     :max-lsn       (lsn->hex max_lsn)}))
+
+(defn get-window-end
+  "The last commit LSN no more than `minutes` after the commit at
+  `from-lsn`, or when nothing was committed in that time, the first commit
+  after it. Returns nil when there is no later commit."
+  [conn-map from-lsn minutes]
+  (let [{:keys [before_lsn after_lsn]}
+        (first (jdbc/query (connection-pool/pooled conn-map)
+                           [(str "SELECT sys.fn_cdc_map_time_to_lsn('largest less than or equal', w.end_time) AS before_lsn, "
+                                 "       sys.fn_cdc_map_time_to_lsn('smallest greater than', w.end_time) AS after_lsn "
+                                 "FROM (SELECT DATEADD(minute, ?, sys.fn_cdc_map_lsn_to_time(?)) AS end_time) AS w")
+                            minutes
+                            (common/hex->bytes from-lsn)]))
+        before-lsn (lsn->hex before_lsn)]
+    (if (and before-lsn (before? from-lsn before-lsn))
+      before-lsn
+      (lsn->hex after_lsn))))
+
+(defn build-cdc-sql-query
+  "Reads the changes after `from-lsn` up to and including `to-lsn`."
+  [change-function capture-instance column-names from-lsn to-lsn]
+  (let [all-changes? (= change-function (change-functions "all"))]
+    [(str "SELECT [__$start_lsn], [__$operation], "
+          "sys.fn_cdc_map_lsn_to_time([__$start_lsn]) AS commit_time"
+          (when (not-empty column-names)
+            (str ", " (string/join ", " (map common/sanitize-names column-names))))
+          (format " FROM cdc.%s(sys.fn_cdc_increment_lsn(?), ?, N'all')"
+                  (common/sanitize-names (format change-function capture-instance)))
+          " ORDER BY [__$start_lsn]"
+          (when all-changes?
+            ", [__$seqval], [__$operation]"))
+     (common/hex->bytes from-lsn)
+     (common/hex->bytes to-lsn)]))
+
+(defn update-cdc-lsn
+  [stream-name lsn state]
+  (assoc-in state ["bookmarks" stream-name "cdc_lsn"] lsn))
+
+(defn cdc-context
+  "Looks up the capture instance of the stream's table, failing when CDC
+  is not set up for it."
+  [config catalog stream-name]
+  (let [dbname      (get-in catalog ["streams" stream-name "metadata" "database-name"])
+        schema-name (get-in catalog ["streams" stream-name "metadata" "schema-name"])
+        table-name  (get-in catalog ["streams" stream-name "table_name"])
+        conn-map    (assoc (config/->conn-map config) :dbname dbname)]
+    (when-not (cdc-enabled-database? conn-map dbname)
+      (throw (UnsupportedOperationException.
+              (format (str "Cannot sync stream: %s using CDC replication. "
+                           "Change Data Capture is not enabled for database: %s")
+                      stream-name
+                      dbname))))
+    (let [capture-instance (get-capture-instance conn-map schema-name table-name)]
+      (when (nil? capture-instance)
+        (throw (UnsupportedOperationException.
+                (format (str "Cannot sync stream: %s using CDC replication. "
+                             "Change Data Capture is not enabled for table: %s")
+                        stream-name
+                        table-name))))
+      {:conn-map         conn-map
+       :capture-instance capture-instance})))
+
+(defn cdc-lsn-out-of-date?
+  "True when there is no bookmark or changes after it have been cleaned up."
+  [stream-name state {:keys [low-water-lsn]}]
+  (let [cdc-lsn (get-in state ["bookmarks" stream-name "cdc_lsn"])]
+    (if (nil? cdc-lsn)
+      true
+      (let [out-of-date? (and low-water-lsn (before? cdc-lsn low-water-lsn))]
+        (when out-of-date?
+          (log/warn "The CDC changes after cdc_lsn have been cleaned up. Executing a full table sync."))
+        out-of-date?))))
+
+(defn- starting-lsn
+  "Where changes are read from after a full table sync started now."
+  [{:keys [low-water-lsn max-lsn]}]
+  (cond
+    (nil? max-lsn)                  low-water-lsn
+    (nil? low-water-lsn)            max-lsn
+    (before? max-lsn low-water-lsn) low-water-lsn
+    :else                           max-lsn))
+
+(defn- start-full-table
+  "Marks the initial full table sync of the stream as started. The LSN to
+  read changes from after it is only bookmarked as `cdc_lsn` once the full
+  table sync finishes, so an interrupted one is started again rather than
+  skipped."
+  [stream-name lsn-range state]
+  (->> (-> state
+           (assoc-in ["bookmarks" stream-name "initial_full_table_lsn"] (starting-lsn lsn-range))
+           (assoc-in ["bookmarks" stream-name "initial_full_table_complete"] false))
+       (singer-messages/write-state! stream-name)))
+
+(defn cdc-init-state
+  [stream-name {:keys [conn-map capture-instance]} state]
+  (if (nil? (get-in state ["bookmarks" stream-name "initial_full_table_complete"]))
+    (start-full-table stream-name (get-lsn-range conn-map capture-instance) state)
+    state))
+
+(defn- finish-full-table
+  [stream-name state]
+  (let [lsn (get-in state ["bookmarks" stream-name "initial_full_table_lsn"])]
+    (cond-> (-> state
+                (update-in ["bookmarks" stream-name] dissoc "initial_full_table_lsn")
+                (assoc-in ["bookmarks" stream-name "initial_full_table_complete"] true))
+      lsn
+      ((partial update-cdc-lsn stream-name lsn)))))
+
+(defn cdc-initial-full-table
+  [config catalog stream-name {:keys [conn-map capture-instance]} state]
+  (let [lsn-range      (get-lsn-range conn-map capture-instance)
+        run-full-table (fn [state]
+                         (->> state
+                              (full/sync! config catalog stream-name)
+                              (finish-full-table stream-name)
+                              (singer-messages/write-state! stream-name)))]
+    (cond
+      (= false (get-in state ["bookmarks" stream-name "initial_full_table_complete"]))
+      (run-full-table state)
+
+      ;; The changes after the bookmark are gone, start over from now
+      (cdc-lsn-out-of-date? stream-name state lsn-range)
+      (->> state
+           (start-full-table stream-name lsn-range)
+           run-full-table)
+
+      :else
+      state)))
+
+(defn sync-window!
+  [config catalog stream-name {:keys [conn-map capture-instance]} column-names state to-lsn]
+  (let [record-keys (singer-fields/get-selected-fields catalog stream-name)
+        from-lsn    (get-in state ["bookmarks" stream-name "cdc_lsn"])
+        sql-params  (build-cdc-sql-query (get-change-function config)
+                                         capture-instance
+                                         column-names
+                                         from-lsn
+                                         to-lsn)]
+    (log/infof "Executing query: %s" (pr-str sql-params))
+    (singer-pipeline/reduce-records! config
+                                     catalog
+                                     stream-name
+                                     (fn [result]
+                                       [(as-> (select-keys result record-keys) rec
+                                          ;; 1 is a delete, 2 an insert and 4 an update
+                                          (if (= 1 (get result "__$operation"))
+                                            (assoc rec "_sdc_deleted_at" (logical/get-commit-time result))
+                                            rec))])
+                                     (fn [st _ _]
+                                       (singer-messages/write-state-buffered! stream-name st))
+                                     state
+                                     (jdbc/reducible-query (connection-pool/pooled conn-map)
+                                                           sql-params
+                                                           common/result-set-opts))))
+
+(defn cdc-sync
+  [config catalog stream-name {:keys [conn-map capture-instance] :as context} state]
+  {:pre [(= true (get-in state ["bookmarks" stream-name "initial_full_table_complete"]))]}
+  (let [{:keys [max-lsn]} (get-lsn-range conn-map capture-instance)
+        window-minutes    (config/get-integer config "cdc_window_minutes" 0)
+        record-keys       (singer-fields/get-selected-fields catalog stream-name)
+        captured-columns  (get-captured-columns conn-map capture-instance)
+        column-names      (filter captured-columns record-keys)]
+    (when-let [missing (seq (remove captured-columns record-keys))]
+      (log/warnf "Selected columns %s of stream %s are not captured by CDC and will be left out of its records"
+                 (string/join ", " missing)
+                 stream-name))
+    (singer-messages/write-activate-version! stream-name catalog state)
+    (loop [state state]
+      (let [cdc-lsn (get-in state ["bookmarks" stream-name "cdc_lsn"])]
+        (if-not (and max-lsn (before? cdc-lsn max-lsn))
+          state
+          (let [window-end (or (when (pos? window-minutes)
+                                 (get-window-end conn-map cdc-lsn window-minutes))
+                               max-lsn)
+                to-lsn     (if (before? window-end max-lsn) window-end max-lsn)]
+            (recur (->> (sync-window! config catalog stream-name context column-names state to-lsn)
+                        (update-cdc-lsn stream-name to-lsn)
+                        (singer-messages/write-state! stream-name)))))))))
+
+(defn sync!
+  [config catalog stream-name state]
+  (let [context (cdc-context config catalog stream-name)]
+    (->> state
+         (cdc-init-state stream-name context)
+         (cdc-initial-full-table config catalog stream-name context)
+         (singer-messages/write-state! stream-name)
+         (cdc-sync config catalog stream-name context))))
@@ -15,3 +15,17 @@
   [table-name]
   (format "[%s]" (-> table-name
                      (string/replace "]" "]]"))))
+
+;; Binary positions like rowversions and CDC LSNs are bookmarked as hex
+;; strings. Values of the same type have the same length, so they also
+;; compare correctly as strings.
+(defn bytes->hex
+  [^bytes bs]
+  (apply str "0x" (map #(format "%02X" (bit-and % 0xff)) bs)))
+
+(defn hex->bytes
+  ^bytes [hex]
+  (->> (subs hex 2)
+       (partition 2)
+       (map #(unchecked-byte (Integer/parseInt (apply str %) 16)))
+       byte-array))
@@ -1,14 +1,18 @@
 (ns tap-mssql.sync-strategies.full
   (:refer-clojure :exclude [sync])
   (:require [tap-mssql.config :as config]
+            [tap-mssql.connection-pool :as connection-pool]
+            [tap-mssql.catalog :as catalog]
             [tap-mssql.utils :refer [try-read-only]]
             [tap-mssql.singer.fields :as singer-fields]
             [tap-mssql.singer.bookmarks :as singer-bookmarks]
             [tap-mssql.singer.messages :as singer-messages]
+            [tap-mssql.singer.pipeline :as singer-pipeline]
             [tap-mssql.sync-strategies.common :as common]
             [clojure.tools.logging :as log]
             [clojure.string :as string]
-            [clojure.java.jdbc :as jdbc]))
+            [clojure.java.jdbc :as jdbc])
+  (:import [java.util.concurrent ArrayBlockingQueue BlockingQueue]))
 
 (defn get-max-pk-values [config catalog stream-name state]
   (let [dbname        (get-in catalog ["streams" stream-name "metadata" "database-name"])
@@ -23,7 +27,7 @@
         (log/infof "Executing query: %s" (pr-str sql-query))
         (->> (try-read-only [conn-map (assoc (config/->conn-map config)
                                               :dbname dbname)]
-               (jdbc/query conn-map
+               (jdbc/query (connection-pool/pooled conn-map)
                            sql-query
                            {:keywordize? false :identifiers identity}))
              first
@@ -71,76 +75,282 @@
    {}
    (get-in state ["bookmarks" stream-name "last_pk_fetched"])))
 
-(defn build-sync-query [stream-name schema-name table-name record-keys state]
-  {:pre [(not (empty? record-keys))
-         (valid-full-table-state? state stream-name)]}
-  ;; TODO: Fully qualify and quote all database structures, maybe just schema
-  (let [last-pk-fetched           (get-last-pk-fetched stream-name state)
-        bookmark-query-text       (generate-bookmark-clause last-pk-fetched)
-        max-pk-values             (get-in state ["bookmarks" stream-name "max_pk_values"])
-        limiting-keys             (map common/sanitize-names (keys max-pk-values))
-        limiting-keys-with-values (->> max-pk-values
-                                       remove-nil-values
-                                       keys
-                                       (map common/sanitize-names))
-        limiting-query-text       (map #(format "%s <= ?" %)
-                                       limiting-keys-with-values)
-        add-where-clause?         (or (not (empty?  bookmark-query-text))
-                                      (not (empty? limiting-query-text)))
-        where-clause              (when add-where-clause?
-                                    (str " WHERE "
-                                         (when-not (string/blank? bookmark-query-text)
-                                           (str "(" bookmark-query-text ") AND "))
-                                         (string/join " AND " limiting-query-text)))
-        order-by                  (when (not (empty? limiting-keys))
-                                    (str " ORDER BY " (string/join ", "
-                                                                   (map #(format "%s" %)
-                                                                        limiting-keys))))
-        sql-params                [(str (format "SELECT %s FROM %s.%s"
-                                                (string/join ", " (map common/sanitize-names record-keys))
-                                                (common/sanitize-names schema-name)
-                                                (common/sanitize-names table-name))
-                                        where-clause
-                                        order-by)]]
-    (if add-where-clause?
-      (concat sql-params
-              (flatten (build-sub-lists (vals last-pk-fetched)))
-              (vals max-pk-values))
-      sql-params)))
+(defn build-sync-query
+  ([stream-name schema-name table-name record-keys state]
+   (build-sync-query stream-name schema-name table-name record-keys state nil))
+  ([stream-name schema-name table-name record-keys state chunk-size]
+   {:pre [(not (empty? record-keys))
+          (valid-full-table-state? state stream-name)]}
+   ;; TODO: Fully qualify and quote all database structures, maybe just schema
+   (let [last-pk-fetched           (get-last-pk-fetched stream-name state)
+         bookmark-query-text       (generate-bookmark-clause last-pk-fetched)
+         max-pk-values             (get-in state ["bookmarks" stream-name "max_pk_values"])
+         limiting-keys             (map common/sanitize-names (keys max-pk-values))
+         limiting-keys-with-values (->> max-pk-values
+                                        remove-nil-values
+                                        keys
+                                        (map common/sanitize-names))
+         limiting-query-text       (map #(format "%s <= ?" %)
+                                        limiting-keys-with-values)
+         add-where-clause?         (or (not (empty?  bookmark-query-text))
+                                       (not (empty? limiting-query-text)))
+         where-clause              (when add-where-clause?
+                                     (str " WHERE "
+                                          (when-not (string/blank? bookmark-query-text)
+                                            (str "(" bookmark-query-text ") AND "))
+                                          (string/join " AND " limiting-query-text)))
+         order-by                  (when (not (empty? limiting-keys))
+                                     (str " ORDER BY " (string/join ", "
+                                                                    (map #(format "%s" %)
+                                                                         limiting-keys))))
+         top-clause                (when chunk-size
+                                     (format "TOP (%d) " chunk-size))
+         sql-params                [(str (format "SELECT %s%s FROM %s.%s"
+                                                 (or top-clause "")
+                                                 (string/join ", " (map common/sanitize-names record-keys))
+                                                 (common/sanitize-names schema-name)
+                                                 (common/sanitize-names table-name))
+                                         where-clause
+                                         order-by)]]
+     (if add-where-clause?
+       (concat sql-params
+               (flatten (build-sub-lists (vals last-pk-fetched)))
+               (vals max-pk-values))
+       sql-params))))
 
-(defn sync-and-write-messages!
-  "Syncs all records, states, returns the latest state. Ensures that the
-  bookmark we have for this stream matches our understanding of the fields
-  defined in the catalog that are bookmark-able."
-  [config catalog stream-name state]
+(defn- sync-query-and-write-messages!
+  "Writes a record for every row returned by `sql-params`. Returns the
+  latest state and the number of rows read."
+  [config catalog stream-name state write-state-buffered sql-params]
   (let [dbname        (get-in catalog ["streams" stream-name "metadata" "database-name"])
         record-keys   (singer-fields/get-selected-fields catalog stream-name)
+        bookmark-keys (singer-bookmarks/get-full-bookmark-keys catalog stream-name)
+        row-count     (volatile! 0)]
+    (log/infof "Executing query: %s" (pr-str sql-params))
+    [(try-read-only [conn-map (assoc (config/->conn-map config)
+                                     :dbname dbname)]
+                    (vreset! row-count 0)
+                    (singer-pipeline/reduce-records! config
+                                                     catalog
+                                                     stream-name
+                                                     (fn [result]
+                                                       [(select-keys result record-keys)])
+                                                     (fn [acc record _]
+                                                       (vswap! row-count inc)
+                                                       (->> (singer-bookmarks/update-last-pk-fetched stream-name bookmark-keys acc record)
+                                                            write-state-buffered))
+                                                     state
+                                                     (jdbc/reducible-query (connection-pool/pooled conn-map)
+                                                                           sql-params
+                                                                           common/result-set-opts)))
+     @row-count]))
+
+(defn- sync-range!
+  "Syncs the rows after the bookmarked last pk fetched up to the max pk
+  values and returns the latest state.
+
+  With `full_table_chunk_size` set, the range is read as a series of
+  `SELECT TOP (n)` queries, each one starting after the last pk fetched by
+  the one before and ending in a STATE. No single query has to hold its
+  locks or row versions for the whole table."
+  [config catalog stream-name state write-state-buffered]
+  (let [record-keys   (singer-fields/get-selected-fields catalog stream-name)
         bookmark-keys (singer-bookmarks/get-full-bookmark-keys catalog stream-name)
         table-name    (get-in catalog ["streams" stream-name "table_name"])
         schema-name   (get-in catalog ["streams" stream-name "metadata" "schema-name"])
-        sql-params    (build-sync-query stream-name schema-name table-name record-keys state)]
-    (log/infof "Executing query: %s" (pr-str sql-params))
+        chunk-size    (config/get-integer config "full_table_chunk_size" nil)]
+    (if (and chunk-size (seq bookmark-keys))
+      (loop [state state]
+        (let [[state row-count] (->> (build-sync-query stream-name schema-name table-name record-keys state chunk-size)
+                                     (sync-query-and-write-messages! config catalog stream-name state write-state-buffered))]
+          (if (< row-count chunk-size)
+            state
+            (recur (singer-messages/write-state! stream-name state)))))
+      (->> (build-sync-query stream-name schema-name table-name record-keys state)
+           (sync-query-and-write-messages! config catalog stream-name state write-state-buffered)
+           first))))
+
+(defn sync-and-write-messages!
+  "Syncs all records, states, returns the latest state. Ensures that the
+  bookmark we have for this stream matches our understanding of the fields
+  defined in the catalog that are bookmark-able."
+  [config catalog stream-name state]
+  (-> (sync-range! config catalog stream-name state (partial singer-messages/write-state-buffered! stream-name))
+      (update-in ["bookmarks" stream-name] dissoc "last_pk_fetched" "max_pk_values" "partitions")))
+
+;;; Partitioned full table sync
+;;;
+;;; A table with a single integer key can be split into contiguous key
+;;; ranges that are read concurrently, each over its own connection. The
+;;; ranges live in the stream's bookmark as "partitions", each with its own
+;;; "last_pk_fetched", so an interrupted sync resumes every range where it
+;;; left off. Each range is synced like a table of its own, chunked and
+;;; pipelined as configured, and its messages are written by the calling
+;;; thread the way the multiplexer writes concurrent streams'.
+
+(def partitionable-sql-datatypes #{"int" "bigint" "smallint" "tinyint"})
+
+(def partition-queue-capacity 10000)
+
+(defn partitioned-sync?
+  [config catalog stream-name state]
+  (let [bookmark-keys (singer-bookmarks/get-full-bookmark-keys catalog stream-name)
+        sql-datatype  (get-in catalog ["streams" stream-name "metadata" "properties"
+                                       (first bookmark-keys) "sql-datatype"])]
+    (and (> (config/get-integer config "full_table_partitions" 1) 1)
+         (= 1 (count bookmark-keys))
+         (some? sql-datatype)
+         (contains? partitionable-sql-datatypes
+                    (catalog/type-name->type-name-lookup sql-datatype))
+         ;; A sync interrupted before partitioning was turned on resumes
+         ;; the way it started.
+         (not (contains? (get-in state ["bookmarks" stream-name]) "last_pk_fetched")))))
+
+(defn get-min-pk-value [config catalog stream-name bookmark-key]
+  (let [dbname      (get-in catalog ["streams" stream-name "metadata" "database-name"])
+        schema-name (common/sanitize-names (get-in catalog ["streams" stream-name "metadata" "schema-name"]))
+        table-name  (common/sanitize-names (get-in catalog ["streams" stream-name "table_name"]))
+        sql-query   [(format "SELECT MIN(%1$s) AS min_pk_value FROM %2$s.%3$s"
+                             (common/sanitize-names bookmark-key)
+                             schema-name
+                             table-name)]]
+    (log/infof "Executing query: %s" (pr-str sql-query))
     (-> (try-read-only [conn-map (assoc (config/->conn-map config)
                                         :dbname dbname)]
-                       (reduce (fn [acc result]
-                                 (let [record (select-keys result record-keys)]
-                                   (singer-messages/write-record! stream-name
-                                                                  state
-                                                                  record
-                                                                  catalog)
-                                   (->> (singer-bookmarks/update-last-pk-fetched stream-name bookmark-keys acc record)
-                                        (singer-messages/write-state-buffered! stream-name))))
-                               state
-                               (jdbc/reducible-query conn-map
-                                                     sql-params
-                                                     common/result-set-opts)))
-        (update-in ["bookmarks" stream-name] dissoc "last_pk_fetched" "max_pk_values"))))
+          (jdbc/query (connection-pool/pooled conn-map) sql-query))
+        first
+        :min_pk_value)))
+
+(defn split-key-range
+  "Splits the inclusive integer range [min-value, max-value] into at most
+  `partition-count` contiguous ranges of (nearly) equal width. Lower bounds
+  are exclusive and the first one is open so nothing below max is missed."
+  [min-value max-value partition-count]
+  (let [span   (inc' (-' max-value min-value))
+        n      (min partition-count span)
+        uppers (map (fn [i]
+                      ;; min - 1 + ceil(span * i / n)
+                      (long (+' (dec' min-value)
+                                (quot (+' (*' span i) (dec n)) n))))
+                    (range 1 (inc n)))]
+    (mapv (fn [lower upper]
+            {"lower" lower "upper" upper})
+          (cons nil (butlast uppers))
+          uppers)))
+
+(defn get-partitions
+  "Returns the partitions bookmarked in state, or splits the key range of
+  the table into new ones. Returns nil for an empty table."
+  [config catalog stream-name state]
+  (or (get-in state ["bookmarks" stream-name "partitions"])
+      (let [bookmark-key (first (singer-bookmarks/get-full-bookmark-keys catalog stream-name))
+            max-value    (get-in state ["bookmarks" stream-name "max_pk_values" bookmark-key])
+            min-value    (get-min-pk-value config catalog stream-name bookmark-key)]
+        (when (and (some? min-value) (some? max-value))
+          (split-key-range min-value
+                           max-value
+                           (config/get-integer config "full_table_partitions" 1))))))
+
+(defn partition->state
+  "Expresses a partition as the full table state `build-sync-query`
+  already understands: the upper bound is the max pk value and the lower
+  bound is where reading resumes from."
+  [stream-name bookmark-key {:strs [lower upper last_pk_fetched]}]
+  {"bookmarks"
+   {stream-name (cond-> {"max_pk_values" {bookmark-key upper}}
+                  (some? last_pk_fetched) (assoc "last_pk_fetched" last_pk_fetched)
+                  (and (nil? last_pk_fetched)
+                       (some? lower))     (assoc "last_pk_fetched" {bookmark-key lower}))}})
+
+(defn- partition-sink
+  "Hands the messages a partition writes to the thread writing them all,
+  tagged with the partition's index. Records are already serialized.
+  Throws once the writing thread has `stopped`, so a partition whose JDBC
+  driver swallowed the interrupt still stops."
+  [^BlockingQueue queue stopped index]
+  (fn [message]
+    (when @stopped
+      (throw (java.util.concurrent.CancellationException. "Partitioned sync stopped")))
+    (.put queue (cond
+                  (string? message)
+                  [:line index message]
+
+                  (= "STATE" (message "type"))
+                  [:state index (message "value")]
+
+                  :else
+                  [:line index (singer-messages/serialize message)]))))
+
+(defn- sync-partition!
+  "Syncs one partition like an unpartitioned table, its bookmark standing
+  in for the stream's, and writes its final state."
+  [config catalog stream-name version partition sink]
+  (let [bookmark-key (first (singer-bookmarks/get-full-bookmark-keys catalog stream-name))]
+    (binding [singer-messages/*message-sink* sink]
+      (->> (assoc-in (partition->state stream-name bookmark-key partition)
+                     ["bookmarks" stream-name "version"]
+                     version)
+           (#(sync-range! config catalog stream-name % (singer-messages/state-buffer stream-name)))
+           (singer-messages/write-state! stream-name)))))
+
+(defn sync-partitions-and-write-messages!
+  "Reads every partition of the table concurrently, returns the latest
+  state once all of them are done. Each partition is read, serialized and
+  bookmarked on its own thread, the calling thread only writes what they
+  hand it, folding the last pk each partition fetched into the stream's
+  \"partitions\" bookmark on every STATE."
+  [config catalog stream-name state partitions]
+  (log/infof "Syncing stream %s in %d partitions" stream-name (count partitions))
+  (let [version (get-in state ["bookmarks" stream-name "version"])
+        state   (->> (assoc-in state ["bookmarks" stream-name "partitions"] partitions)
+                     (singer-messages/write-state! stream-name))
+        queue   (ArrayBlockingQueue. partition-queue-capacity)
+        stopped (atom false)
+        syncs   (mapv (fn [index]
+                        (future
+                          (try
+                            (sync-partition! config catalog stream-name version (partitions index)
+                                             (partition-sink queue stopped index))
+                            (.put queue [:done index nil])
+                            (catch Throwable ex
+                              (.put queue [:error index ex])))))
+                      (range (count partitions)))]
+    (try
+      (loop [state     state
+             remaining (count partitions)]
+        (if (zero? remaining)
+          (update-in state ["bookmarks" stream-name] dissoc "partitions" "last_pk_fetched" "max_pk_values")
+          (let [[tag index value] (.take queue)]
+            (case tag
+              :line
+              (do (singer-messages/write-serialized-record! value)
+                  (recur state remaining))
+
+              :state
+              (recur (->> (get-in value ["bookmarks" stream-name "last_pk_fetched"])
+                          (assoc-in state ["bookmarks" stream-name "partitions" index "last_pk_fetched"])
+                          (singer-messages/write-state! stream-name))
+                     remaining)
+
+              :done
+              (recur state (dec remaining))
+
+              :error
+              (throw value)))))
+      (finally
+        (reset! stopped true)
+        (run! future-cancel syncs)
+        ;; Makes room for a partition blocked on a full queue to notice
+        (.clear queue)))))
 
 (defn sync!
   [config catalog stream-name state]
   {:post [(map? %)]}
-  (->> state
-       (get-max-pk-values config catalog stream-name)
-       (singer-messages/write-state! stream-name)
-       (sync-and-write-messages! config catalog stream-name)
-       (singer-messages/write-activate-version! stream-name catalog)))
+  (let [state (->> state
+                   (get-max-pk-values config catalog stream-name)
+                   (singer-messages/write-state! stream-name))]
+    (->> (if-let [partitions (and (partitioned-sync? config catalog stream-name state)
+                                  (get-partitions config catalog stream-name state))]
+           (sync-partitions-and-write-messages! config catalog stream-name state partitions)
+           (sync-and-write-messages! config catalog stream-name state))
+         (singer-messages/write-activate-version! stream-name catalog))))
@@ -1,35 +1,240 @@
 (ns tap-mssql.sync-strategies.incremental
   (:require [tap-mssql.config :as config]
+            [tap-mssql.connection-pool :as connection-pool]
             [tap-mssql.utils :refer [try-read-only]]
             [tap-mssql.singer.fields :as singer-fields]
             [tap-mssql.singer.bookmarks :as singer-bookmarks]
             [tap-mssql.singer.messages :as singer-messages]
+            [tap-mssql.singer.pipeline :as singer-pipeline]
             [tap-mssql.sync-strategies.common :as common]
             [clojure.tools.logging :as log]
             [clojure.string :as string]
             [clojure.java.jdbc :as jdbc]))
 
+(defn build-seek-clause
+  "Seeks past a bookmarked position in `column-names` order, like
+  `a > ? OR (a = ? AND b > ?)` for [a b]. Takes each value but the last
+  twice."
+  [column-names]
+  (let [[column-name & more] column-names]
+    (if (empty? more)
+      (format "%s > ?" column-name)
+      (format (if (next more)
+                "%1$s > ? OR (%1$s = ? AND (%2$s))"
+                "%1$s > ? OR (%1$s = ? AND %2$s)")
+              column-name
+              (build-seek-clause more)))))
+
+(defn- seek-params
+  [values]
+  (concat (mapcat (juxt identity identity) (butlast values))
+          [(last values)]))
+
+(defn get-replication-key-pk
+  "The bookmarked tiebreaker keys. A rowversion tiebreaker is a byte array,
+  which comes back from serialized state as a vector, like in
+  `full/get-last-pk-fetched`."
+  [stream-name state]
+  (reduce
+   (fn [acc [k v]]
+     (if (instance? clojure.lang.PersistentVector v)
+       (assoc acc k (bytes (byte-array (map byte v))))
+       (assoc acc k v)))
+   {}
+   (get-in state ["bookmarks" stream-name "replication_key_pk"])))
+
 (defn build-incremental-sync-query
-  [stream-name schema-name table-name record-keys replication-key state]
-  {:pre [(not (empty? record-keys))]} ;; Is there more incoming state that we think is worth asserting?
-  (let [replication-key-name (get-in state ["bookmarks" stream-name "replication_key_name"])
-        replication-key-value (get-in state ["bookmarks" stream-name "replication_key_value"])
-        bookmarking-clause    (format "%s >= ?" (common/sanitize-names replication-key))
-        add-where-clause?     (and (some? replication-key-value)
-                                   (= replication-key replication-key-name)) ;; if the replication-key in metadata changes, we negate our bookmark
-        where-clause          (when add-where-clause?
-                                (str " WHERE " bookmarking-clause))
-        order-by              (str " ORDER BY " (common/sanitize-names replication-key))
-        sql-params            [(str (format "SELECT %s FROM %s.%s"
-                                            (string/join ", " (map common/sanitize-names record-keys))
-                                            (common/sanitize-names schema-name)
-                                            (common/sanitize-names table-name))
-                                    where-clause
-                                    order-by)]]
-    (if add-where-clause?
-      (concat sql-params
-              [replication-key-value])
-      sql-params)))
+  "With `tiebreaker-keys`, rows are read in replication key then
+  tiebreaker key order, from just past the bookmarked replication key
+  value and keys, so the rows sharing the bookmarked value that have
+  already been read are not read again."
+  ([stream-name schema-name table-name record-keys replication-key state]
+   (build-incremental-sync-query stream-name schema-name table-name record-keys replication-key state nil))
+  ([stream-name schema-name table-name record-keys replication-key state tiebreaker-keys]
+   {:pre [(not (empty? record-keys))]} ;; Is there more incoming state that we think is worth asserting?
+   (let [replication-key-name  (get-in state ["bookmarks" stream-name "replication_key_name"])
+         replication-key-value (get-in state ["bookmarks" stream-name "replication_key_value"])
+         replication-key-pk    (get-replication-key-pk stream-name state)
+         add-where-clause?     (and (some? replication-key-value)
+                                    (= replication-key replication-key-name)) ;; if the replication-key in metadata changes, we negate our bookmark
+         ;; The tie can only be broken when the keys bookmarked are the keys
+         ;; still being read by
+         seek?                 (and add-where-clause?
+                                    (seq tiebreaker-keys)
+                                    (= (set tiebreaker-keys) (set (keys replication-key-pk))))
+         order-by-keys         (cons replication-key tiebreaker-keys)
+         bookmarking-clause    (if seek?
+                                 (build-seek-clause (map common/sanitize-names order-by-keys))
+                                 (format "%s >= ?" (common/sanitize-names replication-key)))
+         where-clause          (when add-where-clause?
+                                 (str " WHERE " bookmarking-clause))
+         order-by              (str " ORDER BY " (string/join ", " (map common/sanitize-names order-by-keys)))
+         sql-params            [(str (format "SELECT %s FROM %s.%s"
+                                             (string/join ", " (map common/sanitize-names
+                                                                    (distinct (concat record-keys tiebreaker-keys))))
+                                             (common/sanitize-names schema-name)
+                                             (common/sanitize-names table-name))
+                                     where-clause
+                                     order-by)]]
+     (cond
+       seek?
+       (concat sql-params
+               (seek-params (cons replication-key-value
+                                  (map (partial get replication-key-pk) tiebreaker-keys))))
+
+       add-where-clause?
+       (concat sql-params
+               [replication-key-value])
+
+       :else
+       sql-params))))
+
+(defn get-tiebreaker-keys
+  "The keys breaking ties between rows sharing a replication key value
+  when `incremental_pk_tiebreaker` is on: the table's or view's key
+  properties, else its rowversion column."
+  [config catalog stream-name]
+  (when (= "true" (get config "incremental_pk_tiebreaker"))
+    (let [tiebreaker-keys (seq (singer-bookmarks/get-full-bookmark-keys catalog stream-name))]
+      (when (nil? tiebreaker-keys)
+        (log/warnf "Stream %s has no key properties to break replication key ties with, rows sharing the bookmarked value will be read again"
+                   stream-name))
+      tiebreaker-keys)))
+
+(defn- sync-query-and-write-messages!
+  [config catalog stream-name conn-map replication-key tiebreaker-keys state sql-params]
+  (let [record-keys (singer-fields/get-selected-fields catalog stream-name)]
+    (log/infof "Executing query: %s" (pr-str sql-params))
+    (singer-pipeline/reduce-records! config
+                                     catalog
+                                     stream-name
+                                     (fn [result]
+                                       [(select-keys result record-keys)
+                                        (when tiebreaker-keys
+                                          (select-keys result tiebreaker-keys))])
+                                     (fn [acc record pk-values]
+                                       (->> (cond->> (singer-bookmarks/update-state stream-name replication-key record acc)
+                                              tiebreaker-keys
+                                              (singer-bookmarks/update-replication-key-pk stream-name pk-values))
+                                            (singer-messages/write-state-buffered! stream-name)))
+                                     state
+                                     (jdbc/reducible-query (connection-pool/pooled conn-map)
+                                                           sql-params
+                                                           common/result-set-opts))))
+
+;;; With `incremental_backfill_window` set, a stream without a bookmark is
+;;; backfilled a window of replication key values at a time, with a range
+;;; query per window, rather than with one query sorting the whole table.
+;;; Windows span that many values of numeric keys and that many days of
+;;; date and time keys. The window ends are computed by the server from
+;;; the first value of each window, so they keep the key's type and
+;;; windows never start in a gap. The backfill reads up to the greatest
+;;; key value when it started, and bookmarks the start of the next window
+;;; as `backfill_frontier` once a window has been read, so an interrupted
+;;; backfill resumes from there. The rows written after it started are
+;;; read by the usual incremental query once it is done.
+
+(def numeric-datatypes #{"tinyint" "smallint" "int" "bigint" "decimal" "numeric"
+                         "float" "real" "money" "smallmoney"})
+
+(def datetime-datatypes #{"date" "datetime" "datetime2" "smalldatetime" "datetimeoffset"})
+
+(defn build-window-end-expression
+  "How the end of a window is computed from its first value, or nil when
+  the replication key's type can't be windowed."
+  [sql-datatype replication-key]
+  (let [datatype (string/replace (str sql-datatype) #"(\(\))? identity$" "")
+        column   (format "MIN(%s)" (common/sanitize-names replication-key))]
+    (cond
+      (numeric-datatypes datatype)  (format "%s + ?" column)
+      (datetime-datatypes datatype) (format "DATEADD(day, ?, %s)" column)
+      :else                         nil)))
+
+(defn build-backfill-window-query
+  [schema-name table-name replication-key window-end-expression frontier max-value window]
+  (let [rk (common/sanitize-names replication-key)]
+    (into [(str (format "SELECT MIN(%s) AS window_start, %s AS window_end FROM %s.%s WHERE %s <= ?"
+                        rk
+                        window-end-expression
+                        (common/sanitize-names schema-name)
+                        (common/sanitize-names table-name)
+                        rk)
+                (when (some? frontier)
+                  (format " AND %s >= ?" rk)))
+           window max-value]
+          (when (some? frontier) [frontier]))))
+
+(defn build-backfill-sync-query
+  [schema-name table-name record-keys replication-key tiebreaker-keys window-start window-end max-value]
+  {:pre [(not (empty? record-keys))]}
+  (let [rk (common/sanitize-names replication-key)]
+    [(format "SELECT %s FROM %s.%s WHERE %s >= ? AND %s < ? AND %s <= ? ORDER BY %s"
+             (string/join ", " (map common/sanitize-names (distinct (concat record-keys tiebreaker-keys))))
+             (common/sanitize-names schema-name)
+             (common/sanitize-names table-name)
+             rk
+             rk
+             rk
+             (string/join ", " (map common/sanitize-names (cons replication-key tiebreaker-keys))))
+     window-start
+     window-end
+     max-value]))
+
+(defn get-max-replication-key-value
+  [conn-map schema-name table-name replication-key]
+  (-> (jdbc/query (connection-pool/pooled conn-map)
+                  [(format "SELECT MAX(%s) AS max_value FROM %s.%s"
+                           (common/sanitize-names replication-key)
+                           (common/sanitize-names schema-name)
+                           (common/sanitize-names table-name))])
+      first
+      :max_value))
+
+(defn backfill?
+  "True when the stream has no bookmark for its replication key, or an
+  unfinished backfill."
+  [stream-name replication-key state]
+  (let [bookmark (get-in state ["bookmarks" stream-name])]
+    (or (not= replication-key (get bookmark "replication_key_name"))
+        (nil? (get bookmark "replication_key_value"))
+        (contains? bookmark "backfill_max"))))
+
+(defn backfill!
+  "Reads the windows of the backfill left and returns the state with the
+  backfill bookmarks removed."
+  [config catalog stream-name conn-map tiebreaker-keys window-end-expression state]
+  (let [record-keys     (singer-fields/get-selected-fields catalog stream-name)
+        table-name      (get-in catalog ["streams" stream-name "table_name"])
+        schema-name     (get-in catalog ["streams" stream-name "metadata" "schema-name"])
+        replication-key (get-in catalog ["streams" stream-name "metadata" "replication-key"])
+        window          (config/get-integer config "incremental_backfill_window" 0)
+        state           (if (and (= replication-key (get-in state ["bookmarks" stream-name "replication_key_name"]))
+                                 (contains? (get-in state ["bookmarks" stream-name]) "backfill_max"))
+                          state
+                          (->> (-> state
+                                   (update-in ["bookmarks" stream-name] dissoc
+                                              "replication_key_value" "replication_key_pk" "backfill_frontier")
+                                   (assoc-in ["bookmarks" stream-name "replication_key_name"] replication-key)
+                                   (assoc-in ["bookmarks" stream-name "backfill_max"]
+                                             (get-max-replication-key-value conn-map schema-name table-name replication-key)))
+                               (singer-messages/write-state! stream-name)))
+        max-value       (get-in state ["bookmarks" stream-name "backfill_max"])]
+    (loop [state state]
+      (let [frontier (get-in state ["bookmarks" stream-name "backfill_frontier"])
+            {:keys [window_start window_end]}
+            (when (some? max-value)
+              (let [sql-params (build-backfill-window-query schema-name table-name replication-key
+                                                            window-end-expression frontier max-value window)]
+                (log/infof "Executing query: %s" (pr-str sql-params))
+                (first (jdbc/query (connection-pool/pooled conn-map) sql-params))))]
+        (if (nil? window_start)
+          (update-in state ["bookmarks" stream-name] dissoc "backfill_frontier" "backfill_max")
+          (recur (->> (build-backfill-sync-query schema-name table-name record-keys replication-key tiebreaker-keys
+                                                 window_start window_end max-value)
+                      (sync-query-and-write-messages! config catalog stream-name conn-map
+                                                      replication-key tiebreaker-keys state)
+                      (#(assoc-in % ["bookmarks" stream-name "backfill_frontier"] window_end))
+                      (singer-messages/write-state! stream-name))))))))
 
 (defn sync-and-write-messages!
   "Syncs all records, states, returns the latest state. Ensures that the
@@ -41,24 +246,34 @@
         table-name      (get-in catalog ["streams" stream-name "table_name"])
         schema-name     (get-in catalog ["streams" stream-name "metadata" "schema-name"])
         replication-key (get-in catalog ["streams" stream-name "metadata" "replication-key"])
-        sql-params      (build-incremental-sync-query stream-name
-                                                      schema-name
-                                                      table-name
-                                                      record-keys
-                                                      replication-key
-                                                      state)]
-    (log/infof "Executing query: %s" (pr-str sql-params))
+        tiebreaker-keys (get-tiebreaker-keys config catalog stream-name)
+        window-end      (when (and (pos? (config/get-integer config "incremental_backfill_window" 0))
+                                   (backfill? stream-name replication-key state))
+                          (or (build-window-end-expression
+                               (get-in catalog ["streams" stream-name "metadata" "properties" replication-key "sql-datatype"])
+                               replication-key)
+                              (log/warnf "Replication key %s of stream %s is neither numeric nor a date or time, it will not be backfilled in windows"
+                                         replication-key
+                                         stream-name)))]
     (try-read-only [conn-map (assoc (config/->conn-map config true)
                                     :dbname dbname)]
-                   (reduce (fn [acc result]
-                             (let [record (select-keys result record-keys)]
-                               (singer-messages/write-record! stream-name acc record catalog)
-                               (->> (singer-bookmarks/update-state stream-name replication-key record acc)
-                                    (singer-messages/write-state-buffered! stream-name))))
-                           state
-                           (jdbc/reducible-query conn-map
-                                                 sql-params
-                                                 common/result-set-opts)))))
+                   (let [state (if window-end
+                                 (backfill! config catalog stream-name conn-map tiebreaker-keys window-end state)
+                                 state)]
+                     (sync-query-and-write-messages! config
+                                                     catalog
+                                                     stream-name
+                                                     conn-map
+                                                     replication-key
+                                                     tiebreaker-keys
+                                                     state
+                                                     (build-incremental-sync-query stream-name
+                                                                                   schema-name
+                                                                                   table-name
+                                                                                   record-keys
+                                                                                   replication-key
+                                                                                   state
+                                                                                   tiebreaker-keys))))))
 
 (defn sync!
   [config catalog stream-name state]
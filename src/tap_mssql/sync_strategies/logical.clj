@@ -1,58 +1,115 @@
 (ns tap-mssql.sync-strategies.logical
   (:refer-clojure :exclude [sync])
   (:require [tap-mssql.config :as config]
+            [tap-mssql.connection-pool :as connection-pool]
+            [tap-mssql.filters :as filters]
             [tap-mssql.singer.fields :as singer-fields]
             [tap-mssql.singer.bookmarks :as singer-bookmarks]
             [tap-mssql.singer.messages :as singer-messages]
+            [tap-mssql.singer.pipeline :as singer-pipeline]
             [tap-mssql.sync-strategies.full :as full]
             [tap-mssql.sync-strategies.common :as common]
             [clojure.tools.logging :as log]
             [clojure.string :as string]
             [clojure.java.jdbc :as jdbc]))
 
+(defn get-change-tracking-snapshot*
+  "Reads everything log-based sync needs to know about change tracking in a
+  database in one round trip.
+
+  Structure: {:current-version    n
+              :tables             {\"schema_name\" #{\"table1\" \"table2\" ...} ...}
+              :min-valid-versions {[\"schema_name\" \"table1\"] n ...}}"
+  [config dbname]
+  (let [filters          (filters/->filters config)
+        [clauses params] (filters/sql-clauses filters
+                                              "OBJECT_SCHEMA_NAME(object_id)"
+                                              "OBJECT_NAME(object_id)")
+        where-clause     (when (seq clauses)
+                           (str " WHERE " (string/join " AND " clauses)))
+        ;; The version is selected on its own and the tracked tables joined
+        ;; to it so that it comes back even when no table is tracked
+        sql-params       (into [(str "SELECT v.current_version, "
+                                     "       t.schema_name, "
+                                     "       t.table_name, "
+                                     "       t.min_valid_version "
+                                     "FROM (SELECT CHANGE_TRACKING_CURRENT_VERSION() AS current_version) AS v "
+                                     "LEFT JOIN (SELECT OBJECT_SCHEMA_NAME(object_id) AS schema_name, "
+                                     "                  OBJECT_NAME(object_id) AS table_name, "
+                                     "                  CHANGE_TRACKING_MIN_VALID_VERSION(object_id) AS min_valid_version "
+                                     "           FROM sys.change_tracking_tables"
+                                     where-clause
+                                     ") AS t ON 1 = 1")]
+                               params)
+        _                (log/infof "Executing query: %s" (pr-str sql-params))
+        rows             (->> (jdbc/query (connection-pool/pooled (assoc (config/->conn-map config)
+                                                                         :dbname dbname))
+                                          sql-params)
+                              (filter #(or (nil? (:table_name %))
+                                           (filters/keep-object? filters (:schema_name %) (:table_name %)))))
+        tracked-rows     (filter :table_name rows)]
+    {:current-version    (:current_version (first rows))
+     :tables             (reduce (fn [acc val] (update acc (:schema_name val) (fnil conj #{}) (:table_name val)))
+                                 {}
+                                 tracked-rows)
+     :min-valid-versions (into {}
+                               (map (juxt (juxt :schema_name :table_name) :min_valid_version))
+                               tracked-rows)}))
+
+;;; Snapshots taken at the start of a sync, keyed by database name. Streams
+;;; in a database without one read a fresh snapshot each time they ask.
+(def change-tracking-snapshots (atom {}))
+
+(defn prefetch-change-tracking-snapshots!
+  "Takes one snapshot for each database with a selected LOG_BASED stream."
+  [config catalog]
+  (let [dbnames (->> (vals (catalog "streams"))
+                     (filter #(and (get-in % ["metadata" "selected"])
+                                   (= "LOG_BASED" (get-in % ["metadata" "replication-method"]))))
+                     (map #(get-in % ["metadata" "database-name"]))
+                     distinct)]
+    (reset! change-tracking-snapshots
+            (into {}
+                  (map (juxt identity (partial get-change-tracking-snapshot* config)))
+                  dbnames))))
+
+(defn get-change-tracking-snapshot
+  [config dbname]
+  (or (get @change-tracking-snapshots dbname)
+      (get-change-tracking-snapshot* config dbname)))
+
 (defn get-change-tracking-tables*
-  "Structure: {\"schema_name\" [\"table1\" \"table2\" ...] ...}"
+  "Structure: {\"schema_name\" #{\"table1\" \"table2\" ...} ...}"
   [config dbname]
-  (reduce (fn [acc val] (assoc acc
-                               (:schema_name val)
-                               (-> (get acc (:schema_name val))
-                                   (concat [(:table_name val)])
-                                   set)))
-          {}
-          (jdbc/query (assoc (config/->conn-map config)
-                             :dbname dbname)
-                      [(str "SELECT OBJECT_SCHEMA_NAME(object_id) AS schema_name, "
-                            "       OBJECT_NAME(object_id) AS table_name "
-                            "FROM sys.change_tracking_tables")])))
+  (:tables (get-change-tracking-snapshot config dbname)))
 
 (def get-change-tracking-tables (memoize get-change-tracking-tables*))
 
 (defn get-change-tracking-databases* [conf]
-  (set (map #(:db_name %)
-            (jdbc/query (config/->conn-map conf)
-                        [(str "SELECT DB.name AS db_name "
-                              "FROM sys.change_tracking_databases CTDB "
-                              "INNER JOIN sys.databases DB "
-                              "ON CTDB.database_id=DB.database_id")]))))
+  (set (filter (partial filters/keep-database? (filters/->filters conf))
+               (map #(:db_name %)
+                    (jdbc/query (connection-pool/pooled (config/->conn-map conf))
+                                [(str "SELECT DB.name AS db_name "
+                                      "FROM sys.change_tracking_databases CTDB "
+                                      "INNER JOIN sys.databases DB "
+                                      "ON CTDB.database_id=DB.database_id")])))))
 
 (def get-change-tracking-databases (memoize get-change-tracking-databases*))
 
-(defn get-object-id-by-table-name [config dbname schema-name table-name]
-  (let [sql-query ["SELECT OBJECT_ID(?) AS object_id"
-                   (-> (partial format "%s.%s.%s")
-                       (apply (map common/sanitize-names [dbname schema-name table-name])))]]
-    (log/infof "Executing query: %s" sql-query)
-    (->> (jdbc/query (assoc (config/->conn-map config) :dbname dbname) sql-query)
-         first
-         :object_id)))
-
 (defn get-min-valid-version [config dbname schema-name table-name]
-  (let [object-id (get-object-id-by-table-name config dbname schema-name table-name)
-        sql-query (format "SELECT CHANGE_TRACKING_MIN_VALID_VERSION(%d) as min_valid_version" object-id)]
-    (log/infof "Executing query: %s" sql-query)
-    (-> (jdbc/query (assoc (config/->conn-map config) :dbname dbname) [sql-query])
-        first
-        :min_valid_version)))
+  (get-in (get-change-tracking-snapshot config dbname)
+          [:min-valid-versions [schema-name table-name]]))
+
+(defn get-excluding-filter
+  "The name of the filter setting that leaves the stream's table out of the
+  change tracking lookups, or nil."
+  [config dbname schema-name table-name]
+  (let [filters (filters/->filters config)]
+    (cond
+      (not (filters/keep-database? filters dbname))                   "include_databases"
+      (not (filters/keep-schema? filters schema-name))                "include_schemas"
+      (not (filters/keep-object? filters schema-name table-name))     "exclude_tables"
+      :else                                                           nil)))
 
 (defn assert-log-based-setup-complete [config catalog stream-name state]
   (let [table-name        (get-in catalog ["streams" stream-name "table_name"])
@@ -60,14 +117,21 @@
         dbname            (get-in catalog ["streams" stream-name "metadata" "database-name"])
         min-valid-version (get-min-valid-version config dbname schema-name table-name)
         primary-keys (get-in catalog ["streams" stream-name "metadata" "table-key-properties"])]
+    (when-let [setting-name (get-excluding-filter config dbname schema-name table-name)]
+      (throw (UnsupportedOperationException.
+              (format (str "Cannot sync stream: %s using log-based replication. "
+                           "Table: %s is excluded by %s")
+                      stream-name
+                      table-name
+                      setting-name))))
     (when (not (contains? (get-change-tracking-databases config) dbname))
       (throw (UnsupportedOperationException.
               (format (str "Cannot sync stream: %s using log-based replication. "
                            "Change Tracking is not enabled for database: %s")
                       stream-name
                       dbname))))
-    (when (not (contains? (-> (get-change-tracking-tables config dbname)
-                              (get schema-name)) table-name))
+    (when (not (contains? (-> (get-change-tracking-snapshot config dbname)
+                              (get-in [:tables schema-name])) table-name))
       (throw (UnsupportedOperationException.
               (format (str "Cannot sync stream: %s using log-based replication. "
                            "Change Tracking is not enabled for table: %s")
@@ -87,11 +151,7 @@
 
 (defn get-current-log-version [config catalog stream-name]
   (let [dbname (get-in catalog ["streams" stream-name "metadata" "database-name"])]
-    (-> (jdbc/query (assoc (config/->conn-map config)
-                           :dbname dbname)
-                    ["SELECT current_version = CHANGE_TRACKING_CURRENT_VERSION()"])
-        first
-        :current_version)))
+    (:current-version (get-change-tracking-snapshot config dbname))))
 
 (defn get-last-pk-fetched [stream-name state]
   (reduce
@@ -150,59 +210,103 @@
           ((partial singer-messages/write-state! stream-name)))
       state))
 
-(defn build-log-based-sql-query [catalog stream-name state]
-  (let [schema-name           (->  (get-in catalog ["streams" stream-name "metadata" "schema-name"])
+(defn column-mask-condition
+  "A condition keeping every change but the updates that changed none of
+  `column-names`. SYS_CHANGE_COLUMNS is NULL when the table does not track
+  columns updated, or when all of them were."
+  [schema-name table-name column-names]
+  (let [sql-literal (fn [s] (format "N'%s'" (string/replace s "'" "''")))
+        object-id   (format "OBJECT_ID(%s)" (sql-literal (str schema-name "." table-name)))]
+    (str "(c.SYS_CHANGE_OPERATION <> 'U' OR c.SYS_CHANGE_COLUMNS IS NULL"
+         (string/join (map #(format " OR CHANGE_TRACKING_IS_COLUMN_IN_MASK(COLUMNPROPERTY(%s, %s, 'ColumnId'), c.SYS_CHANGE_COLUMNS) = 1"
+                                    object-id
+                                    (sql-literal %))
+                           column-names))
+         ")")))
+
+(defn build-log-based-sql-query
+  "Builds the query for changes from the bookmarked version on.
+
+  Options:
+    :max-version       only read changes up to and including this version
+    :join-commit-time? join sys.dm_tran_commit_table for commit_time (default true)
+    :column-mask?      leave out updates that changed no selected column"
+  ([catalog stream-name state]
+   (build-log-based-sql-query catalog stream-name state {}))
+  ([catalog stream-name state {:keys [max-version join-commit-time? column-mask?]
+                               :or   {join-commit-time? true}}]
+   (let [schema-name           (->  (get-in catalog ["streams" stream-name "metadata" "schema-name"])
+                                    (common/sanitize-names))
+         table-name            (-> (get-in catalog ["streams" stream-name "table_name"])
                                    (common/sanitize-names))
-        table-name            (-> (get-in catalog ["streams" stream-name "table_name"])
-                                  (common/sanitize-names))
-        primary-keys          (map common/sanitize-names (set (get-in catalog ["streams"
-                                                                               stream-name
-                                                                               "metadata"
-                                                                               "table-key-properties"])))
-        primary-key-bookmarks (get-last-pk-fetched stream-name state)
-        current-log-version   (get-in state ["bookmarks" stream-name "current_log_version"])
-        _                     (log/infof "Syncing log-based stream at version: %d" current-log-version)
-        record-keys           (map common/sanitize-names (clojure.set/difference (set (singer-fields/get-selected-fields catalog stream-name))
-                                                                                 primary-keys))]
-    ;; Assert state of the world
-    (assert (some? current-log-version)
-            "Invalid log-based state, need a value for `current-log-version`.")
-    (let [select-clause (str "SELECT c.SYS_CHANGE_VERSION, c.SYS_CHANGE_OPERATION, tc.commit_time"
-                             (when (not-empty primary-keys)
-                               (str ", " (string/join ", "
-                                                      (map #(format "c.%s" %)
-                                                           primary-keys))))
-                             (when (not-empty record-keys)
-                               (str ", " (string/join ", "
-                                                      (map #(format "%s.%s.%s" schema-name table-name %)
-                                                           record-keys)))))
-          from-clause (format " FROM CHANGETABLE (CHANGES %s.%s, %s) as c " schema-name table-name (if (> current-log-version 0)
-                                                                                                     (dec current-log-version)
-                                                                                                     0))
-          join-clause (format "LEFT JOIN %s.%s ON %s LEFT JOIN %s on %s"
-                              schema-name
-                              table-name
-                              (string/join " AND "(map #(format "c.%s=%s.%s.%s" % schema-name table-name %) primary-keys))
-                              "sys.dm_tran_commit_table tc"
-                              "c.SYS_CHANGE_VERSION = tc.commit_ts")
-          join-where-clause (when (not-empty primary-key-bookmarks)
-                              (str (format " WHERE c.SYS_CHANGE_VERSION = %s AND "
-                                           current-log-version)
-                                   (string/join " AND "
-                                                (map #(format "c.%s >= ?" %)
-                                                     (-> (keys primary-key-bookmarks)
-                                                         sort
-                                                         vec)))))
-          order-by-clause (str " ORDER BY c.SYS_CHANGE_VERSION"
-                               (when (not-empty primary-keys)
-                                 (str ", " (string/join ", "
-                                                        (map #(format "c.%s" %)
-                                                             (sort (vec primary-keys)))))))
-          query-string (str select-clause from-clause join-clause join-where-clause order-by-clause)]
-      (if (not-empty primary-key-bookmarks)
-        (into [query-string] (-> (sort-by key primary-key-bookmarks)
-                                 vals))
-        [query-string]))))
+         primary-keys          (map common/sanitize-names (set (get-in catalog ["streams"
+                                                                                stream-name
+                                                                                "metadata"
+                                                                                "table-key-properties"])))
+         primary-key-bookmarks (get-last-pk-fetched stream-name state)
+         current-log-version   (get-in state ["bookmarks" stream-name "current_log_version"])
+         _                     (log/infof "Syncing log-based stream at version: %d" current-log-version)
+         record-keys           (map common/sanitize-names (clojure.set/difference (set (singer-fields/get-selected-fields catalog stream-name))
+                                                                                  primary-keys))]
+     ;; Assert state of the world
+     (assert (some? current-log-version)
+             "Invalid log-based state, need a value for `current-log-version`.")
+     (let [select-clause (str "SELECT c.SYS_CHANGE_VERSION, c.SYS_CHANGE_OPERATION"
+                              (when join-commit-time?
+                                ", tc.commit_time")
+                              (when (not-empty primary-keys)
+                                (str ", " (string/join ", "
+                                                       (map #(format "c.%s" %)
+                                                            primary-keys))))
+                              (when (not-empty record-keys)
+                                (str ", " (string/join ", "
+                                                       (map #(format "%s.%s.%s" schema-name table-name %)
+                                                            record-keys))))
+                              ;; Primary keys are never null, so a null one
+                              ;; means the row is gone from the table
+                              (when (not-empty primary-keys)
+                                (format ", CASE WHEN %s.%s.%s IS NULL THEN 0 ELSE 1 END AS row_found"
+                                        schema-name
+                                        table-name
+                                        (first primary-keys))))
+           from-clause (format " FROM CHANGETABLE (CHANGES %s.%s, %s) as c " schema-name table-name (if (> current-log-version 0)
+                                                                                                      (dec current-log-version)
+                                                                                                      0))
+           join-clause (str (format "LEFT JOIN %s.%s ON %s"
+                                    schema-name
+                                    table-name
+                                    (string/join " AND "(map #(format "c.%s=%s.%s.%s" % schema-name table-name %) primary-keys)))
+                            (when join-commit-time?
+                              (format " LEFT JOIN %s on %s"
+                                      "sys.dm_tran_commit_table tc"
+                                      "c.SYS_CHANGE_VERSION = tc.commit_ts")))
+           where-conditions (cond-> []
+                              (not-empty primary-key-bookmarks)
+                              (into (cons (format "c.SYS_CHANGE_VERSION = %s" current-log-version)
+                                          (map #(format "c.%s >= ?" %)
+                                               (-> (keys primary-key-bookmarks)
+                                                   sort
+                                                   vec))))
+
+                              (some? max-version)
+                              (conj (format "c.SYS_CHANGE_VERSION <= %d" max-version))
+
+                              column-mask?
+                              (conj (column-mask-condition schema-name
+                                                           table-name
+                                                           (singer-fields/get-selected-fields catalog stream-name))))
+           join-where-clause (when (not-empty where-conditions)
+                               (str " WHERE " (string/join " AND " where-conditions)))
+           order-by-clause (str " ORDER BY c.SYS_CHANGE_VERSION"
+                                (when (not-empty primary-keys)
+                                  (str ", " (string/join ", "
+                                                         (map #(format "c.%s" %)
+                                                              (sort (vec primary-keys)))))))
+           query-string (str select-clause from-clause join-clause join-where-clause order-by-clause)]
+       (if (not-empty primary-key-bookmarks)
+         (into [query-string] (-> (sort-by key primary-key-bookmarks)
+                                  vals))
+         [query-string])))))
 
 
 (defn maybe-update-current-log-version [state stream-name db-log-version]
@@ -216,35 +320,163 @@
   (or (get result "commit_time")
       (.toString (java.time.Instant/now))))
 
+(def commit-times-per-query 1000)
+
+(defn get-commit-times
+  "Structure: {commit_ts commit_time ...} for at most commit-times-per-query
+  versions from `from-version` on."
+  [config dbname from-version]
+  (let [sql-params [(format (str "SELECT TOP (%d) commit_ts, commit_time "
+                                 "FROM sys.dm_tran_commit_table "
+                                 "WHERE commit_ts >= ? "
+                                 "ORDER BY commit_ts")
+                            commit-times-per-query)
+                    from-version]]
+    (log/infof "Executing query: %s" (pr-str sql-params))
+    (->> (jdbc/query (connection-pool/pooled (assoc (config/->conn-map config)
+                                                    :dbname dbname))
+                     sql-params)
+         (map (juxt :commit_ts :commit_time))
+         (into (sorted-map)))))
+
+(defn commit-time-lookup
+  "Returns a (fn [version]) that finds the commit time of a version. Changes
+  are read in version order, so a miss loads the commit times of the next
+  commit-times-per-query versions and only that window is kept."
+  [config dbname]
+  (let [cache (atom nil)]
+    (fn [version]
+      (let [{:keys [from to commit-times]} @cache]
+        (if (and from (<= from version to))
+          (get commit-times version)
+          (let [commit-times (get-commit-times config dbname version)]
+            (reset! cache {:from         version
+                           :to           (max version (or (some-> (rseq commit-times) first key) version))
+                           :commit-times commit-times})
+            (get commit-times version)))))))
+
+(def commit-time-modes #{"join" "lookup" "sync_start"})
+
+(defn get-commit-time-mode
+  [config]
+  (let [mode (or (get config "log_based_commit_time") "join")]
+    (when-not (commit-time-modes mode)
+      (throw (IllegalArgumentException.
+              (format "log_based_commit_time must be one of %s, got: %s"
+                      (string/join ", " (sort commit-time-modes))
+                      mode))))
+    mode))
+
+(defn deleted-at-fn
+  "Returns a (fn [result]) giving the `_sdc_deleted_at` of a deleted row.
+  `join` reads the commit time joined onto every change, `lookup` looks
+  deleted versions up in sys.dm_tran_commit_table separately and
+  `sync_start` uses the time the sync started."
+  [config dbname]
+  (case (get-commit-time-mode config)
+    "join"       (fn [result]
+                   (when-not (get result "commit-time")
+                     (log/warn "Found deleted record with no timestamp, falling back to current time."))
+                   (get-commit-time result))
+    "lookup"     (let [lookup (commit-time-lookup config dbname)]
+                   (fn [result]
+                     (get-commit-time {"commit_time" (lookup (get result "sys_change_version"))})))
+    "sync_start" (constantly (.toString (java.time.Instant/now)))))
+
+(defn row-gone?
+  "An insert or update whose row was deleted since. CHANGETABLE returns
+  one net change per key, so the delete comes with a later version, and
+  the row has nothing left to emit now."
+  [result]
+  (and (not= "D" (get result "sys_change_operation"))
+       (= 0 (get result "row_found"))))
+
+(defn sync-changes!
+  "Syncs the changes from the bookmarked version on, or up to and including
+  `max-version` when given, and returns the state. Logs the records and
+  deletes emitted and the changes skipped because their row is gone."
+  [config catalog stream-name state max-version deleted-at]
+  (let [record-keys   (singer-fields/get-selected-fields catalog stream-name)
+        bookmark-keys (singer-bookmarks/get-logical-bookmark-keys catalog stream-name)
+        dbname        (get-in catalog ["streams" stream-name "metadata" "database-name"])
+        from-version  (get-in state ["bookmarks" stream-name "current_log_version"])
+        sql-params    (build-log-based-sql-query catalog
+                                                 stream-name
+                                                 state
+                                                 {:max-version       max-version
+                                                  :join-commit-time? (= "join" (get-commit-time-mode config))
+                                                  :column-mask?      (= "true" (get config "log_based_column_mask_filter"))})
+        ;; Counted on whichever threads read and write the rows, and only
+        ;; read once the reduce is over
+        emitted       (volatile! 0)
+        deletes       (volatile! 0)
+        skipped       (volatile! 0)]
+    (log/infof "Executing query: %s" sql-params)
+    (let [state (singer-pipeline/reduce-records! config
+                                                 catalog
+                                                 stream-name
+                                                 (fn [result]
+                                                   [(as-> (select-keys result record-keys) rec
+                                                      (if (= "D" (get result "sys_change_operation"))
+                                                        (assoc rec "_sdc_deleted_at" (deleted-at result))
+                                                        rec))
+                                                    (get result "sys_change_version")])
+                                                 (fn [st record sys-change-version]
+                                                   (vswap! emitted inc)
+                                                   (when (contains? record "_sdc_deleted_at")
+                                                     (vswap! deletes inc))
+                                                   (->> (singer-bookmarks/update-last-pk-fetched stream-name bookmark-keys st record)
+                                                        (update-current-log-version stream-name sys-change-version)
+                                                        (singer-messages/write-state-buffered! stream-name)))
+                                                 state
+                                                 (eduction (remove (fn [result]
+                                                                     (when (row-gone? result)
+                                                                       (vswap! skipped inc)
+                                                                       true)))
+                                                           (jdbc/reducible-query (connection-pool/pooled (assoc (config/->conn-map config)
+                                                                                                                :dbname dbname))
+                                                                                 sql-params
+                                                                                 common/result-set-opts)))]
+      (log/infof "Stream %s versions %d to %s: emitted %d records (%d deletes), skipped %d changes whose row is gone"
+                 stream-name
+                 from-version
+                 (or max-version "latest")
+                 @emitted
+                 @deletes
+                 @skipped)
+      state)))
+
+(defn sync-changes-in-windows!
+  "Syncs the changes up to `db-log-version` in slices of at most `window`
+  versions, writing a STATE after each one so that an interrupted sync
+  resumes from the last slice finished rather than from the start."
+  [config catalog stream-name state db-log-version window deleted-at]
+  (loop [state state]
+    (let [current-log-version (get-in state ["bookmarks" stream-name "current_log_version"])
+          ;; A sync interrupted part way through a version finishes that
+          ;; version first, as the query resuming it covers no other
+          max-version         (if (not-empty (get-last-pk-fetched stream-name state))
+                                current-log-version
+                                (min db-log-version (+ current-log-version (dec window))))
+          state               (sync-changes! config catalog stream-name state max-version deleted-at)]
+      (if (< max-version db-log-version)
+        (recur (->> state
+                    (update-current-log-version stream-name (inc max-version))
+                    (singer-messages/write-state! stream-name)))
+        state))))
+
 (defn log-based-sync
   [config catalog stream-name state]
   {:pre  [(= true (get-in state ["bookmarks" stream-name "initial_full_table_complete"]))]
    :post [(map? %)]}
-  (let [record-keys    (singer-fields/get-selected-fields catalog stream-name)
-        bookmark-keys  (singer-bookmarks/get-logical-bookmark-keys catalog stream-name)
-        dbname         (get-in catalog ["streams" stream-name "metadata" "database-name"])
+  (let [dbname         (get-in catalog ["streams" stream-name "metadata" "database-name"])
         db-log-version (get-current-log-version config catalog stream-name)
-        sql-params     (build-log-based-sql-query catalog stream-name state)]
-    (log/infof "Executing query: %s" sql-params)
+        window         (config/get-integer config "log_based_version_window" 0)
+        deleted-at     (deleted-at-fn config dbname)]
     (singer-messages/write-activate-version! stream-name catalog state)
-    (-> (reduce (fn [st result]
-                  (let [record (as-> (select-keys result record-keys) rec
-                                 (if (= "D" (get result "sys_change_operation"))
-                                   (do
-                                     (when-not (get result "commit-time")
-                                       (log/warn "Found deleted record with no timestamp, falling back to current time."))
-                                     (assoc rec "_sdc_deleted_at" (get-commit-time result)))
-                                   rec))]
-                    (singer-messages/write-record! stream-name st record catalog)
-                    (->> (singer-bookmarks/update-last-pk-fetched stream-name bookmark-keys st record)
-                         (update-current-log-version stream-name
-                                                     (get result "sys_change_version"))
-                         (singer-messages/write-state-buffered! stream-name))))
-                state
-                (jdbc/reducible-query (assoc (config/->conn-map config)
-                                             :dbname dbname)
-                                      sql-params
-                                      common/result-set-opts))
+    (-> (if (pos? window)
+          (sync-changes-in-windows! config catalog stream-name state db-log-version window deleted-at)
+          (sync-changes! config catalog stream-name state nil deleted-at))
         ;; maybe-update in case no rows were synced
         (maybe-update-current-log-version stream-name db-log-version)
         ;; last_pk_fetched indicates an interruption, and should be gone
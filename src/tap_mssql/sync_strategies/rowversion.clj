@@ -0,0 +1,116 @@
+(ns tap-mssql.sync-strategies.rowversion
+  (:require [tap-mssql.config :as config]
+            [tap-mssql.connection-pool :as connection-pool]
+            [tap-mssql.utils :refer [try-read-only]]
+            [tap-mssql.singer.fields :as singer-fields]
+            [tap-mssql.singer.messages :as singer-messages]
+            [tap-mssql.singer.pipeline :as singer-pipeline]
+            [tap-mssql.sync-strategies.common :as common]
+            [clojure.tools.logging :as log]
+            [clojure.string :as string]
+            [clojure.java.jdbc :as jdbc]))
+
+;;; ROWVERSION replication reads the rows whose rowversion (timestamp)
+;;; column is greater than the bookmark. Rowversions are unique within a
+;;; database and increase with every insert and update, so reading in
+;;; rowversion order and bookmarking the last one read never reads a row
+;;; twice. Rows are only read up to just below MIN_ACTIVE_ROWVERSION(),
+;;; since transactions still open may commit lower rowversions later.
+;;;
+;;; The bookmark is kept as a hex string, like "0x00000000000007D1".
+
+(defn get-rowversion-column
+  [catalog stream-name]
+  (some (fn [[column-name column-metadata]]
+          (when (= "timestamp" (column-metadata "sql-datatype"))
+            column-name))
+        (get-in catalog ["streams" stream-name "metadata" "properties"])))
+
+(defn- after?
+  [a b]
+  (pos? (compare a b)))
+
+(defn get-max-rowversion
+  "The highest rowversion no open transaction can still commit below."
+  [conn-map]
+  (-> (jdbc/query (connection-pool/pooled conn-map)
+                  [(str "SELECT CONVERT(binary(8), "
+                        "CONVERT(bigint, MIN_ACTIVE_ROWVERSION()) - 1) AS max_rowversion")])
+      first
+      :max_rowversion))
+
+(defn build-rowversion-sync-query
+  [schema-name table-name record-keys rowversion-column last-rowversion max-rowversion]
+  {:pre [(not (empty? record-keys))]}
+  (let [rowversion    (common/sanitize-names rowversion-column)
+        where-clause  (str " WHERE "
+                           (when last-rowversion
+                             (format "%s > ? AND " rowversion))
+                           (format "%s <= ?" rowversion))
+        sql-params    [(str (format "SELECT %s FROM %s.%s"
+                                    (string/join ", " (map common/sanitize-names
+                                                           (distinct (concat record-keys [rowversion-column]))))
+                                    (common/sanitize-names schema-name)
+                                    (common/sanitize-names table-name))
+                            where-clause
+                            " ORDER BY " rowversion)]]
+    (if last-rowversion
+      (conj sql-params (common/hex->bytes last-rowversion) (common/hex->bytes max-rowversion))
+      (conj sql-params (common/hex->bytes max-rowversion)))))
+
+(defn update-rowversion
+  [stream-name rowversion state]
+  (assoc-in state ["bookmarks" stream-name "rowversion"] rowversion))
+
+(defn sync-and-write-messages!
+  "Syncs the rows changed since the bookmarked rowversion and returns the
+  latest state."
+  [config catalog stream-name state]
+  (let [dbname            (get-in catalog ["streams" stream-name "metadata" "database-name"])
+        record-keys       (singer-fields/get-selected-fields catalog stream-name)
+        table-name        (get-in catalog ["streams" stream-name "table_name"])
+        schema-name       (get-in catalog ["streams" stream-name "metadata" "schema-name"])
+        rowversion-column (get-rowversion-column catalog stream-name)
+        last-rowversion   (get-in state ["bookmarks" stream-name "rowversion"])]
+    (when (nil? rowversion-column)
+      (throw (UnsupportedOperationException.
+              (format (str "Cannot sync stream: %s using rowversion replication. "
+                           "No rowversion column found for table: %s")
+                      stream-name
+                      table-name))))
+    (try-read-only [conn-map (assoc (config/->conn-map config true)
+                                    :dbname dbname)]
+                   (let [max-rowversion (common/bytes->hex (get-max-rowversion conn-map))
+                         sql-params     (build-rowversion-sync-query schema-name
+                                                                     table-name
+                                                                     record-keys
+                                                                     rowversion-column
+                                                                     last-rowversion
+                                                                     max-rowversion)]
+                     (log/infof "Executing query: %s" (pr-str sql-params))
+                     (cond->> (singer-pipeline/reduce-records! config
+                                                               catalog
+                                                               stream-name
+                                                               (fn [result]
+                                                                 [(select-keys result record-keys)
+                                                                  (get result rowversion-column)])
+                                                               (fn [acc _ rowversion]
+                                                                 (->> (update-rowversion stream-name (common/bytes->hex rowversion) acc)
+                                                                      (singer-messages/write-state-buffered! stream-name)))
+                                                               state
+                                                               (jdbc/reducible-query (connection-pool/pooled conn-map)
+                                                                                     sql-params
+                                                                                     common/result-set-opts))
+                       ;; Every row up to the upper bound has been read, even
+                       ;; when the last of them was not a row of this table
+                       (or (nil? last-rowversion)
+                           (after? max-rowversion last-rowversion))
+                       (update-rowversion stream-name max-rowversion))))))
+
+(defn sync!
+  [config catalog stream-name state]
+  (->> state
+       (singer-messages/write-activate-version! stream-name catalog)
+       (singer-messages/write-state! stream-name)
+       (sync-and-write-messages! config catalog stream-name)
+       (singer-messages/write-activate-version! stream-name catalog)))
@@ -0,0 +1,207 @@
+(ns tap-mssql.sync-strategies.temporal
+  (:require [tap-mssql.config :as config]
+            [tap-mssql.connection-pool :as connection-pool]
+            [tap-mssql.utils :refer [try-read-only]]
+            [tap-mssql.singer.fields :as singer-fields]
+            [tap-mssql.singer.messages :as singer-messages]
+            [tap-mssql.singer.pipeline :as singer-pipeline]
+            [tap-mssql.sync-strategies.common :as common]
+            [clojure.tools.logging :as log]
+            [clojure.set :as set]
+            [clojure.string :as string]
+            [clojure.java.jdbc :as jdbc])
+  (:import [java.time LocalDateTime]
+           [java.time.format DateTimeFormatter]))
+
+;;; TEMPORAL replication reads system-versioned temporal tables by their
+;;; SYSTEM_TIME period. The first sync reads the table AS OF the time it
+;;; starts. Every later sync reads the row versions that started in the
+;;; period since, and the history rows closed out in it without a later
+;;; version of the same key, which are deletes. Both come through
+;;; `FOR SYSTEM_TIME BETWEEN`, so the history table is read by its period
+;;; index.
+;;;
+;;; The bookmark, `period_time`, is the UTC time every change up to and
+;;; including has been synced, as an ISO 8601 string. Row versions are
+;;; stamped with the time their transaction began, so a sync never reads
+;;; past the oldest read/write transaction still open on the server, whose
+;;; changes may commit behind the bookmark later.
+
+(defn get-period-columns
+  "Structure: {:start-column \"ValidFrom\" :end-column \"ValidTo\"}, or
+  nil when the table is not system-versioned."
+  [conn-map schema-name table-name]
+  (-> (jdbc/query (connection-pool/pooled conn-map)
+                  [(str "SELECT sc.name AS start_column, ec.name AS end_column "
+                        "FROM sys.periods AS p "
+                        "INNER JOIN sys.tables AS t ON t.object_id = p.object_id "
+                        "INNER JOIN sys.columns AS sc ON sc.object_id = p.object_id AND sc.column_id = p.start_column_id "
+                        "INNER JOIN sys.columns AS ec ON ec.object_id = p.object_id AND ec.column_id = p.end_column_id "
+                        "WHERE p.object_id = OBJECT_ID(?) AND t.temporal_type = 2")
+                   (format "%s.%s"
+                           (common/sanitize-names schema-name)
+                           (common/sanitize-names table-name))])
+      first
+      (set/rename-keys {:start_column :start-column
+                        :end_column   :end-column})))
+
+(defn get-sync-end-time
+  "The time a sync reads up to: `lag-seconds` before now, and a second
+  before the oldest open read/write transaction began. Transaction begin
+  times are local `datetime`s, so they are shifted to UTC and the second
+  covers their rounding."
+  [conn-map lag-seconds]
+  (-> (jdbc/query (connection-pool/pooled conn-map)
+                  [(str "SELECT CONVERT(varchar(27), "
+                        "CASE WHEN t.oldest_begin_time < n.end_time THEN t.oldest_begin_time ELSE n.end_time END, "
+                        "126) AS end_time "
+                        "FROM (SELECT DATEADD(second, ?, SYSUTCDATETIME()) AS end_time) AS n "
+                        "CROSS JOIN (SELECT MIN(DATEADD(second, -1, "
+                        "DATEADD(millisecond, DATEDIFF(millisecond, SYSDATETIME(), SYSUTCDATETIME()), "
+                        "CONVERT(datetime2, transaction_begin_time)))) AS oldest_begin_time "
+                        "FROM sys.dm_tran_active_transactions "
+                        "WHERE transaction_type = 1 "
+                        "AND transaction_id <> CURRENT_TRANSACTION_ID()) AS t")
+                   (- lag-seconds)])
+      first
+      :end_time))
+
+(def period-time-formatter (DateTimeFormatter/ofPattern "yyyy-MM-dd'T'HH:mm:ss.SSSSSSS"))
+
+(defn get-window-end
+  [period-time end-time window-minutes]
+  (if (pos? window-minutes)
+    (let [window-end (.plusMinutes (LocalDateTime/parse period-time) window-minutes)]
+      (if (.isBefore window-end (LocalDateTime/parse end-time))
+        (.format window-end period-time-formatter)
+        end-time))
+    end-time))
+
+(defn- table-name-sql
+  [schema-name table-name]
+  (format "%s.%s"
+          (common/sanitize-names schema-name)
+          (common/sanitize-names table-name)))
+
+(defn build-temporal-snapshot-query
+  [schema-name table-name record-keys end-time]
+  {:pre [(not (empty? record-keys))]}
+  [(format "SELECT %s FROM %s FOR SYSTEM_TIME AS OF ?"
+           (string/join ", " (map common/sanitize-names record-keys))
+           (table-name-sql schema-name table-name))
+   end-time])
+
+(defn build-temporal-changes-query
+  "Reads the row versions that started after `from-time` up to and
+  including `to-time`, and, when there are primary keys to match versions
+  by, the rows deleted in that period as their last version."
+  [schema-name table-name record-keys primary-keys {:keys [start-column end-column]} from-time to-time]
+  {:pre [(not (empty? record-keys))]}
+  (let [table  (table-name-sql schema-name table-name)
+        start  (common/sanitize-names start-column)
+        end    (common/sanitize-names end-column)
+        upsert (format (str "SELECT %s, %s AS _sdc_period_time, 0 AS _sdc_is_delete "
+                            "FROM %s FOR SYSTEM_TIME BETWEEN ? AND ? "
+                            "WHERE %s > ?")
+                       (string/join ", " (map common/sanitize-names record-keys))
+                       start
+                       table
+                       start)
+        delete (format (str "SELECT %s, h.%s, 1 "
+                            "FROM %s FOR SYSTEM_TIME BETWEEN ? AND ? AS h "
+                            "WHERE h.%s <= ? "
+                            "AND NOT EXISTS (SELECT 1 FROM %s FOR SYSTEM_TIME ALL AS n "
+                            "WHERE %s AND n.%s = h.%s)")
+                       (string/join ", " (map #(str "h." (common/sanitize-names %)) record-keys))
+                       end
+                       table
+                       end
+                       table
+                       (string/join " AND " (map #(format "n.%1$s = h.%1$s" (common/sanitize-names %))
+                                                 primary-keys))
+                       start
+                       end)]
+    (if (empty? primary-keys)
+      [(str upsert " ORDER BY _sdc_period_time")
+       from-time to-time from-time]
+      [(str upsert " UNION ALL " delete " ORDER BY _sdc_period_time, _sdc_is_delete")
+       from-time to-time from-time
+       from-time to-time to-time])))
+
+(defn update-period-time
+  [stream-name period-time state]
+  (assoc-in state ["bookmarks" stream-name "period_time"] period-time))
+
+(defn- read-change
+  [record-keys result]
+  [(if (= 1 (get result "_sdc_is_delete"))
+     (assoc (select-keys result record-keys)
+            "_sdc_deleted_at" (get result "_sdc_period_time"))
+     (select-keys result record-keys))])
+
+(defn- reduce-query!
+  [config catalog stream-name conn-map read-row state sql-params]
+  (log/infof "Executing query: %s" (pr-str sql-params))
+  (singer-pipeline/reduce-records! config
+                                   catalog
+                                   stream-name
+                                   read-row
+                                   (fn [st _ _]
+                                     (singer-messages/write-state-buffered! stream-name st))
+                                   state
+                                   (jdbc/reducible-query (connection-pool/pooled conn-map)
+                                                         sql-params
+                                                         common/result-set-opts)))
+
+(defn sync-and-write-messages!
+  "Syncs the table as of now on the first sync, and the changes since the
+  bookmarked period time after, returning the latest state."
+  [config catalog stream-name state]
+  (let [dbname         (get-in catalog ["streams" stream-name "metadata" "database-name"])
+        record-keys    (singer-fields/get-selected-fields catalog stream-name)
+        primary-keys   (get-in catalog ["streams" stream-name "metadata" "table-key-properties"])
+        table-name     (get-in catalog ["streams" stream-name "table_name"])
+        schema-name    (get-in catalog ["streams" stream-name "metadata" "schema-name"])
+        window-minutes (config/get-integer config "temporal_window_minutes" 0)]
+    (try-read-only [conn-map (assoc (config/->conn-map config true)
+                                    :dbname dbname)]
+                   (let [period-columns (get-period-columns conn-map schema-name table-name)
+                         end-time       (get-sync-end-time conn-map (config/get-integer config "temporal_lag_seconds" 0))]
+                     (when (nil? period-columns)
+                       (throw (UnsupportedOperationException.
+                               (format (str "Cannot sync stream: %s using temporal replication. "
+                                            "Table: %s is not a system-versioned temporal table")
+                                       stream-name
+                                       table-name))))
+                     (when (empty? primary-keys)
+                       (log/warnf "Stream %s has no primary key, deletes will not be synced" stream-name))
+                     (if (nil? (get-in state ["bookmarks" stream-name "period_time"]))
+                       (->> (build-temporal-snapshot-query schema-name table-name record-keys end-time)
+                            (reduce-query! config catalog stream-name conn-map
+                                           (fn [result] [(select-keys result record-keys)])
+                                           state)
+                            (update-period-time stream-name end-time)
+                            (singer-messages/write-state! stream-name))
+                       (loop [state state]
+                         (let [period-time (get-in state ["bookmarks" stream-name "period_time"])]
+                           (if-not (.isBefore (LocalDateTime/parse period-time) (LocalDateTime/parse end-time))
+                             state
+                             (let [to-time (get-window-end period-time end-time window-minutes)]
+                               (recur (->> (build-temporal-changes-query schema-name
+                                                                         table-name
+                                                                         record-keys
+                                                                         primary-keys
+                                                                         period-columns
+                                                                         period-time
+                                                                         to-time)
+                                           (reduce-query! config catalog stream-name conn-map
+                                                          (partial read-change record-keys)
+                                                          state)
+                                           (update-period-time stream-name to-time)
+                                           (singer-messages/write-state! stream-name))))))))))))
+
+(defn sync!
+  [config catalog stream-name state]
+  (->> state
+       (singer-messages/write-state! stream-name)
+       (sync-and-write-messages! config catalog stream-name)))
@@ -28,3 +28,23 @@
                              (when-not should-retry# (throw ex#))))]
            result#
            (recur (dissoc ~inner-name :ApplicationIntent) false))))))
+
+(defn bounded-pmap
+  "Like (mapv f coll), calling f on at most `parallelism` threads at a
+  time. Results are in the order of `coll` whatever order they finish in.
+  The first exception thrown by f is rethrown once the calls still running
+  are cancelled."
+  [parallelism f coll]
+  (if (<= parallelism 1)
+    (mapv f coll)
+    (let [pool (java.util.concurrent.Executors/newFixedThreadPool parallelism)]
+      (try
+        (let [tasks (mapv (fn [x]
+                            (.submit pool ^Callable (bound-fn [] (f x))))
+                          coll)]
+          (try
+            (mapv (fn [^java.util.concurrent.Future task] (.get task)) tasks)
+            (catch java.util.concurrent.ExecutionException ex
+              (throw (.getCause ex)))))
+        (finally
+          (.shutdownNow pool))))))
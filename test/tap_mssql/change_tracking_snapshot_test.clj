@@ -0,0 +1,43 @@
+(ns tap-mssql.change-tracking-snapshot-test
+  (:require [tap-mssql.sync-strategies.logical :as logical]
+            [clojure.test :refer [is deftest]]))
+
+(def catalog
+  {"streams" {"db_dbo_a" {"table_name" "a"
+                          "metadata"   {"selected"           true
+                                        "replication-method" "LOG_BASED"
+                                        "database-name"      "db"
+                                        "schema-name"        "dbo"}}
+              "db_dbo_b" {"table_name" "b"
+                          "metadata"   {"selected"           true
+                                        "replication-method" "LOG_BASED"
+                                        "database-name"      "db"
+                                        "schema-name"        "dbo"}}
+              "other_dbo_c" {"table_name" "c"
+                             "metadata"   {"selected"           true
+                                           "replication-method" "FULL_TABLE"
+                                           "database-name"      "other"
+                                           "schema-name"        "dbo"}}}})
+
+(deftest one-snapshot-per-log-based-database
+  (let [calls (atom [])]
+    (with-redefs [logical/get-change-tracking-snapshot* (fn [_ dbname]
+                                                          (swap! calls conj dbname)
+                                                          {:current-version    42
+                                                           :tables             {"dbo" #{"a" "b"}}
+                                                           :min-valid-versions {["dbo" "a"] 3
+                                                                                ["dbo" "b"] 5}})]
+      (try
+        (logical/prefetch-change-tracking-snapshots! {} catalog)
+        (is (= ["db"] @calls))
+        (doseq [stream-name ["db_dbo_a" "db_dbo_b"]]
+          (is (= 42 (logical/get-current-log-version {} catalog stream-name))))
+        (is (= 3 (logical/get-min-valid-version {} "db" "dbo" "a")))
+        (is (= 5 (logical/get-min-valid-version {} "db" "dbo" "b")))
+        (is (= {"dbo" #{"a" "b"}} (logical/get-change-tracking-tables* {} "db")))
+        (is (= ["db"] @calls))
+        ;; Databases without a snapshot are read each time
+        (logical/get-min-valid-version {} "other" "dbo" "c")
+        (is (= ["db" "other"] @calls))
+        (finally
+          (reset! logical/change-tracking-snapshots {}))))))
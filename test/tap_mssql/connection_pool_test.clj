@@ -0,0 +1,88 @@
+(ns tap-mssql.connection-pool-test
+  (:require [tap-mssql.connection-pool :as connection-pool]
+            [clojure.test :refer [is deftest use-fixtures]])
+  (:import [java.lang.reflect InvocationHandler Proxy]
+           [java.sql Connection SQLException]))
+
+(defn fake-connection
+  "A Connection that only knows whether it was closed and whether it
+  should report itself valid."
+  [valid?]
+  (let [closed? (atom false)]
+    (Proxy/newProxyInstance
+     (.getClassLoader Connection)
+     (into-array Class [Connection])
+     (reify InvocationHandler
+       (invoke [_ proxy method args]
+         (case (.getName method)
+           "close"         (reset! closed? true)
+           "isClosed"      @closed?
+           "isValid"       @valid?
+           "getAutoCommit" true
+           "equals"        (identical? proxy (first args))
+           "hashCode"      (System/identityHashCode proxy)
+           "toString"      "fake-connection"
+           nil))))))
+
+(defn with-pooling
+  [f]
+  (connection-pool/configure! {"connection_pool_size" 2})
+  (try
+    (f)
+    (finally
+      (connection-pool/configure! {}))))
+
+(use-fixtures :each with-pooling)
+
+(defn counting-pool
+  []
+  (let [opened (atom [])
+        pool   (connection-pool/make-pool (fn []
+                                            (let [connection (fake-connection (atom true))]
+                                              (swap! opened conj connection)
+                                              connection)))]
+    [pool opened]))
+
+(deftest returned-connections-are-reused
+  (let [[pool opened] (counting-pool)]
+    (dotimes [_ 10]
+      (with-open [^Connection connection (connection-pool/borrow! pool)]
+        (is (not (.isClosed connection)))))
+    (is (= 1 (count @opened)))
+    (is (not (.isClosed ^Connection (first @opened))))))
+
+(deftest borrowing-never-blocks
+  (let [[pool opened] (counting-pool)
+        connections   (doall (repeatedly 5 #(connection-pool/borrow! pool)))]
+    (is (= 5 (count @opened)))
+    (run! #(.close ^Connection %) connections)
+    ;; Only connection_pool_size of them are kept once returned
+    (is (= 3 (count (filter #(.isClosed ^Connection %) @opened))))))
+
+(deftest returned-connections-cannot-be-used
+  (let [[pool _]             (counting-pool)
+        ^Connection borrowed (connection-pool/borrow! pool)]
+    (.close borrowed)
+    (is (.isClosed borrowed))
+    (is (thrown? SQLException (.createStatement borrowed)))))
+
+(deftest closed-connections-are-not-handed-out
+  (let [[pool opened] (counting-pool)]
+    (.close ^Connection (connection-pool/borrow! pool))
+    ;; The server went away while it sat in the pool
+    (.close ^Connection (first @opened))
+    (with-open [connection (connection-pool/borrow! pool)]
+      (is (= 2 (count @opened))))))
+
+(deftest idle-connections-are-evicted
+  (let [[pool opened] (counting-pool)]
+    (.close ^Connection (connection-pool/borrow! pool))
+    (connection-pool/evict-idle! pool (- (System/currentTimeMillis) 60000))
+    (is (not (.isClosed ^Connection (first @opened))))
+    (connection-pool/evict-idle! pool (+ (System/currentTimeMillis) 1))
+    (is (.isClosed ^Connection (first @opened)))))
+
+(deftest pooling-is-off-by-default
+  (connection-pool/configure! {})
+  (let [db-spec {:dbtype "sqlserver" :dbname "a"}]
+    (is (= db-spec (connection-pool/pooled db-spec)))))
@@ -12,7 +12,9 @@
             [tap-mssql.catalog :as catalog]
             [tap-mssql.singer.transform :as singer-transform]
             [tap-mssql.singer.messages :as singer-messages]
-            [tap-mssql.config :as config])
+            [tap-mssql.config :as config]
+            [clojure.string :as string]
+            [clojure.data.json :as json])
   (:import [java.sql Date]))
 
 (defn get-destroy-database-command
@@ -78,6 +80,106 @@
                                  {"craftsmanship_dbo_mahogany"
                                   {"max_pk_values" {"legs" nil}}}}))))
 
+(deftest build-chunked-sync-query-test
+  ;; First chunk
+  (is (= '("SELECT TOP (500) [legs], [tabletop], [leaf] FROM [dbo].[mahogany] WHERE [legs] <= ? AND [leaf] <= ? ORDER BY [legs], [leaf]"
+           4
+           "birch")
+         (full/build-sync-query "craftsmanship_dbo_mahogany" "dbo" "mahogany" ["legs", "tabletop", "leaf"]
+                                {"bookmarks" {"craftsmanship_dbo_mahogany" {"max_pk_values" {"legs" 4 "leaf" "birch"}}}}
+                                500)))
+  ;; Later chunks seek past the last pk fetched
+  (is (= '("SELECT TOP (500) [legs], [tabletop], [leaf] FROM [dbo].[mahogany] WHERE (([legs] > ?) OR ([legs] = ? AND [leaf] > ?)) AND [legs] <= ? AND [leaf] <= ? ORDER BY [legs], [leaf]"
+           2 2 "balsa"
+           4 "birch")
+         (full/build-sync-query "craftsmanship_dbo_mahogany" "dbo" "mahogany" ["legs", "tabletop", "leaf"]
+                                {"bookmarks" {"craftsmanship_dbo_mahogany" {"last_pk_fetched" {"legs" 2 "leaf" "balsa"}
+                                                                            "max_pk_values"   {"legs" 4 "leaf" "birch"}}}}
+                                500))))
+
+(deftest split-key-range-test
+  ;; Ranges are contiguous, the first lower bound is open and the last
+  ;; upper bound is the max
+  (is (= [{"lower" nil "upper" 3}
+          {"lower" 3 "upper" 5}
+          {"lower" 5 "upper" 8}
+          {"lower" 8 "upper" 10}]
+         (full/split-key-range 1 10 4)))
+  ;; Never more partitions than keys
+  (is (= [{"lower" nil "upper" 5}
+          {"lower" 5 "upper" 6}]
+         (full/split-key-range 5 6 8)))
+  ;; The whole bigint range does not overflow
+  (is (= [{"lower" nil "upper" -1}
+          {"lower" -1 "upper" Long/MAX_VALUE}]
+         (full/split-key-range Long/MIN_VALUE Long/MAX_VALUE 2))))
+
+(deftest partition-sync-query-test
+  ;; First partition only has an upper bound
+  (is (= '("SELECT [id], [value] FROM [dbo].[mahogany] WHERE [id] <= ? ORDER BY [id]"
+           250)
+         (full/build-sync-query "craftsmanship_dbo_mahogany" "dbo" "mahogany" ["id" "value"]
+                                (full/partition->state "craftsmanship_dbo_mahogany" "id"
+                                                       {"lower" nil "upper" 250}))))
+  ;; Later partitions start after their lower bound
+  (is (= '("SELECT [id], [value] FROM [dbo].[mahogany] WHERE (([id] > ?)) AND [id] <= ? ORDER BY [id]"
+           250
+           500)
+         (full/build-sync-query "craftsmanship_dbo_mahogany" "dbo" "mahogany" ["id" "value"]
+                                (full/partition->state "craftsmanship_dbo_mahogany" "id"
+                                                       {"lower" 250 "upper" 500}))))
+  ;; Interrupted partitions resume after their last pk fetched
+  (is (= '("SELECT [id], [value] FROM [dbo].[mahogany] WHERE (([id] > ?)) AND [id] <= ? ORDER BY [id]"
+           321
+           500)
+         (full/build-sync-query "craftsmanship_dbo_mahogany" "dbo" "mahogany" ["id" "value"]
+                                (full/partition->state "craftsmanship_dbo_mahogany" "id"
+                                                       {"lower"           250
+                                                        "upper"           500
+                                                        "last_pk_fetched" {"id" 321}})))))
+
+(deftest partitions-are-synced-and-bookmarked-on-their-own
+  (let [stream-name "craftsmanship_dbo_mahogany"
+        catalog     {"streams" {stream-name {"table_name" "mahogany"
+                                             "metadata"   {"table-key-properties" ["id"]
+                                                           "properties"           {"id" {"sql-datatype" "int"}}}}}}
+        partitions  (full/split-key-range 1 1000 4)
+        ;; Stands in for the queries, reading the partition's keys in order
+        sync-range  (fn [_ catalog stream-name state write-state-buffered]
+                      (let [{:strs [last_pk_fetched max_pk_values]} (get-in state ["bookmarks" stream-name])]
+                        (reduce (fn [state id]
+                                  (singer-messages/write-record! stream-name state {"id" id} catalog)
+                                  (->> (assoc-in state ["bookmarks" stream-name "last_pk_fetched"] {"id" id})
+                                       write-state-buffered))
+                                state
+                                (range (inc (get last_pk_fetched "id" 0))
+                                       (inc (get max_pk_values "id"))))))
+        _           (reset! singer-messages/records-since-last-state 0)
+        final-state (atom nil)
+        messages    (->> (with-out-str
+                           (with-redefs-fn {#'full/sync-range! sync-range}
+                             #(reset! final-state
+                                      (full/sync-partitions-and-write-messages!
+                                       {} catalog stream-name
+                                       {"bookmarks" {stream-name {"version" 1}}}
+                                       partitions))))
+                         string/split-lines
+                         (map json/read-str))
+        states      (->> messages
+                         (filter #(= "STATE" (% "type")))
+                         (map #(get-in % ["value" "bookmarks" stream-name "partitions"]))
+                         (remove nil?))]
+    (is (= (range 1 1001)
+           (->> messages
+                (filter #(= "RECORD" (% "type")))
+                (map #(get-in % ["record" "id"]))
+                sort)))
+    ;; Every partition counts its own records towards its STATEs
+    (is (= 0 @singer-messages/records-since-last-state))
+    (is (= (map #(get % "upper") partitions)
+           (map #(get-in % ["last_pk_fetched" "id"]) (last states))))
+    (is (= {"version" 1} (get-in @final-state ["bookmarks" stream-name])))))
+
 (deftest ^:integration build-log-based-sql-query-test
   (with-matrix-assertions test-db-configs test-db-fixture
     ;; No PK
@@ -92,7 +194,7 @@
                                  {} )))
     ;; Has primary key, no record Keys, no primary key bookmark
     (is (=
-         ["SELECT c.SYS_CHANGE_VERSION, c.SYS_CHANGE_OPERATION, tc.commit_time, c.[id], [dbo].[basic_table].[id] FROM CHANGETABLE (CHANGES [dbo].[basic_table], 0) as c LEFT JOIN [dbo].[basic_table] ON c.[id]=[dbo].[basic_table].[id] LEFT JOIN sys.dm_tran_commit_table tc on c.SYS_CHANGE_VERSION = tc.commit_ts ORDER BY c.SYS_CHANGE_VERSION, c.[id]"]
+         ["SELECT c.SYS_CHANGE_VERSION, c.SYS_CHANGE_OPERATION, tc.commit_time, c.[id], [dbo].[basic_table].[id], CASE WHEN [dbo].[basic_table].[id] IS NULL THEN 0 ELSE 1 END AS row_found FROM CHANGETABLE (CHANGES [dbo].[basic_table], 0) as c LEFT JOIN [dbo].[basic_table] ON c.[id]=[dbo].[basic_table].[id] LEFT JOIN sys.dm_tran_commit_table tc on c.SYS_CHANGE_VERSION = tc.commit_ts ORDER BY c.SYS_CHANGE_VERSION, c.[id]"]
          (logical/build-log-based-sql-query
           (update-in (catalog/discover test-db-config)
                      ["streams" "full_table_sync_test_dbo_basic_table" "metadata" "properties" "value"]
@@ -102,7 +204,7 @@
           {"bookmarks" {"full_table_sync_test_dbo_basic_table" {"current_log_version" 0}}})))
     ;; Has PK, No Selected Fields, Has Bookmark
     (is (=
-         ["SELECT c.SYS_CHANGE_VERSION, c.SYS_CHANGE_OPERATION, tc.commit_time, c.[id], [dbo].[basic_table].[id] FROM CHANGETABLE (CHANGES [dbo].[basic_table], 0) as c LEFT JOIN [dbo].[basic_table] ON c.[id]=[dbo].[basic_table].[id] LEFT JOIN sys.dm_tran_commit_table tc on c.SYS_CHANGE_VERSION = tc.commit_ts WHERE c.SYS_CHANGE_VERSION = 0 AND c.id >= ? ORDER BY c.SYS_CHANGE_VERSION, c.[id]" "foo"]
+         ["SELECT c.SYS_CHANGE_VERSION, c.SYS_CHANGE_OPERATION, tc.commit_time, c.[id], [dbo].[basic_table].[id], CASE WHEN [dbo].[basic_table].[id] IS NULL THEN 0 ELSE 1 END AS row_found FROM CHANGETABLE (CHANGES [dbo].[basic_table], 0) as c LEFT JOIN [dbo].[basic_table] ON c.[id]=[dbo].[basic_table].[id] LEFT JOIN sys.dm_tran_commit_table tc on c.SYS_CHANGE_VERSION = tc.commit_ts WHERE c.SYS_CHANGE_VERSION = 0 AND c.id >= ? ORDER BY c.SYS_CHANGE_VERSION, c.[id]" "foo"]
          (logical/build-log-based-sql-query
           (update-in (catalog/discover test-db-config)
                      ["streams" "full_table_sync_test_dbo_basic_table" "metadata" "properties" "value"]
@@ -115,7 +217,7 @@
              "last_pk_fetched"     {"id" "foo"}}}})))
     ;; Has primary key, selected fields, no primary key bookmark
     (is (=
-         ["SELECT c.SYS_CHANGE_VERSION, c.SYS_CHANGE_OPERATION, tc.commit_time, c.[id], [dbo].[basic_table].[id], [dbo].[basic_table].[value] FROM CHANGETABLE (CHANGES [dbo].[basic_table], 0) as c LEFT JOIN [dbo].[basic_table] ON c.[id]=[dbo].[basic_table].[id] LEFT JOIN sys.dm_tran_commit_table tc on c.SYS_CHANGE_VERSION = tc.commit_ts ORDER BY c.SYS_CHANGE_VERSION, c.[id]"]
+         ["SELECT c.SYS_CHANGE_VERSION, c.SYS_CHANGE_OPERATION, tc.commit_time, c.[id], [dbo].[basic_table].[id], [dbo].[basic_table].[value], CASE WHEN [dbo].[basic_table].[id] IS NULL THEN 0 ELSE 1 END AS row_found FROM CHANGETABLE (CHANGES [dbo].[basic_table], 0) as c LEFT JOIN [dbo].[basic_table] ON c.[id]=[dbo].[basic_table].[id] LEFT JOIN sys.dm_tran_commit_table tc on c.SYS_CHANGE_VERSION = tc.commit_ts ORDER BY c.SYS_CHANGE_VERSION, c.[id]"]
          (logical/build-log-based-sql-query
           (catalog/discover test-db-config)
           "full_table_sync_test_dbo_basic_table"
@@ -125,7 +227,7 @@
 
     ;; Has primary key, selected fields, primary key bookmark
     (is (=
-         ["SELECT c.SYS_CHANGE_VERSION, c.SYS_CHANGE_OPERATION, tc.commit_time, c.[id], [dbo].[basic_table].[id], [dbo].[basic_table].[value] FROM CHANGETABLE (CHANGES [dbo].[basic_table], 0) as c LEFT JOIN [dbo].[basic_table] ON c.[id]=[dbo].[basic_table].[id] LEFT JOIN sys.dm_tran_commit_table tc on c.SYS_CHANGE_VERSION = tc.commit_ts WHERE c.SYS_CHANGE_VERSION = 0 AND c.id >= ? ORDER BY c.SYS_CHANGE_VERSION, c.[id]" "foo"]
+         ["SELECT c.SYS_CHANGE_VERSION, c.SYS_CHANGE_OPERATION, tc.commit_time, c.[id], [dbo].[basic_table].[id], [dbo].[basic_table].[value], CASE WHEN [dbo].[basic_table].[id] IS NULL THEN 0 ELSE 1 END AS row_found FROM CHANGETABLE (CHANGES [dbo].[basic_table], 0) as c LEFT JOIN [dbo].[basic_table] ON c.[id]=[dbo].[basic_table].[id] LEFT JOIN sys.dm_tran_commit_table tc on c.SYS_CHANGE_VERSION = tc.commit_ts WHERE c.SYS_CHANGE_VERSION = 0 AND c.id >= ? ORDER BY c.SYS_CHANGE_VERSION, c.[id]" "foo"]
          (logical/build-log-based-sql-query
           (catalog/discover test-db-config)
           "full_table_sync_test_dbo_basic_table"
@@ -135,7 +237,7 @@
              "last_pk_fetched"     {"id" "foo"}}}})))
     ;; Has composite primary keys, selected fields, bookmarks for both pks
     (is (=
-         ["SELECT c.SYS_CHANGE_VERSION, c.SYS_CHANGE_OPERATION, tc.commit_time, c.[id], c.[second_id], [dbo].[composite_key_table].[id], [dbo].[composite_key_table].[second_id], [dbo].[composite_key_table].[value] FROM CHANGETABLE (CHANGES [dbo].[composite_key_table], 0) as c LEFT JOIN [dbo].[composite_key_table] ON c.[id]=[dbo].[composite_key_table].[id] AND c.[second_id]=[dbo].[composite_key_table].[second_id] LEFT JOIN sys.dm_tran_commit_table tc on c.SYS_CHANGE_VERSION = tc.commit_ts WHERE c.SYS_CHANGE_VERSION = 0 AND c.id >= ? AND c.second_id >= ? ORDER BY c.SYS_CHANGE_VERSION, c.[id], c.[second_id]" "foo" "bar"]
+         ["SELECT c.SYS_CHANGE_VERSION, c.SYS_CHANGE_OPERATION, tc.commit_time, c.[id], c.[second_id], [dbo].[composite_key_table].[id], [dbo].[composite_key_table].[second_id], [dbo].[composite_key_table].[value], CASE WHEN [dbo].[composite_key_table].[id] IS NULL THEN 0 ELSE 1 END AS row_found FROM CHANGETABLE (CHANGES [dbo].[composite_key_table], 0) as c LEFT JOIN [dbo].[composite_key_table] ON c.[id]=[dbo].[composite_key_table].[id] AND c.[second_id]=[dbo].[composite_key_table].[second_id] LEFT JOIN sys.dm_tran_commit_table tc on c.SYS_CHANGE_VERSION = tc.commit_ts WHERE c.SYS_CHANGE_VERSION = 0 AND c.id >= ? AND c.second_id >= ? ORDER BY c.SYS_CHANGE_VERSION, c.[id], c.[second_id]" "foo" "bar"]
          (logical/build-log-based-sql-query
           (catalog/discover test-db-config)
           "full_table_sync_test_dbo_composite_key_table"
@@ -172,6 +274,31 @@
   (is (= "0x000000000000000A"
          (singer-transform/transform-binary (byte-array [0 0 0 0 0 0 0 10])))))
 
+(deftest transform-binary-matches-format-based-encoding-test
+  (let [binary (byte-array (range -128 128))]
+    ;; A seq of bytes still goes through the format based encoding
+    (is (= (singer-transform/transform-binary (seq binary))
+           (singer-transform/transform-binary binary))))
+  (is (= "0x" (singer-transform/transform-binary (byte-array 0)))))
+
+(deftest transform-varbinary-base64-test
+  (let [binary (byte-array [0 0 0 0 0 0 0 10])]
+    (try
+      (reset! singer-transform/varbinary-encoding "base64")
+      (is (= "AAAAAAAAAAo=" (singer-transform/transform-varbinary binary)))
+      ;; Only varbinary columns are affected
+      (is (= {"test1" "AAAAAAAAAAo="
+              "test2" "0x000000000000000A"}
+             (singer-transform/transform
+              {"streams"
+               {"cuyahoga" {"metadata" {"properties" {"test1" {"sql-datatype" "varbinary"}
+                                                      "test2" {"sql-datatype" "binary"}}}}}}
+              "cuyahoga"
+              {"test1" binary
+               "test2" binary})))
+      (finally
+        (reset! singer-transform/varbinary-encoding "hex")))))
+
 (deftest transform-date-test
   ;; Convert to string and add time and tz offset (T00:00:00+00:00)
   (is (= "2019-08-08T00:00:00+00:00"
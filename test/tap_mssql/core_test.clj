@@ -2,6 +2,8 @@
   (:require [tap-mssql.catalog :as catalog]
             [tap-mssql.serialized-catalog :as serialized-catalog]
             [tap-mssql.config :as config]
+            [tap-mssql.singer.messages :as singer-messages]
+            [tap-mssql.sync-strategies.logical :as logical]
             [clojure.test :refer [is deftest]]
             [tap-mssql.core :refer :all]))
 
@@ -118,6 +120,32 @@
   (is (= "myidentity()type" (catalog/type-name->type-name-lookup "myidentity()type")))
 )
 
+(deftest follow-mode-syncs-log-based-streams-until-stopped
+  (let [catalog {"streams" {"a" {"tap_stream_id" "a"
+                                 "metadata"      {"selected"           true
+                                                  "replication-method" "LOG_BASED"}}
+                            "b" {"tap_stream_id" "b"
+                                 "metadata"      {"selected"           true
+                                                  "replication-method" "FULL_TABLE"}}
+                            "c" {"tap_stream_id" "c"
+                                 "metadata"      {"replication-method" "LOG_BASED"}}}}
+        stop    (promise)
+        synced  (atom [])]
+    (with-redefs [do-sync                                     (fn [_ _ state]
+                                                                (swap! synced conj :all)
+                                                                state)
+                  logical/prefetch-change-tracking-snapshots! (constantly nil)
+                  logical/sync!                               (fn [_ _ stream-name state]
+                                                                (swap! synced conj stream-name)
+                                                                (when (= 3 (count @synced))
+                                                                  (deliver stop true))
+                                                                (update state "cycles" (fnil inc 0)))
+                  singer-messages/write-state!                (fn [_ state] state)]
+      (is (= {"cycles" 2}
+             (do-follow {"follow_interval_seconds" 0} catalog {} stop)))
+      (is (= [:all "a" "a"] @synced)))))
+
+
 (comment
   ;; Run all loaded tests
   (do
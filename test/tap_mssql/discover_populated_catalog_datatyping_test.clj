@@ -436,6 +436,32 @@
          (get-in (catalog/discover test-db-config)
                  ["streams" "datatyping_dbo_decimal_identity" "schema" "properties" "decimal_identity"]))))
 
+(deftest ^:integration verify-bulk-discovery-matches-jdbc-discovery
+  (is (= (catalog/discover test-db-config)
+         (catalog/discover (assoc test-db-config "discovery_method" "bulk")))))
+
+(deftest ^:integration verify-cached-discovery-matches-discovery
+  (let [cache-file  (java.io.File/createTempFile "discovery-cache" ".json")
+        cache-config (assoc test-db-config "discovery_cache_path" (.getPath cache-file))]
+    (try
+      (io/delete-file cache-file)
+      ;; Cold cache
+      (is (= (catalog/discover test-db-config)
+             (catalog/discover cache-config)))
+      ;; Warm cache
+      (is (= (catalog/discover test-db-config)
+             (catalog/discover cache-config)))
+      ;; A changed table is read again
+      (jdbc/db-do-commands (assoc (config/->conn-map test-db-config) :dbname "datatyping")
+                           ["ALTER TABLE exact_numerics ADD added_later int"])
+      (is (= (catalog/discover test-db-config)
+             (catalog/discover cache-config)))
+      (is (contains? (get-in (catalog/discover cache-config)
+                             ["streams" "datatyping_dbo_exact_numerics" "schema" "properties"])
+                     "added_later"))
+      (finally
+        (io/delete-file cache-file true)))))
+
 (comment
   (map select-keys
        (get-columns test-db-config)
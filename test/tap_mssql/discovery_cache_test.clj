@@ -0,0 +1,55 @@
+(ns tap-mssql.discovery-cache-test
+  (:require [tap-mssql.discovery-cache :as discovery-cache]
+            [clojure.test :refer [is deftest]]
+            [clojure.java.io :as io]))
+
+(def cached-objects
+  {"1" {"schema_name" "dbo" "table_name" "a" "modify_date" "2019-01-01T00:00:00"
+        "columns"     [{"table_name" "a" "column_name" "id" "primary-key?" true}]}
+   "2" {"schema_name" "dbo" "table_name" "b" "modify_date" "2019-01-01T00:00:00"
+        "columns"     []}
+   "3" {"schema_name" "dbo" "table_name" "dropped" "modify_date" "2019-01-01T00:00:00"
+        "columns"     []}})
+
+(deftest only-new-and-changed-objects-are-read-again
+  (is (= ["2" "4" "5"]
+         (discovery-cache/changed-object-ids
+          cached-objects
+          {"1" {"schema_name" "dbo" "table_name" "a" "modify_date" "2019-01-01T00:00:00"}
+           ;; altered
+           "2" {"schema_name" "dbo" "table_name" "b" "modify_date" "2019-06-01T00:00:00"}
+           ;; renamed from dropped
+           "4" {"schema_name" "dbo" "table_name" "c" "modify_date" "2019-01-01T00:00:00"}
+           "5" {"schema_name" "dbo" "table_name" "dropped" "modify_date" "2019-06-01T00:00:00"}}))))
+
+(deftest cached-columns-round-trip
+  (let [file (java.io.File/createTempFile "discovery-cache" ".json")
+        path (.getPath file)]
+    (try
+      (let [column {:table_cat "db" :table_schem "dbo" :table_name "a" :column_name "id"
+                    :type_name "int" :column_size 10 :decimal_digits 0
+                    :primary-key? true :is-view? false :approximate-row-count 12}
+            object (discovery-cache/->cached-object {"schema_name" "dbo"
+                                                     "table_name"  "a"
+                                                     "modify_date" "2019-01-01T00:00:00"}
+                                                    [column])]
+        (discovery-cache/write-cache! path "localhost" {"db" {"objects" {"1" object}}})
+        (is (= [(dissoc column :approximate-row-count)]
+               (-> (discovery-cache/read-cache path "localhost")
+                   (get-in ["databases" "db" "objects" "1"])
+                   discovery-cache/cached-columns)))
+        (is (= discovery-cache/empty-cache
+               (discovery-cache/read-cache path "another-host"))))
+      (finally
+        (io/delete-file file true)))))
+
+(deftest missing-or-unreadable-caches-are-empty
+  (is (= discovery-cache/empty-cache
+         (discovery-cache/read-cache "/nonexistent/discovery-cache.json" "localhost")))
+  (let [file (java.io.File/createTempFile "discovery-cache" ".json")]
+    (try
+      (spit file "{not json")
+      (is (= discovery-cache/empty-cache
+             (discovery-cache/read-cache (.getPath file) "localhost")))
+      (finally
+        (io/delete-file file true)))))
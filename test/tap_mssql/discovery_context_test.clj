@@ -0,0 +1,64 @@
+(ns tap-mssql.discovery-context-test
+  (:require [tap-mssql.catalog :as catalog]
+            [tap-mssql.config :as config]
+            [clojure.test :refer [is deftest]]))
+
+(def schemas ["dbo" "sales" "hr"])
+
+(defn fake-columns
+  [_ database _]
+  [{:table_cat   (:table_cat database)
+    :table_schem (:table_schem database)
+    :table_name  "widgets"
+    :column_name "id"
+    :type_name   "int"}])
+
+(deftest database-wide-queries-run-once-per-database
+  (let [calls (atom {})
+        count-call (fn [k result]
+                     (fn [& _]
+                       (swap! calls update k (fnil inc 0))
+                       result))]
+    (with-redefs [config/->conn-map                 (constantly {})
+                  catalog/get-schemas-for-db        (count-call :schemas
+                                                                (map (fn [schema] {:table_catalog "db" :table_schem schema})
+                                                                     schemas))
+                  catalog/get-table-names           (count-call :table-names ["widgets"])
+                  catalog/get-database-view-names   (count-call :views {"hr" #{"widgets"}})
+                  catalog/get-approximate-row-count (count-call :row-counts [{:schema_name "sales" :table_name "widgets" :row_count 7 :temporal_type 2}])
+                  catalog/get-primary-keys          (count-call :primary-keys [{:table_catalog "db" :table_schema "dbo"
+                                                                                :table_name "widgets" :primary_key "id"}])
+                  catalog/get-database-raw-columns  fake-columns]
+      (let [columns (catalog/get-database-columns-by-schema {} {:table_cat "db"})
+            by-schema (into {} (map (juxt :table_schem identity) columns))]
+        (is (= {:schemas 1 :table-names 1 :views 1 :row-counts 1 :primary-keys 1}
+               @calls))
+        (is (= 3 (count columns)))
+        (is (= [true false false]
+               (map (comp :primary-key? by-schema) ["dbo" "sales" "hr"])))
+        (is (= [false false true]
+               (map (comp :is-view? by-schema) ["dbo" "sales" "hr"])))
+        (is (= [false true false]
+               (map (comp :is-temporal? by-schema) ["dbo" "sales" "hr"])))
+        (is (= 7 (:approximate-row-count (by-schema "sales"))))
+        (is (= 0 (:approximate-row-count (by-schema "hr"))))))))
+
+(deftest parallel-discovery-keeps-database-and-schema-order
+  (let [databases (map (fn [n] {:table_cat (str "db" n)}) (range 6))]
+    (with-redefs [config/->conn-map                 (constantly {})
+                  catalog/get-schemas-for-db        (fn [_ database]
+                                                      (Thread/sleep (rand-int 5))
+                                                      (map (fn [schema] {:table_catalog (:table_cat database) :table_schem schema})
+                                                           schemas))
+                  catalog/get-table-names           (constantly ["widgets"])
+                  catalog/get-database-view-names   (constantly {})
+                  catalog/get-approximate-row-count (constantly [])
+                  catalog/get-primary-keys          (constantly [])
+                  catalog/get-database-raw-columns  (fn [& args]
+                                                      (Thread/sleep (rand-int 5))
+                                                      (apply fake-columns args))]
+      (is (= (catalog/get-databases-columns-by-schema {} 1 databases)
+             (catalog/get-databases-columns-by-schema {} 4 databases)))
+      (is (= (for [n (range 6) schema schemas] [(str "db" n) schema])
+             (map (juxt :table_cat :table_schem)
+                  (catalog/get-databases-columns-by-schema {} 4 databases)))))))
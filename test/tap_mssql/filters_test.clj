@@ -0,0 +1,57 @@
+(ns tap-mssql.filters-test
+  (:require [tap-mssql.filters :as filters]
+            [clojure.test :refer [is deftest]]))
+
+(deftest patterns-can-be-lists-or-comma-separated-strings
+  (is (= [] (filters/get-patterns {} "include_schemas")))
+  (is (= ["dbo" "sales_*"] (filters/get-patterns {"include_schemas" ["dbo" "sales_*"]} "include_schemas")))
+  (is (= ["dbo" "sales_*"] (filters/get-patterns {"include_schemas" " dbo, sales_*,"} "include_schemas")))
+  (is (thrown? IllegalArgumentException
+               (filters/get-patterns {"include_schemas" 42} "include_schemas"))))
+
+(deftest commas-inside-regexes-do-not-split-patterns
+  (is (= ["/^x{1,3}$/" "dbo"]
+         (filters/get-patterns {"include_schemas" "/^x{1,3}$/, dbo"} "include_schemas")))
+  (is (= ["stg_*" "/^(a|b),c$/" "/^d{2,}$/"]
+         (filters/get-patterns {"exclude_tables" "stg_*, /^(a|b),c$/,/^d{2,}$/"} "exclude_tables")))
+  (is (filters/keep-schema? (filters/->filters {"include_schemas" "/^x{1,3}$/"}) "xx")))
+
+(deftest globs-become-escaped-like-patterns
+  (is (= "stg\\_%" (filters/glob->like "stg_*")))
+  (is (= "a_b" (filters/glob->like "a?b")))
+  (is (= "100\\%\\[x]" (filters/glob->like "100%[x]"))))
+
+(deftest globs-and-regexes-match-names
+  (let [f (filters/->filters {"include_databases" ["sales" "/^hr_\\d+$/"]
+                              "include_schemas"   "dbo, report*"
+                              "exclude_tables"    ["stg_*" "/.*_archive$/"]})]
+    (is (filters/keep-database? f "SALES"))
+    (is (filters/keep-database? f "hr_2019"))
+    (is (not (filters/keep-database? f "HR_2019")))
+    (is (not (filters/keep-database? f "sales2")))
+    (is (filters/keep-object? f "dbo" "orders"))
+    (is (filters/keep-object? f "reporting" "orders"))
+    (is (not (filters/keep-object? f "archive" "orders")))
+    (is (not (filters/keep-object? f "dbo" "STG_orders")))
+    (is (not (filters/keep-object? f "dbo" "orders_archive")))))
+
+(deftest no-filters-keep-everything
+  (let [f (filters/->filters {})]
+    (is (filters/keep-database? f "anything"))
+    (is (filters/keep-object? f "any" "thing"))
+    (is (= [[] []] (filters/sql-clauses f "s.name" "o.name")))))
+
+(deftest globs-are-pushed-into-sql
+  (is (= [["(s.name COLLATE Latin1_General_100_CI_AS LIKE ? ESCAPE '\\' OR s.name COLLATE Latin1_General_100_CI_AS LIKE ? ESCAPE '\\')"
+           "o.name COLLATE Latin1_General_100_CI_AS NOT LIKE ? ESCAPE '\\'"]
+          ["dbo" "report%" "stg\\_%"]]
+         (filters/sql-clauses (filters/->filters {"include_schemas" ["dbo" "report*"]
+                                                  "exclude_tables"  ["stg_*" "/_archive$/"]})
+                              "s.name"
+                              "o.name")))
+  ;; A regex include can't be expressed in SQL, and the includes are
+  ;; alternatives, so none of them are pushed down
+  (is (= [[] []]
+         (filters/sql-clauses (filters/->filters {"include_schemas" ["dbo" "/^report/"]})
+                              "s.name"
+                              "o.name"))))
@@ -0,0 +1,76 @@
+(ns tap-mssql.multiplexer-test
+  (:require [tap-mssql.singer.messages :as singer-messages]
+            [tap-mssql.singer.multiplexer :as multiplexer]
+            [clojure.test :refer [is deftest]]
+            [clojure.string :as string]
+            [clojure.data.json :as json]))
+
+(defn fake-sync
+  "Writes a few records and states for a stream the same way a sync
+  strategy would, sleeping a little so streams interleave."
+  [state stream-name]
+  (reduce (fn [st n]
+            (Thread/sleep (rand-int 3))
+            (singer-messages/write! {"type"   "RECORD"
+                                     "stream" stream-name
+                                     "record" {"n" n}})
+            (singer-messages/write-state! stream-name
+                                          (assoc-in st ["bookmarks" stream-name "last_n"] n)))
+          state
+          (range 50)))
+
+(defn get-messages-from-output
+  [parallelism stream-names]
+  (as-> (with-out-str
+          (multiplexer/sync-streams! parallelism fake-sync {} stream-names))
+      output
+    (string/split output #"\n")
+    (filter (complement empty?) output)
+    (mapv json/read-str output)))
+
+(deftest merge-stream-state-only-takes-the-writing-streams-bookmarks
+  (is (= {"bookmarks" {"a" {"last_n" 2}
+                       "b" {"last_n" 7}}}
+         (multiplexer/merge-stream-state {"bookmarks" {"a" {"last_n" 2}
+                                                       "b" {"last_n" 1}}}
+                                         "b"
+                                         {"bookmarks" {"a" {"last_n" 0}
+                                                       "b" {"last_n" 7}}}))))
+
+(deftest parallel-streams-keep-their-own-message-order
+  (let [stream-names ["a" "b" "c" "d"]
+        messages     (get-messages-from-output 3 stream-names)]
+    (doseq [stream-name stream-names]
+      (is (= (range 50)
+             (->> messages
+                  (filter #(and (= "RECORD" (% "type"))
+                                (= stream-name (% "stream"))))
+                  (map #(get-in % ["record" "n"]))))))))
+
+(deftest parallel-streams-write-merged-states
+  (let [stream-names ["a" "b" "c"]
+        messages     (get-messages-from-output 3 stream-names)
+        states       (filter #(= "STATE" (% "type")) messages)]
+    ;; Bookmarks never go backwards and never disappear once seen
+    (is (every? (fn [[earlier later]]
+                  (every? (fn [[stream-name bookmark]]
+                            (<= (bookmark "last_n")
+                                (get-in later ["value" "bookmarks" stream-name "last_n"])))
+                          (get-in earlier ["value" "bookmarks"])))
+                (partition 2 1 states)))
+    (is (= {"a" {"last_n" 49}
+            "b" {"last_n" 49}
+            "c" {"last_n" 49}}
+           (get-in (last states) ["value" "bookmarks"])))))
+
+(deftest parallel-stream-errors-are-rethrown
+  (is (thrown-with-msg? Exception
+                        #"BOOM"
+                        (with-out-str
+                          (multiplexer/sync-streams! 2
+                                                     (fn [state stream-name]
+                                                       (when (= "b" stream-name)
+                                                         (throw (Exception. "BOOM")))
+                                                       state)
+                                                     {}
+                                                     ["a" "b" "c"])))))
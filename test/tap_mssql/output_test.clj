@@ -0,0 +1,89 @@
+(ns tap-mssql.output-test
+  (:require [tap-mssql.singer.messages :as singer-messages]
+            [tap-mssql.singer.output :as singer-output]
+            [clojure.test :refer [is deftest]]
+            [clojure.string :as string]
+            [clojure.data.json :as json])
+  (:import [java.io ByteArrayOutputStream]))
+
+(defn- written
+  [^ByteArrayOutputStream out]
+  (.toString out "UTF-8"))
+
+(defmacro with-sink
+  "Installs a sink over `out` for the body and always uninstalls it."
+  [config out & body]
+  `(do
+     (singer-output/install! ~config ~out)
+     (try
+       ~@body
+       (finally
+         (singer-output/uninstall!)))))
+
+(defn- write-line!
+  [^String line]
+  (singer-output/write-line! (fn [^java.io.Writer writer]
+                               (.write writer line))))
+
+(defn- eventually
+  "Polls `f` until it returns truthy or `timeout-ms` passes."
+  [timeout-ms f]
+  (let [deadline (+ (System/currentTimeMillis) timeout-ms)]
+    (loop []
+      (or (f)
+          (when (< (System/currentTimeMillis) deadline)
+            (Thread/sleep 10)
+            (recur))))))
+
+(deftest messages-written-through-the-sink-reach-it
+  (let [out (ByteArrayOutputStream.)]
+    (with-sink {"output_max_flush_latency_ms" 60000} out
+      (is (singer-output/installed?))
+      (singer-messages/write! {"type" "RECORD" "stream" "s" "record" {"name" "Zoë"}})
+      (singer-messages/write-state! "s" {"bookmarks" {"s" {"version" 1}}}))
+    (is (not (singer-output/installed?)))
+    (is (= [{"type" "RECORD" "stream" "s" "record" {"name" "Zoë"}}
+            {"type" "STATE" "stream" "s" "value" {"bookmarks" {"s" {"version" 1}}}}]
+           (map json/read-str (string/split-lines (written out)))))))
+
+(deftest uninstall-flushes-what-is-still-buffered
+  (let [out (ByteArrayOutputStream.)]
+    (with-sink {"output_max_flush_latency_ms" 60000} out
+      (write-line! "one")
+      (write-line! "two")
+      ;; Nowhere near full and not stale, so nothing has been flushed yet
+      (is (= "" (written out))))
+    (is (= "one\ntwo\n" (written out)))))
+
+(deftest lines-are-flushed-by-the-latency-timer
+  (let [out (ByteArrayOutputStream.)]
+    (with-sink {"output_max_flush_latency_ms" 50} out
+      (write-line! "waiting")
+      ;; Nothing else is written, so only the timer can flush it
+      (is (eventually 5000 #(= "waiting\n" (written out)))))))
+
+(deftest lines-are-flushed-when-the-buffer-fills
+  (let [out  (ByteArrayOutputStream.)
+        line (apply str (repeat 1000 "x"))]
+    (with-sink {"output_buffer_size"          1024
+                "output_max_flush_latency_ms" 60000}
+      out
+      ;; Well past the buffer, and the writer's own encoding buffer
+      (dotimes [_ 100]
+        (write-line! line))
+      (is (<= (* 90 1001) (count (written out))))
+      (is (string/starts-with? (written out) (str line "\n"))))
+    (is (= (* 100 1001) (count (written out))))))
+
+(deftest installing-again-replaces-the-sink
+  (let [first-out  (ByteArrayOutputStream.)
+        second-out (ByteArrayOutputStream.)
+        first-sink (singer-output/install! {"output_max_flush_latency_ms" 60000} first-out)]
+    (write-line! "first")
+    (with-sink {"output_max_flush_latency_ms" 60000} second-out
+      (write-line! "second"))
+    (is (.isShutdown ^java.util.concurrent.ExecutorService (:flusher first-sink)))
+    (is (= "first\n" (written first-out)))
+    (is (= "second\n" (written second-out)))
+    ;; A single shutdown hook serves every sink
+    (is (realized? @#'singer-output/flush-on-shutdown))))
@@ -0,0 +1,101 @@
+(ns tap-mssql.pipeline-test
+  (:require [tap-mssql.singer.messages :as singer-messages]
+            [tap-mssql.singer.pipeline :as singer-pipeline]
+            [clojure.test :refer [is deftest]]
+            [clojure.string :as string]
+            [clojure.data.json :as json]))
+
+(def catalog {"streams" {"s" {"table_name" "s"
+                              "metadata"   {"properties" {"id"   {"sql-datatype" "int"}
+                                                          "name" {"sql-datatype" "varchar"}}}}}})
+
+(def rows (mapv (fn [n] {"id" n "name" (str "row " n) "ignored" true})
+                (range 2500)))
+
+(defn sync-rows
+  [config]
+  (reset! singer-messages/records-since-last-state 0)
+  (let [final-state (atom nil)
+        output      (with-out-str
+                      (reset! final-state
+                              (singer-pipeline/reduce-records!
+                               config
+                               catalog
+                               "s"
+                               (fn [row] [(select-keys row ["id" "name"]) (row "id")])
+                               (fn [state _ id]
+                                 (->> (assoc-in state ["bookmarks" "s" "last_id"] id)
+                                      (singer-messages/write-state-buffered! "s")))
+                               {"bookmarks" {"s" {"version" 1}}}
+                               rows)))]
+    [@final-state
+     (->> (string/split output #"\n")
+          (remove empty?)
+          (mapv json/read-str))]))
+
+(deftest pipelined-output-matches-serial-output
+  (let [serial    (sync-rows {})
+        pipelined (sync-rows {"pipeline_serializer_threads" 4})]
+    (is (= serial pipelined))
+    (is (= (range 2500)
+           (->> (second pipelined)
+                (filter #(= "RECORD" (% "type")))
+                (map #(get-in % ["record" "id"])))))
+    (is (= 2499 (get-in (first pipelined) ["bookmarks" "s" "last_id"])))))
+
+(deftest pipelined-reader-errors-are-rethrown
+  (is (thrown-with-msg? Exception
+                        #"BOOM"
+                        (with-out-str
+                          (singer-pipeline/reduce-records!
+                           {"pipeline_serializer_threads" 2}
+                           catalog
+                           "s"
+                           (fn [row]
+                             (when (= 1500 (row "id"))
+                               (throw (Exception. "BOOM")))
+                             [(select-keys row ["id" "name"])])
+                           (fn [state _ _] state)
+                           {}
+                           rows)))))
+
+(deftest pipelined-timings-are-logged-once-per-stream
+  ;; Clears what the other tests left
+  (singer-pipeline/log-stream-timings! "s")
+  (sync-rows {"pipeline_serializer_threads" 2})
+  (sync-rows {"pipeline_serializer_threads" 2})
+  (is (= 5000 (get-in @@#'singer-pipeline/stream-timings ["s" :records])))
+  (singer-pipeline/log-stream-timings! "s")
+  (is (not (contains? @@#'singer-pipeline/stream-timings "s"))))
+
+(defn- interrupt-swallowing-rows
+  "Endless rows that clear the interrupt flag, like a JDBC driver that
+  swallows it, and deliver `closed` when the reduce over them ends."
+  [closed]
+  (reify clojure.lang.IReduceInit
+    (reduce [_ f init]
+      (try
+        (loop [acc init
+               n   0]
+          (Thread/interrupted)
+          (let [acc (f acc {"id" n "name" (str "row " n)})]
+            (if (reduced? acc)
+              @acc
+              (recur acc (inc n)))))
+        (finally
+          (deliver closed true))))))
+
+(deftest pipelined-reader-stops-when-the-writer-gives-up
+  (let [closed (promise)]
+    (is (thrown-with-msg? Exception
+                          #"BOOM"
+                          (with-out-str
+                            (singer-pipeline/reduce-records!
+                             {"pipeline_serializer_threads" 2}
+                             catalog
+                             "s"
+                             (fn [row] [(select-keys row ["id" "name"])])
+                             (fn [state _ _] (throw (Exception. "BOOM")))
+                             {}
+                             (interrupt-swallowing-rows closed)))))
+    (is (deref closed 5000 false))))
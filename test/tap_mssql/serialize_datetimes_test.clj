@@ -0,0 +1,109 @@
+(ns tap-mssql.serialize-datetimes-test
+  (:require [tap-mssql.singer.messages :as singer-messages]
+            [tap-mssql.singer.serializer :as singer-serializer]
+            [clojure.test :refer [is deftest]]
+            [clojure.data.json :as json]
+            [clojure.data.generators :as generators])
+  (:import [java.time LocalDate LocalDateTime LocalTime]))
+
+;;; The formatter `serialize-datetimes` used before datetimes were written
+;;; digit by digit. The fast path has to agree with it everywhere.
+
+(def df (-> (java.time.format.DateTimeFormatterBuilder.)
+            (.appendPattern "yyyy-MM-dd'T'HH:mm:ss.SSSSSSX")
+            (.toFormatter)))
+
+(defn reference-timestamp->string [ts]
+  (-> ts
+      (.toLocalDateTime)
+      (.atOffset java.time.ZoneOffset/UTC)
+      (.format df)
+      (.replace "000Z" "Z")
+      (.replace ".000Z" "Z")))
+
+(def iterations 20000)
+
+(defn random-local-date
+  [^LocalDate from ^LocalDate to]
+  (LocalDate/ofEpochDay (generators/uniform (.toEpochDay from)
+                                            (inc (.toEpochDay to)))))
+
+(defn random-nanos
+  "Nanosecond fractions of a second in 100ns ticks, often landing on whole
+  milliseconds or whole seconds to exercise the trimmed forms."
+  []
+  (case (generators/uniform 0 3)
+    0 0
+    1 (* 1000000 (generators/uniform 0 1000))
+    2 (* 100 (generators/uniform 0 10000000))))
+
+(defn random-timestamp
+  [from to]
+  (java.sql.Timestamp/valueOf
+   (LocalDateTime/of (random-local-date from to)
+                     (LocalTime/ofNanoOfDay (+ (* 1000000000 (generators/uniform 0 86400))
+                                               (random-nanos))))))
+
+(def column-ranges
+  ;; From the value ranges documented above `serialize-datetimes`
+  {"datetime"       [(LocalDate/of 1753 1 1) (LocalDate/of 9999 12 31)]
+   "datetime2"      [(LocalDate/of 1 1 1) (LocalDate/of 9999 12 31)]
+   "datetimeoffset" [(LocalDate/of 1 1 1) (LocalDate/of 9999 12 31)]
+   "smalldatetime"  [(LocalDate/of 1900 1 1) (LocalDate/of 2079 6 6)]})
+
+(defmacro with-fixed-seed
+  [& body]
+  `(binding [generators/*rnd* (java.util.Random. 8675309)]
+     ~@body))
+
+(deftest timestamps-match-the-reference-formatter
+  (with-fixed-seed
+    (doseq [[column-type [from to]] column-ranges]
+      (dotimes [_ iterations]
+        (let [ts (random-timestamp from to)]
+          (is (= (reference-timestamp->string ts)
+                 (singer-messages/serialize-datetimes column-type ts))
+              (str column-type " " ts)))))))
+
+(deftest datetimeoffsets-match-the-reference-formatter
+  (with-fixed-seed
+    (let [[from to] (column-ranges "datetimeoffset")]
+      (dotimes [_ iterations]
+        (let [ts     (random-timestamp from to)
+              offset (microsoft.sql.DateTimeOffset/valueOf ts (int (generators/uniform -840 841)))]
+          (is (= (reference-timestamp->string (.getTimestamp offset))
+                 (singer-messages/serialize-datetimes "datetimeoffset" offset))
+              (str offset)))))))
+
+(deftest dates-and-times-match-to-string
+  (with-fixed-seed
+    (dotimes [_ iterations]
+      (let [date (java.sql.Date/valueOf (random-local-date (LocalDate/of 1 1 1) (LocalDate/of 9999 12 31)))
+            time (java.sql.Time/valueOf (LocalTime/ofSecondOfDay (generators/uniform 0 86400)))]
+        (is (= (.toString date) (singer-messages/serialize-datetimes "date" date)))
+        (is (= (.toString time) (singer-messages/serialize-datetimes "time" time)))))))
+
+(deftest range-boundaries-match-the-reference-formatter
+  (doseq [ldt [(LocalDateTime/of 1 1 1 0 0 0 0)
+               (LocalDateTime/of 1582 10 4 23 59 59 999999900)
+               (LocalDateTime/of 1582 10 15 0 0 0 0)
+               (LocalDateTime/of 1753 1 1 0 0 0 3000000)
+               (LocalDateTime/of 2079 6 6 23 59 0 0)
+               (LocalDateTime/of 9999 12 31 23 59 59 997000000)
+               (LocalDateTime/of 9999 12 31 23 59 59 999999900)
+               (LocalDateTime/of 2019 8 8 12 0 0 120000000)
+               (LocalDateTime/of 2019 8 8 12 0 0 123000)]]
+    (let [ts (java.sql.Timestamp/valueOf ldt)]
+      (is (= (reference-timestamp->string ts)
+             (singer-messages/serialize-datetimes "datetime2" ts))
+          (str ldt)))))
+
+(deftest compiled-serializer-writes-the-same-datetimes
+  (let [catalog    {"streams" {"s" {"metadata" {"properties" {"at" {"sql-datatype" "datetime2"}}}}}}
+        serializer (singer-serializer/compile-record-serializer catalog "s" "s" singer-messages/serialize-datetimes)]
+    (with-fixed-seed
+      (dotimes [_ 1000]
+        (let [ts (random-timestamp (LocalDate/of 1 1 1) (LocalDate/of 9999 12 31))]
+          (is (= (reference-timestamp->string ts)
+                 (get-in (json/read-str (singer-serializer/serialize-record serializer {"at" ts} nil))
+                         ["record" "at"]))))))))
@@ -0,0 +1,149 @@
+(ns tap-mssql.serializer-test
+  (:require [tap-mssql.singer.messages :as singer-messages]
+            [tap-mssql.singer.serializer :as singer-serializer]
+            [tap-mssql.singer.transform :as singer-transform]
+            [clojure.test :refer [is deftest]]
+            [clojure.string :as string]
+            [clojure.data.json :as json]))
+
+(def stream-name "test_dbo_records")
+
+(def catalog
+  {"streams" {stream-name {"metadata" {"properties" {"id"       {"sql-datatype" "int identity" "selected" true}
+                                                    "big"      {"sql-datatype" "bigint" "selected" true}
+                                                    "flag"     {"sql-datatype" "bit" "selected" true}
+                                                    "name"     {"sql-datatype" "nvarchar" "selected" true}
+                                                    "uuid"     {"sql-datatype" "uniqueidentifier" "selected" true}
+                                                    "price"    {"sql-datatype" "decimal" "selected" true}
+                                                    "ratio"    {"sql-datatype" "float" "selected" true}
+                                                    "payload"  {"sql-datatype" "varbinary" "selected" true}
+                                                    "rv"       {"sql-datatype" "timestamp" "selected" true}
+                                                    "born_on"  {"sql-datatype" "date" "selected" true}
+                                                    "seen_at"  {"sql-datatype" "datetime2" "selected" true}
+                                                    "seen_off" {"sql-datatype" "datetimeoffset" "selected" true}
+                                                    "at_time"  {"sql-datatype" "time" "selected" true}
+                                                    "born_at"  {"sql-datatype" "date" "selected" false}}}}}})
+
+(def record
+  {"id"       42
+   "big"      9223372036854775807
+   "flag"     true
+   "name"     "quote \" slash / back \\ tab \t newline \n snowman ☃"
+   "uuid"     "6F9619FF-8B86-D011-B42D-00C04FC964FF"
+   "price"    (bigdec "12345.6789")
+   "ratio"    0.25
+   "payload"  (byte-array [0 1 127 -128 -1])
+   "rv"       (byte-array [0 0 0 0 0 0 0 10])
+   "born_on"  (java.sql.Date. 1565222400000)
+   "seen_at"  (java.sql.Timestamp. 1565222400123)
+   "seen_off" (microsoft.sql.DateTimeOffset/valueOf (java.sql.Timestamp. 1565222400123) 60)
+   "at_time"  (java.sql.Time. 3723000)})
+
+(defn current-path
+  "How records were written before serializers were compiled."
+  [record version]
+  (json/write-str (cond-> {"type"   "RECORD"
+                           "stream" stream-name
+                           "record" (singer-transform/transform catalog stream-name record)}
+                    version (assoc "version" version))
+                  :value-fn singer-messages/serialize-datetimes))
+
+(def ^:private baseline-datetime-formatter
+  (-> (java.time.format.DateTimeFormatterBuilder.)
+      (.appendPattern "yyyy-MM-dd'T'HH:mm:ss.SSSSSSX")
+      (.toFormatter)))
+
+(defn- baseline-timestamp->string
+  [^java.sql.Timestamp ts]
+  (-> (.toLocalDateTime ts)
+      (.atOffset java.time.ZoneOffset/UTC)
+      (.format baseline-datetime-formatter)
+      (.replace "000Z" "Z")
+      (.replace ".000Z" "Z")))
+
+(defn baseline-path
+  "How records were written before any of the serialization work: every
+  field transformed through a catalog lookup and the message encoded by
+  `json/write-str`, formatting datetimes with a DateTimeFormatter."
+  [record version]
+  (json/write-str (cond-> {"type"   "RECORD"
+                           "stream" stream-name
+                           "record" (into {}
+                                          (map (fn [[k v]]
+                                                 (case (get-in catalog ["streams" stream-name "metadata" "properties" k "sql-datatype"])
+                                                   ("timestamp" "varbinary" "binary")
+                                                   [k (when v
+                                                        (apply str "0x" (map (comp string/upper-case
+                                                                                   (partial format "%02x"))
+                                                                             v)))]
+                                                   "date"
+                                                   [k (when v (str v "T00:00:00+00:00"))]
+                                                   [k v])))
+                                          record)}
+                    version (assoc "version" version))
+                  :value-fn (fn [_ v]
+                              (condp instance? v
+                                java.sql.Timestamp           (baseline-timestamp->string v)
+                                microsoft.sql.DateTimeOffset (baseline-timestamp->string (.getTimestamp ^microsoft.sql.DateTimeOffset v))
+                                java.sql.Time                (str v)
+                                v))))
+
+(defn compiled-path
+  [record version]
+  (singer-serializer/serialize-record
+   (singer-serializer/record-serializer catalog stream-name stream-name singer-messages/serialize-datetimes)
+   record
+   version))
+
+(deftest compiled-serializer-matches-current-path
+  (is (= (json/read-str (current-path record 1560363676948))
+         (json/read-str (compiled-path record 1560363676948))))
+  (is (= (json/read-str (current-path record nil))
+         (json/read-str (compiled-path record nil)))))
+
+(deftest compiled-serializer-writes-deselected-fields-by-their-type
+  (let [record (assoc record "born_at" (java.sql.Date. 1565222400000))]
+    (is (= (json/read-str (current-path record 1))
+           (json/read-str (compiled-path record 1))))
+    (is (= "2019-08-08T00:00:00+00:00"
+           (get-in (json/read-str (compiled-path record 1)) ["record" "born_at"])))))
+
+(deftest compiled-serializer-writes-nulls-and-unknown-fields
+  (let [record (assoc (zipmap (keys record) (repeat nil))
+                      "_sdc_deleted_at" (java.sql.Timestamp. 1565222400000))]
+    (is (= (json/read-str (current-path record 1))
+           (json/read-str (compiled-path record 1))))))
+
+(deftest date-columns-that-are-not-sql-dates-are-written-with-str
+  (doseq [born-on ["2019-08-08" (java.time.LocalDate/of 2019 8 8)]]
+    (let [record (assoc record "born_on" born-on)]
+      (is (= "2019-08-08T00:00:00+00:00"
+             (get-in (json/read-str (compiled-path record 1)) ["record" "born_on"])))
+      (is (= (json/read-str (current-path record 1))
+             (json/read-str (compiled-path record 1)))))))
+
+(deftest compiled-serializer-escapes-strings-like-data-json
+  (let [s "quote \" slash / back \\ ctrl \u0001 del \u007f snowman ☃"]
+    (is (= (json/write-str s)
+           (let [writer (java.io.StringWriter.)]
+             (singer-serializer/write-json-string writer s)
+             (str writer))))))
+
+(defn- time-ms
+  [n f]
+  (let [start (System/nanoTime)]
+    (dotimes [_ n] (f))
+    (/ (- (System/nanoTime) start) 1e6)))
+
+(deftest ^:benchmark compiled-serializer-benchmark
+  (let [n        100000
+        _warm-up (dotimes [_ 20000]
+                   (baseline-path record 1)
+                   (compiled-path record 1))
+        baseline (time-ms n #(baseline-path record 1))
+        compiled (time-ms n #(compiled-path record 1))]
+    (is (= (json/read-str (baseline-path record 1))
+           (json/read-str (compiled-path record 1))))
+    (println (format "Serialized %d records: baseline json/write-str path %.0f ms, compiled serializer %.0f ms (%.1fx)"
+                     n baseline compiled (/ baseline compiled)))
+    (is (< compiled baseline))))
@@ -0,0 +1,170 @@
+(ns tap-mssql.sync-cdc-test
+  (:require [tap-mssql.catalog :as catalog]
+            [tap-mssql.config :as config]
+            [clojure.test :refer [is deftest]]
+            [clojure.java.jdbc :as jdbc]
+            [clojure.data.json :as json]
+            [clojure.string :as string]
+            [tap-mssql.core :refer :all]
+            [tap-mssql.sync-strategies.common :as common]
+            [tap-mssql.sync-strategies.cdc :as cdc]
+            [tap-mssql.sync-strategies.full :as full]
+            [tap-mssql.test-utils :refer [with-out-and-err-to-dev-null
+                                          test-db-config
+                                          test-db-configs
+                                          with-matrix-assertions]]))
+
+(defn get-destroy-database-command
+  [database]
+  (format "DROP DATABASE %s" (:table_cat database)))
+
+(defn maybe-destroy-test-db
+  [config]
+  (let [destroy-database-commands (->> (catalog/get-databases config)
+                                       (filter catalog/non-system-database?)
+                                       (map get-destroy-database-command))]
+    (let [db-spec (config/->conn-map config)]
+      (jdbc/db-do-commands db-spec destroy-database-commands))))
+
+(defn create-test-db
+  [config]
+  (let [db-spec (config/->conn-map config)]
+    (jdbc/db-do-commands db-spec ["CREATE DATABASE cdc_sync_test"])
+    (jdbc/db-do-commands (assoc db-spec :dbname "cdc_sync_test")
+                         [(jdbc/create-table-ddl
+                           "data_table"
+                           [[:id "int NOT NULL PRIMARY KEY"]
+                            [:value "int"]])])))
+
+(defn test-db-fixture [f config]
+  (with-out-and-err-to-dev-null
+    (maybe-destroy-test-db config)
+    (create-test-db config)
+    (f)))
+
+(defn create-cdc-enabled-test-db
+  [config]
+  (let [db-spec (assoc (config/->conn-map config) :dbname "cdc_enabled_sync_test")]
+    (jdbc/db-do-commands (config/->conn-map config) ["CREATE DATABASE cdc_enabled_sync_test"])
+    (jdbc/db-do-commands db-spec
+                         [(jdbc/create-table-ddl
+                           "data_table"
+                           [[:id "int NOT NULL PRIMARY KEY"]
+                            [:value "int"]])])
+    (jdbc/execute! db-spec ["EXEC sys.sp_cdc_enable_db"])
+    (jdbc/execute! db-spec [(str "EXEC sys.sp_cdc_enable_table @source_schema = N'dbo', "
+                                 "@source_name = N'data_table', @role_name = NULL")])
+    (jdbc/insert-multi! db-spec "data_table" (map #(hash-map :id % :value %) (range 10)))))
+
+(defn cdc-enabled-test-db-fixture [f config]
+  (with-out-and-err-to-dev-null
+    (maybe-destroy-test-db config)
+    (create-cdc-enabled-test-db config)
+    (f)))
+
+(defn get-messages-from-output
+  [config catalog state]
+  (as-> (with-out-str
+          (do-sync config catalog state))
+      output
+      (string/split output #"\n")
+      (filter (complement empty?) output)
+      (map json/read-str output)
+      (vec output)))
+
+(deftest build-cdc-sql-query-test
+  (let [[sql & params] (cdc/build-cdc-sql-query (cdc/get-change-function {})
+                                                "dbo_data_table"
+                                                ["id" "value"]
+                                                "0x0000002A000000100003"
+                                                "0x0000002A000001000001")]
+    (is (= (str "SELECT [__$start_lsn], [__$operation], "
+                "sys.fn_cdc_map_lsn_to_time([__$start_lsn]) AS commit_time, [id], [value] "
+                "FROM cdc.[fn_cdc_get_all_changes_dbo_data_table](sys.fn_cdc_increment_lsn(?), ?, N'all') "
+                "ORDER BY [__$start_lsn], [__$seqval], [__$operation]")
+           sql))
+    (is (= ["0x0000002A000000100003" "0x0000002A000001000001"]
+           (map common/bytes->hex params))))
+  (let [[sql] (cdc/build-cdc-sql-query (cdc/get-change-function {"cdc_changes" "net"})
+                                       "dbo_data_table"
+                                       ["id"]
+                                       "0x0000002A000000100003"
+                                       "0x0000002A000001000001")]
+    (is (= (str "SELECT [__$start_lsn], [__$operation], "
+                "sys.fn_cdc_map_lsn_to_time([__$start_lsn]) AS commit_time, [id] "
+                "FROM cdc.[fn_cdc_get_net_changes_dbo_data_table](sys.fn_cdc_increment_lsn(?), ?, N'all') "
+                "ORDER BY [__$start_lsn]")
+           sql)))
+  (is (thrown? IllegalArgumentException
+               (cdc/get-change-function {"cdc_changes" "some"}))))
+
+(deftest ^:integration verify-cdc-sync-requires-cdc-enabled-database
+  (with-matrix-assertions test-db-configs test-db-fixture
+    (is (thrown? UnsupportedOperationException
+                 (get-messages-from-output test-db-config
+                                           (-> (catalog/discover test-db-config)
+                                               (assoc-in ["streams" "cdc_sync_test_dbo_data_table" "metadata" "selected"] true)
+                                               (assoc-in ["streams" "cdc_sync_test_dbo_data_table" "metadata" "replication-method"] "CDC"))
+                                           {})))))
+
+(def cdc-stream-name "cdc_enabled_sync_test_dbo_data_table")
+
+;; The bookmark is below the low water LSN, so the changes after it have
+;; been cleaned up. The LSN range is the same at the low water and max LSN,
+;; so there are no changes to read after the resync.
+(def cleaned-up-lsn-range {:low-water-lsn "0x00000000000000000010"
+                           :max-lsn       "0x00000000000000000010"})
+
+(def cleaned-up-state {"bookmarks" {cdc-stream-name {"version"                     1
+                                                     "cdc_lsn"                     "0x00000000000000000001"
+                                                     "initial_full_table_complete" true}}})
+
+(defn- cdc-catalog
+  [config]
+  (-> (catalog/discover config)
+      (assoc-in ["streams" cdc-stream-name "metadata" "selected"] true)
+      (assoc-in ["streams" cdc-stream-name "metadata" "replication-method"] "CDC")))
+
+(defn- bookmark
+  [messages]
+  (->> messages
+       (filter #(= "STATE" (% "type")))
+       last
+       (#(get-in % ["value" "bookmarks" cdc-stream-name]))))
+
+(deftest ^:integration verify-cdc-resyncs-when-changes-were-cleaned-up
+  (with-matrix-assertions test-db-configs cdc-enabled-test-db-fixture
+    (with-redefs [cdc/get-lsn-range (constantly cleaned-up-lsn-range)]
+      (let [messages (get-messages-from-output test-db-config (cdc-catalog test-db-config) cleaned-up-state)]
+        (is (= (range 10)
+               (->> messages
+                    (filter #(= "RECORD" (% "type")))
+                    (map #(get-in % ["record" "id"]))
+                    sort)))
+        (is (= {"cdc_lsn"                     "0x00000000000000000010"
+                "initial_full_table_complete" true}
+               (select-keys (bookmark messages) ["cdc_lsn" "initial_full_table_complete" "initial_full_table_lsn"])))))))
+
+(deftest ^:integration verify-interrupted-cdc-resync-is-not-skipped
+  (with-matrix-assertions test-db-configs cdc-enabled-test-db-fixture
+    (with-redefs [cdc/get-lsn-range (constantly cleaned-up-lsn-range)]
+      (let [catalog           (cdc-catalog test-db-config)
+            interrupted-state (as-> (with-out-str
+                                      (with-redefs [full/sync! (fn [& _] (throw (ex-info "Interrupted" {})))]
+                                        (try
+                                          (do-sync test-db-config catalog cleaned-up-state)
+                                          (catch Exception _))))
+                                  output
+                                (string/split output #"\n")
+                                (filter (complement empty?) output)
+                                (map json/read-str output)
+                                (bookmark output))]
+        ;; The new LSN is not bookmarked until the resync finishes
+        (is (= false (get interrupted-state "initial_full_table_complete")))
+        (is (= "0x00000000000000000001" (get interrupted-state "cdc_lsn")))
+        (let [messages (get-messages-from-output test-db-config
+                                                 catalog
+                                                 {"bookmarks" {cdc-stream-name interrupted-state}})]
+          (is (= 10 (count (filter #(= "RECORD" (% "type")) messages))))
+          (is (= "0x00000000000000000010" (get (bookmark messages) "cdc_lsn")))
+          (is (= true (get (bookmark messages) "initial_full_table_complete"))))))))
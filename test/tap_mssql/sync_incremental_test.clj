@@ -8,6 +8,7 @@
             [clojure.string :as string]
             [tap-mssql.core :refer :all]
             [tap-mssql.sync-strategies.incremental :as incremental]
+            [tap-mssql.singer.messages :as singer-messages]
             [tap-mssql.test-utils :refer [with-out-and-err-to-dev-null
                                           test-db-config
                                           test-db-configs
@@ -147,6 +148,65 @@
                       count)))
         (is (= 404 (get-in end-state ["value" "bookmarks" "incremental_sync_test_dbo_data_table" "replication_key_value"])))))))
 
+(deftest ^:integration verify-incremental-pk-tiebreaker-skips-rows-already-read
+  (with-matrix-assertions test-db-configs test-db-fixture
+    ;; Four values of 50 rows each
+    (jdbc/db-do-commands (assoc (config/->conn-map test-db-config) :dbname "incremental_sync_test")
+                         ["UPDATE dbo.data_table SET other_value = value / 50"])
+    (let [config           (assoc test-db-config "incremental_pk_tiebreaker" "true")
+          selected-catalog (->> (catalog/discover config)
+                                (select-stream "incremental_sync_test_dbo_data_table")
+                                (set-replication-key "incremental_sync_test_dbo_data_table" "other_value"))
+          records          (fn [messages]
+                             (filter #(= "RECORD" (% "type")) messages))
+          end-state        (fn [messages]
+                             (->> messages
+                                  (filter #(= "STATE" (% "type")))
+                                  last
+                                  (#(get % "value"))))
+          first-messages   (get-messages-from-output config nil selected-catalog)]
+      (is (= 200 (count (records first-messages))))
+      (is (= 3 (get-in (end-state first-messages)
+                       ["bookmarks" "incremental_sync_test_dbo_data_table" "replication_key_value"])))
+      (is (= #{"id"} (set (keys (get-in (end-state first-messages)
+                                        ["bookmarks" "incremental_sync_test_dbo_data_table" "replication_key_pk"])))))
+      ;; The 50 rows sharing the bookmarked value are not read again
+      (let [second-messages (get-messages-from-output config nil (end-state first-messages) selected-catalog)]
+        (is (empty? (records second-messages)))
+        (jdbc/db-do-commands (assoc (config/->conn-map config) :dbname "incremental_sync_test")
+                             ["INSERT INTO dbo.data_table (value, other_value) VALUES (404, 3)"])
+        (is (= [404]
+               (->> (get-messages-from-output config nil (end-state second-messages) selected-catalog)
+                    records
+                    (map #(get-in % ["record" "value"])))))))))
+
+(deftest ^:integration verify-incremental-backfill-reads-in-windows
+  (with-matrix-assertions test-db-configs test-db-fixture
+    (let [config           (assoc test-db-config "incremental_backfill_window" "50")
+          selected-catalog (->> (catalog/discover config)
+                                (select-stream "incremental_sync_test_dbo_data_table")
+                                (set-replication-key "incremental_sync_test_dbo_data_table" "value"))
+          first-messages   (get-messages-from-output config nil selected-catalog)
+          bookmarks        (->> first-messages
+                                (filter #(= "STATE" (% "type")))
+                                (map #(get-in % ["value" "bookmarks" "incremental_sync_test_dbo_data_table"])))]
+      ;; The rows written since the backfill started are read after it
+      ;; with >=, which reads the last value again
+      (is (= (concat (range 200) [199])
+             (->> first-messages
+                  (filter #(= "RECORD" (% "type")))
+                  (map #(get-in % ["record" "value"])))))
+      ;; One frontier per window read
+      (is (= [50 100 150 200]
+             (->> bookmarks (keep #(get % "backfill_frontier")) distinct)))
+      (is (= 199 (get (last bookmarks) "replication_key_value")))
+      (is (not (contains? (last bookmarks) "backfill_max")))
+      ;; Once backfilled, the stream syncs as usual
+      (is (= [199]
+             (->> (get-messages-from-output config nil {"bookmarks" {"incremental_sync_test_dbo_data_table" (last bookmarks)}} selected-catalog)
+                  (filter #(= "RECORD" (% "type")))
+                  (map #(get-in % ["record" "value"]))))))))
+
 (deftest ^:integration verify-changing-replication-key-resyncs-table
   (with-matrix-assertions test-db-configs test-db-fixture
     (let [selected-catalog (->> (catalog/discover test-db-config)
@@ -252,3 +312,53 @@
                                                      replication-key
                                                      state))))
   )
+
+(deftest test-build-incremental-sync-query-with-tiebreaker
+  (let [stream-name "incremental_sync_test_dbo_data_table"
+        state       {"bookmarks"
+                     {stream-name
+                      {"version"               1
+                       "replication_key_value" "2019-08-29"
+                       "replication_key_name"  "updated_on"
+                       "replication_key_pk"    {"id" 7 "line" 2}}}}]
+    (is (= "id > ? OR (id = ? AND line > ?)"
+           (incremental/build-seek-clause ["id" "line"])))
+    (is (= '("SELECT [value], [updated_on], [id], [line] FROM [dbo].[data_table] WHERE [updated_on] > ? OR ([updated_on] = ? AND ([id] > ? OR ([id] = ? AND [line] > ?))) ORDER BY [updated_on], [id], [line]"
+             "2019-08-29" "2019-08-29" 7 7 2)
+           (incremental/build-incremental-sync-query stream-name "dbo" "data_table" ["value" "updated_on"] "updated_on" state ["id" "line"])))
+    ;; A bookmark without the keys, e.g. from before the tiebreaker was
+    ;; turned on, is read from inclusively
+    (is (= '("SELECT [value], [updated_on], [id] FROM [dbo].[data_table] WHERE [updated_on] >= ? ORDER BY [updated_on], [id]"
+             "2019-08-29")
+           (incremental/build-incremental-sync-query stream-name "dbo" "data_table" ["value" "updated_on"] "updated_on"
+                                                     (update-in state ["bookmarks" stream-name] dissoc "replication_key_pk")
+                                                     ["id"])))))
+
+(deftest test-build-backfill-queries
+  (is (= "MIN([value]) + ?" (incremental/build-window-end-expression "int identity" "value")))
+  (is (= "DATEADD(day, ?, MIN([updated_on]))" (incremental/build-window-end-expression "datetime2" "updated_on")))
+  (is (nil? (incremental/build-window-end-expression "varchar" "name")))
+  (is (= ["SELECT MIN([value]) AS window_start, MIN([value]) + ? AS window_end FROM [dbo].[data_table] WHERE [value] <= ? AND [value] >= ?"
+          50 199 100]
+         (incremental/build-backfill-window-query "dbo" "data_table" "value" "MIN([value]) + ?" 100 199 50)))
+  (is (= ["SELECT MIN([value]) AS window_start, MIN([value]) + ? AS window_end FROM [dbo].[data_table] WHERE [value] <= ?"
+          50 199]
+         (incremental/build-backfill-window-query "dbo" "data_table" "value" "MIN([value]) + ?" nil 199 50)))
+  (is (= ["SELECT [id], [value] FROM [dbo].[data_table] WHERE [value] >= ? AND [value] < ? AND [value] <= ? ORDER BY [value], [id]"
+          100 150 199]
+         (incremental/build-backfill-sync-query "dbo" "data_table" ["id" "value"] "value" ["id"] 100 150 199))))
+
+(deftest rowversion-tiebreakers-survive-serialized-state
+  (let [stream-name "incremental_sync_test_dbo_keyless_table"
+        rowversion  (byte-array (map unchecked-byte [0 0 0 0 0 0 0x07 0xD1]))
+        state       (-> {"bookmarks"
+                         {stream-name
+                          {"replication_key_value" 5
+                           "replication_key_name"  "value"
+                           "replication_key_pk"    {"rv" rowversion}}}}
+                        singer-messages/serialize
+                        json/read-str)
+        [_ & params] (incremental/build-incremental-sync-query stream-name "dbo" "keyless_table" ["value"] "value" state ["rv"])]
+    (is (= [5 5] (take 2 params)))
+    (is (bytes? (last params)))
+    (is (= (seq rowversion) (seq (last params))))))
@@ -203,6 +203,26 @@
                                   #{})
                        (get-messages-from-output test-db-config nil))))))
 
+(deftest excluding-filter-names-the-setting-that-excludes-a-table
+  (is (nil? (logical/get-excluding-filter {} "db" "dbo" "data_table")))
+  (is (= "include_databases"
+         (logical/get-excluding-filter {"include_databases" "other"} "db" "dbo" "data_table")))
+  (is (= "include_schemas"
+         (logical/get-excluding-filter {"include_schemas" "sales"} "db" "dbo" "data_table")))
+  (is (= "exclude_tables"
+         (logical/get-excluding-filter {"exclude_tables" "DATA_*"} "db" "dbo" "data_table"))))
+
+(deftest ^:integration verify-log-based-replication-throws-if-table-is-excluded
+  (with-matrix-assertions test-db-configs null-fixture
+    (do (maybe-destroy-test-db test-db-config)
+        (create-test-db test-db-config)
+        (setup-change-tracking-for-database test-db-config)
+        (setup-change-tracking-for-table test-db-config))
+    (is (thrown-with-msg? UnsupportedOperationException #"excluded by exclude_tables"
+                          (-> (catalog/discover test-db-config)
+                              (select-stream "log_based_sync_test_dbo_data_table" "LOG_BASED")
+                              (get-messages-from-output (assoc test-db-config "exclude_tables" "data_*") nil))))))
+
 (deftest ^:integration verify-log-based-replication-performs-initial-full-table
   ;; TODO: Fixture might need to have another function appended to set up change tracking
   (with-matrix-assertions test-db-configs test-db-fixture
@@ -515,3 +535,138 @@
                      (get-messages-from-output test-db-config nil test-state)
                      ((partial filter #(= "RECORD" (% "type"))))
                      count))))))))
+
+(deftest ^:integration verify-log-based-replication-in-version-windows
+  (with-matrix-assertions test-db-configs test-db-fixture
+    ;; One change tracking version per insert
+    (doseq [value (range 100 105)]
+      (jdbc/insert! (assoc (config/->conn-map test-db-config)
+                           :dbname "log_based_sync_test")
+                    "dbo.data_table"
+                    {:value value}))
+    (let [test-state {"bookmarks"
+                      {"log_based_sync_test_dbo_data_table"
+                       {"version"                     1560965962084
+                        "initial_full_table_complete" true
+                        "current_log_version"         0}}}
+          catalog    (-> (catalog/discover test-db-config)
+                         (select-stream "log_based_sync_test_dbo_data_table" "LOG_BASED"))
+          of-type    (fn [message-type messages]
+                       (filter #(= message-type (% "type")) messages))
+          unwindowed (get-messages-from-output catalog test-db-config nil test-state)
+          windowed   (get-messages-from-output catalog
+                                               (assoc test-db-config "log_based_version_window" 2)
+                                               nil
+                                               test-state)]
+      (is (= (range 100 105)
+             (map #(get-in % ["record" "value"]) (of-type "RECORD" windowed))))
+      (is (= (of-type "RECORD" unwindowed)
+             (of-type "RECORD" windowed)))
+      ;; A STATE is written after every window
+      (is (< (count (of-type "STATE" unwindowed))
+             (count (of-type "STATE" windowed))))
+      (is (= (get-in (last (of-type "STATE" unwindowed)) ["value" "bookmarks"])
+             (get-in (last (of-type "STATE" windowed)) ["value" "bookmarks"]))))))
+
+(deftest ^:integration verify-deleted-at-in-every-commit-time-mode
+  (with-matrix-assertions test-db-configs test-db-fixture
+    (delete-data test-db-config "dbo")
+    (let [test-state {"bookmarks"
+                      {"log_based_sync_test_dbo_data_table"
+                       {"version"                     1560965962084
+                        "initial_full_table_complete" true
+                        "current_log_version"         0}}}
+          catalog    (-> (catalog/discover test-db-config)
+                         (select-stream "log_based_sync_test_dbo_data_table" "LOG_BASED"))
+          deleted-at (fn [mode]
+                       (->> (get-messages-from-output catalog
+                                                      (assoc test-db-config "log_based_commit_time" mode)
+                                                      nil
+                                                      test-state)
+                            (filter #(= "RECORD" (% "type")))
+                            (map #(get-in % ["record" "_sdc_deleted_at"]))))]
+      (is (= 10 (count (deleted-at "join"))))
+      ;; The delete was one transaction, so every row has its commit time
+      (is (= (deleted-at "join") (deleted-at "lookup")))
+      (is (every? some? (deleted-at "sync_start")))
+      (is (thrown? IllegalArgumentException (deleted-at "nope"))))))
+
+(deftest commit-time-lookup-reads-a-window-of-versions
+  (let [queries (atom [])]
+    (with-redefs [logical/get-commit-times (fn [_ _ from-version]
+                                             (swap! queries conj from-version)
+                                             (into (sorted-map)
+                                                   (for [v (range from-version (+ from-version 3))
+                                                         :when (<= v 7)]
+                                                     [v (str "t" v)])))]
+      (let [lookup (logical/commit-time-lookup {} "db")]
+        (is (= ["t1" "t2" "t3" "t4" "t4" "t7"]
+               (map lookup [1 2 3 4 4 7])))
+        (is (= [1 4 7] @queries))
+        ;; Versions past the last commit are looked up again
+        (is (nil? (lookup 9)))
+        (is (= [1 4 7 9] @queries))))))
+
+(deftest ^:benchmark commit-time-join-benchmark
+  (with-matrix-assertions test-db-configs test-db-fixture
+    ;; Every insert and delete is its own transaction, so the commit table
+    ;; gets a row for each
+    (let [db-spec (assoc (config/->conn-map test-db-config) :dbname "log_based_sync_test")]
+      (dotimes [n 2000]
+        (jdbc/insert! db-spec "dbo.data_table" {:value (+ 1000 n)}))
+      (dotimes [n 1000]
+        (jdbc/execute! db-spec ["DELETE FROM dbo.data_table WHERE value = ?" (+ 1000 (* 2 n))])))
+    (let [db-spec    (assoc (config/->conn-map test-db-config) :dbname "log_based_sync_test")
+          catalog    (-> (catalog/discover test-db-config)
+                         (select-stream "log_based_sync_test_dbo_data_table" "LOG_BASED"))
+          state      {"bookmarks" {"log_based_sync_test_dbo_data_table" {"current_log_version" 0}}}
+          query      (fn [join-commit-time?]
+                       (logical/build-log-based-sql-query catalog
+                                                          "log_based_sync_test_dbo_data_table"
+                                                          state
+                                                          {:join-commit-time? join-commit-time?}))
+          time-ms    (fn [n sql-params]
+                       (let [start (System/nanoTime)]
+                         (dotimes [_ n] (doall (jdbc/query db-spec sql-params)))
+                         (/ (- (System/nanoTime) start) 1e6)))
+          n          20
+          _warm-up   (do (time-ms 2 (query true))
+                         (time-ms 2 (query false)))
+          joined     (time-ms n (query true))
+          not-joined (time-ms n (query false))]
+      (is (= (count (jdbc/query db-spec (query true)))
+             (count (jdbc/query db-spec (query false)))))
+      (println (format "Read %d changes %d times: with commit time join %.0f ms, without %.0f ms (%.1fx)"
+                       (count (jdbc/query db-spec (query false)))
+                       n joined not-joined (/ joined not-joined))))))
+
+(deftest changes-whose-row-is-gone-are-skipped
+  (is (logical/row-gone? {"sys_change_operation" "U" "row_found" 0}))
+  (is (logical/row-gone? {"sys_change_operation" "I" "row_found" 0}))
+  (is (not (logical/row-gone? {"sys_change_operation" "U" "row_found" 1})))
+  ;; Deletes never find their row
+  (is (not (logical/row-gone? {"sys_change_operation" "D" "row_found" 0}))))
+
+(deftest ^:integration verify-column-mask-filter-drops-updates-to-unselected-columns
+  (with-matrix-assertions test-db-configs test-db-fixture
+    (let [db-spec    (assoc (config/->conn-map test-db-config) :dbname "log_based_sync_test")
+          test-state {"bookmarks"
+                      {"log_based_sync_test_dbo_data_table"
+                       {"version"                     1560965962084
+                        "initial_full_table_complete" true
+                        "current_log_version"         0}}}
+          catalog    (-> (catalog/discover test-db-config)
+                         (select-stream "log_based_sync_test_dbo_data_table" "LOG_BASED")
+                         (assoc-in ["streams" "log_based_sync_test_dbo_data_table"
+                                    "metadata" "properties" "deselected_value" "selected"]
+                                   false))
+          records    (fn [config]
+                       (->> (get-messages-from-output catalog config nil test-state)
+                            (filter #(= "RECORD" (% "type")))
+                            (map #(get-in % ["record" "value"]))))]
+      (jdbc/execute! db-spec ["UPDATE dbo.data_table SET deselected_value = 1 WHERE value < 50"])
+      (jdbc/execute! db-spec ["UPDATE dbo.data_table SET value = value + 1000 WHERE value >= 95"])
+      (is (= 55 (count (records test-db-config))))
+      (let [masked (records (assoc test-db-config "log_based_column_mask_filter" "true"))]
+        (is (= 5 (count masked)))
+        (is (= (set (range 1095 1100)) (set masked)))))))
@@ -0,0 +1,123 @@
+(ns tap-mssql.sync-rowversion-test
+  (:require [tap-mssql.catalog :as catalog]
+            [tap-mssql.config :as config]
+            [clojure.test :refer [is deftest]]
+            [clojure.java.jdbc :as jdbc]
+            [clojure.data.json :as json]
+            [clojure.string :as string]
+            [tap-mssql.core :refer :all]
+            [tap-mssql.sync-strategies.common :as common]
+            [tap-mssql.sync-strategies.rowversion :as rowversion]
+            [tap-mssql.test-utils :refer [with-out-and-err-to-dev-null
+                                          test-db-config
+                                          test-db-configs
+                                          with-matrix-assertions]]))
+
+(defn get-destroy-database-command
+  [database]
+  (format "DROP DATABASE %s" (:table_cat database)))
+
+(defn maybe-destroy-test-db
+  [config]
+  (let [destroy-database-commands (->> (catalog/get-databases config)
+                                       (filter catalog/non-system-database?)
+                                       (map get-destroy-database-command))]
+    (let [db-spec (config/->conn-map config)]
+      (jdbc/db-do-commands db-spec destroy-database-commands))))
+
+(defn create-test-db
+  [config]
+  (let [db-spec (config/->conn-map config)]
+    (jdbc/db-do-commands db-spec ["CREATE DATABASE rowversion_sync_test"])
+    (jdbc/db-do-commands (assoc db-spec :dbname "rowversion_sync_test")
+                         [(jdbc/create-table-ddl
+                           "data_table"
+                           [[:id "int NOT NULL PRIMARY KEY"]
+                            [:value "int"]
+                            [:rv "rowversion"]])])
+    (jdbc/db-do-commands (assoc db-spec :dbname "rowversion_sync_test")
+                         [(jdbc/create-table-ddl
+                           "no_rowversion_table"
+                           [[:id "int NOT NULL PRIMARY KEY"]
+                            [:value "int"]])])))
+
+(defn populate-data
+  [config]
+  (jdbc/insert-multi! (-> (config/->conn-map config)
+                          (assoc :dbname "rowversion_sync_test"))
+                      "data_table"
+                      (map #(hash-map :id % :value %) (range 100))))
+
+(defn test-db-fixture [f config]
+  (with-out-and-err-to-dev-null
+    (maybe-destroy-test-db config)
+    (create-test-db config)
+    (populate-data config)
+    (f)))
+
+(defn get-messages-from-output
+  [config catalog state]
+  (as-> (with-out-str
+          (do-sync config catalog state))
+      output
+      (string/split output #"\n")
+      (filter (complement empty?) output)
+      (map json/read-str output)
+      (vec output)))
+
+(defn select-stream
+  [stream-name catalog]
+  (-> (assoc-in catalog ["streams" stream-name "metadata" "selected"] true)
+      (assoc-in ["streams" stream-name "metadata" "replication-method"] "ROWVERSION")))
+
+(defn records
+  [messages]
+  (->> messages
+       (filter #(= "RECORD" (% "type")))
+       (map #(get-in % ["record" "value"]))))
+
+(defn last-state
+  [messages]
+  (->> messages
+       (filter #(= "STATE" (% "type")))
+       last
+       (#(get % "value"))))
+
+(deftest build-rowversion-sync-query-test
+  (let [[sql & params] (rowversion/build-rowversion-sync-query "dbo" "data_table" ["id" "value"] "rv"
+                                                               "0x00000000000007D1" "0x00000000000007FF")]
+    (is (= (str "SELECT [id], [value], [rv] FROM [dbo].[data_table] "
+                "WHERE [rv] > ? AND [rv] <= ? ORDER BY [rv]")
+           sql))
+    (is (= ["0x00000000000007D1" "0x00000000000007FF"]
+           (map common/bytes->hex params))))
+  (let [[sql & params] (rowversion/build-rowversion-sync-query "dbo" "data_table" ["id" "rv"] "rv"
+                                                               nil "0x00000000000007FF")]
+    (is (= "SELECT [id], [rv] FROM [dbo].[data_table] WHERE [rv] <= ? ORDER BY [rv]"
+           sql))
+    (is (= 1 (count params)))))
+
+(deftest ^:integration verify-rowversion-sync-reads-each-change-once
+  (with-matrix-assertions test-db-configs test-db-fixture
+    (let [catalog        (->> (catalog/discover test-db-config)
+                              (select-stream "rowversion_sync_test_dbo_data_table"))
+          first-messages (get-messages-from-output test-db-config catalog {})
+          first-state    (last-state first-messages)]
+      (is (= (range 100) (records first-messages)))
+      (is (re-matches #"0x[0-9A-F]{16}"
+                      (get-in first-state ["bookmarks" "rowversion_sync_test_dbo_data_table" "rowversion"])))
+      ;; Nothing changed, nothing is read
+      (is (empty? (records (get-messages-from-output test-db-config catalog first-state))))
+      (let [db-spec (assoc (config/->conn-map test-db-config) :dbname "rowversion_sync_test")]
+        (jdbc/execute! db-spec ["UPDATE data_table SET value = value + 1000 WHERE id IN (3, 5)"])
+        (jdbc/insert! db-spec "data_table" {:id 100 :value 100}))
+      (is (= [1003 1005 100]
+             (records (get-messages-from-output test-db-config catalog first-state)))))))
+
+(deftest ^:integration verify-rowversion-sync-requires-a-rowversion-column
+  (with-matrix-assertions test-db-configs test-db-fixture
+    (is (thrown? UnsupportedOperationException
+                 (get-messages-from-output test-db-config
+                                           (->> (catalog/discover test-db-config)
+                                                (select-stream "rowversion_sync_test_dbo_no_rowversion_table"))
+                                           {})))))
@@ -7,3 +7,8 @@
       "Normal strings should be surrounded by []")
   (is (= "[chicken]]potpie]" (sanitize-names "chicken]potpie"))
       "Right square brackets should be closed and sanitized"))
+
+(deftest binary-positions-round-trip-through-hex
+  (let [bs (byte-array (map unchecked-byte [0 0 0 0 0 1 0xA2 0xFF]))]
+    (is (= "0x000000000001A2FF" (bytes->hex bs)))
+    (is (= (seq bs) (seq (hex->bytes (bytes->hex bs)))))))
@@ -0,0 +1,147 @@
+(ns tap-mssql.sync-temporal-test
+  (:require [tap-mssql.catalog :as catalog]
+            [tap-mssql.config :as config]
+            [clojure.test :refer [is deftest]]
+            [clojure.java.jdbc :as jdbc]
+            [clojure.data.json :as json]
+            [clojure.string :as string]
+            [tap-mssql.core :refer :all]
+            [tap-mssql.sync-strategies.temporal :as temporal]
+            [tap-mssql.test-utils :refer [with-out-and-err-to-dev-null
+                                          test-db-config
+                                          test-db-configs
+                                          with-matrix-assertions]]))
+
+(defn get-destroy-database-command
+  [database]
+  (format "DROP DATABASE %s" (:table_cat database)))
+
+(defn maybe-destroy-test-db
+  [config]
+  (let [destroy-database-commands (->> (catalog/get-databases config)
+                                       (filter catalog/non-system-database?)
+                                       (map get-destroy-database-command))]
+    (let [db-spec (config/->conn-map config)]
+      (jdbc/db-do-commands db-spec destroy-database-commands))))
+
+(defn create-test-db
+  [config]
+  (let [db-spec (config/->conn-map config)]
+    (jdbc/db-do-commands db-spec ["CREATE DATABASE temporal_sync_test"])
+    (jdbc/db-do-commands (assoc db-spec :dbname "temporal_sync_test")
+                         [(str "CREATE TABLE data_table ("
+                               "id int NOT NULL PRIMARY KEY, "
+                               "value int, "
+                               "valid_from datetime2 GENERATED ALWAYS AS ROW START NOT NULL, "
+                               "valid_to datetime2 GENERATED ALWAYS AS ROW END NOT NULL, "
+                               "PERIOD FOR SYSTEM_TIME (valid_from, valid_to)) "
+                               "WITH (SYSTEM_VERSIONING = ON (HISTORY_TABLE = dbo.data_table_history))")])))
+
+(defn populate-data
+  [config]
+  (jdbc/insert-multi! (-> (config/->conn-map config)
+                          (assoc :dbname "temporal_sync_test"))
+                      "data_table"
+                      (map #(hash-map :id % :value %) (range 10))))
+
+(defn test-db-fixture [f config]
+  (with-out-and-err-to-dev-null
+    (maybe-destroy-test-db config)
+    (create-test-db config)
+    (populate-data config)
+    (f)))
+
+(defn get-messages-from-output
+  [config catalog state]
+  (as-> (with-out-str
+          (do-sync config catalog state))
+      output
+      (string/split output #"\n")
+      (filter (complement empty?) output)
+      (map json/read-str output)
+      (vec output)))
+
+(defn records
+  [messages]
+  (->> messages
+       (filter #(= "RECORD" (% "type")))
+       (map #(get % "record"))))
+
+(defn last-state
+  [messages]
+  (->> messages
+       (filter #(= "STATE" (% "type")))
+       last
+       (#(get % "value"))))
+
+(deftest build-temporal-changes-query-test
+  (let [period-columns {:start-column "valid_from" :end-column "valid_to"}]
+    (is (= [(str "SELECT [id], [value], [valid_from] AS _sdc_period_time, 0 AS _sdc_is_delete "
+                 "FROM [dbo].[data_table] FOR SYSTEM_TIME BETWEEN ? AND ? "
+                 "WHERE [valid_from] > ? "
+                 "UNION ALL "
+                 "SELECT h.[id], h.[value], h.[valid_to], 1 "
+                 "FROM [dbo].[data_table] FOR SYSTEM_TIME BETWEEN ? AND ? AS h "
+                 "WHERE h.[valid_to] <= ? "
+                 "AND NOT EXISTS (SELECT 1 FROM [dbo].[data_table] FOR SYSTEM_TIME ALL AS n "
+                 "WHERE n.[id] = h.[id] AND n.[valid_from] = h.[valid_to]) "
+                 "ORDER BY _sdc_period_time, _sdc_is_delete")
+            "a" "b" "a"
+            "a" "b" "b"]
+           (temporal/build-temporal-changes-query "dbo" "data_table" ["id" "value"] ["id"] period-columns "a" "b")))
+    ;; Without a primary key deletes can't be told from updates
+    (is (= [(str "SELECT [value], [valid_from] AS _sdc_period_time, 0 AS _sdc_is_delete "
+                 "FROM [dbo].[data_table] FOR SYSTEM_TIME BETWEEN ? AND ? "
+                 "WHERE [valid_from] > ? "
+                 "ORDER BY _sdc_period_time")
+            "a" "b" "a"]
+           (temporal/build-temporal-changes-query "dbo" "data_table" ["value"] [] period-columns "a" "b")))))
+
+(deftest window-ends-never-pass-the-sync-end
+  (is (= "2020-01-01T10:30:00.0000000"
+         (temporal/get-window-end "2020-01-01T10:00:00.0000000" "2020-01-01T12:00:00.0000000" 30)))
+  (is (= "2020-01-01T12:00:00.0000000"
+         (temporal/get-window-end "2020-01-01T11:45:00.0000000" "2020-01-01T12:00:00.0000000" 30)))
+  (is (= "2020-01-01T12:00:00.0000000"
+         (temporal/get-window-end "2020-01-01T10:00:00.0000000" "2020-01-01T12:00:00.0000000" 0))))
+
+(deftest ^:integration verify-temporal-sync-reads-changes-and-deletes
+  (with-matrix-assertions test-db-configs test-db-fixture
+    (let [catalog        (-> (catalog/discover test-db-config)
+                             (assoc-in ["streams" "temporal_sync_test_dbo_data_table" "metadata" "selected"] true)
+                             (assoc-in ["streams" "temporal_sync_test_dbo_data_table" "metadata" "replication-method"] "TEMPORAL"))
+          _              (is (= true (get-in catalog ["streams" "temporal_sync_test_dbo_data_table" "metadata" "is-temporal"])))
+          _              (is (not (contains? (get-in catalog ["streams" "temporal_sync_test_dbo_data_table_history" "metadata"])
+                                             "is-temporal")))
+          first-messages (get-messages-from-output test-db-config catalog {})
+          first-state    (last-state first-messages)]
+      (is (= (range 10) (sort (map #(% "id") (records first-messages)))))
+      (is (string? (get-in first-state ["bookmarks" "temporal_sync_test_dbo_data_table" "period_time"])))
+      (let [db-spec (assoc (config/->conn-map test-db-config) :dbname "temporal_sync_test")]
+        (jdbc/execute! db-spec ["UPDATE data_table SET value = value + 100 WHERE id = 3"])
+        (jdbc/execute! db-spec ["DELETE FROM data_table WHERE id = 5"]))
+      (let [changes (records (get-messages-from-output test-db-config catalog first-state))]
+        (is (= [3 5] (map #(% "id") changes)))
+        (is (= 103 ((first changes) "value")))
+        (is (nil? ((first changes) "_sdc_deleted_at")))
+        (is (some? ((second changes) "_sdc_deleted_at")))))))
+
+(deftest ^:integration verify-temporal-sync-waits-for-open-transactions
+  (with-matrix-assertions test-db-configs test-db-fixture
+    (let [db-spec       (assoc (config/->conn-map test-db-config) :dbname "temporal_sync_test")
+          catalog       (-> (catalog/discover test-db-config)
+                            (assoc-in ["streams" "temporal_sync_test_dbo_data_table" "metadata" "selected"] true)
+                            (assoc-in ["streams" "temporal_sync_test_dbo_data_table" "metadata" "replication-method"] "TEMPORAL"))
+          first-state   (last-state (get-messages-from-output test-db-config catalog {}))]
+      (jdbc/db-do-commands db-spec ["CREATE TABLE scratch_table (id int)"])
+      (with-open [conn (jdbc/get-connection db-spec)]
+        (.setAutoCommit conn false)
+        ;; Begins a read/write transaction whose begin time stamps the
+        ;; update below, which only comes after the next sync
+        (jdbc/execute! {:connection conn} ["INSERT INTO scratch_table (id) VALUES (1)"])
+        (Thread/sleep 2000)
+        (let [open-state (last-state (get-messages-from-output test-db-config catalog first-state))]
+          (jdbc/execute! {:connection conn} ["UPDATE data_table SET value = value + 100 WHERE id = 3"])
+          (.commit conn)
+          (let [changes (records (get-messages-from-output test-db-config catalog open-state))]
+            (is (= [103] (map #(% "value") (filter #(= 3 (% "id")) changes))))))))))